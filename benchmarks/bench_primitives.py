@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the hot primitives
+
+Times NSEC3 hashing (Python and C extension), the NSEC3 chain indexes,
+domain name comparison and decoding, type bit map decoding, the zone file
+readers and the prehash ring buffers. Each benchmark is repeated and the
+best and median time per operation are reported. The input data is
+generated from a fixed seed, so the runs are repeatable.
+
+    python3 benchmarks/bench_primitives.py
+    python3 benchmarks/bench_primitives.py --json results.json
+    python3 benchmarks/bench_primitives.py --filter NSEC3Array \\
+            --index-sizes 10000,10000000
+
+With --json, the results are also written as a JSON document (to stdout if
+the file name is -), together with a description of the machine, to track
+regressions across releases. Note that NSEC3Tree needs roughly 1 GiB of
+memory per million records.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import operator
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+import n3map
+from n3map import log
+from n3map import name
+from n3map import prehash
+from n3map import query
+from n3map import rrfile
+from n3map import rrtypes
+from n3map import util
+from n3map.rrtypes.nsec3 import SHA1_MAX
+from n3map.tree.nsec3array import NSEC3Array
+from n3map.tree.nsec3tree import NSEC3Tree
+
+if prehash.HAS_NSEC3HASH:
+    from n3map import nsec3hash
+
+# version of the layout of the JSON document
+FORMAT_VERSION = 1
+SEED = 5155
+SALT = bytes.fromhex('aabbccdd')
+ZONE = name.fqdn_from_text('example.com')
+# A NS SOA MX TXT AAAA RRSIG NSEC DNSKEY
+BITMAP_TYPES = (1, 2, 6, 15, 16, 28, 46, 47, 48)
+
+
+class Runner(object):
+    def __init__(self, repeat, name_filter, verbose):
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.verbose = verbose
+        self.results = []
+
+    def selected(self, bench_name):
+        return (self.name_filter is None or
+                any(f in bench_name for f in self.name_filter))
+
+    def run(self, bench_name, params, unit, ops, func):
+        """Calls func() repeat times, each call performing ops operations.
+        func may return the time it took itself if only part of it is to be
+        measured."""
+        if not self.selected(bench_name):
+            return
+        times = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            elapsed = func()
+            if not isinstance(elapsed, float):
+                elapsed = time.perf_counter() - start
+            times.append(elapsed)
+        best = min(times)/ops
+        self.results.append({
+            'name' : bench_name,
+            'params' : params,
+            'unit' : unit,
+            'ops' : ops,
+            'times' : times,
+            'best' : best,
+            'median' : statistics.median(times)/ops,
+            })
+        if self.verbose:
+            p = ' '.join('{0}={1}'.format(k, v) for k, v in params.items())
+            print('{0:<26s} {1:<30s} {2:>10s} {3:>12.0f} {4:s}/s'.format(
+                bench_name, p, _format_time(best), 1.0/best, unit),
+                flush=True)
+
+
+def _format_time(t):
+    for unit, factor in (('s', 1.0), ('ms', 1e3), ('us', 1e6)):
+        if t*factor >= 1.0:
+            return '{0:.2f} {1:s}'.format(t*factor, unit)
+    return '{0:.0f} ns'.format(t*1e9)
+
+def _random_names(rnd, n):
+    return [name.DomainName(name.Label('{0:x}'.format(
+        rnd.getrandbits(32)).encode()), *ZONE.labels) for i in range(n)]
+
+def _random_chain(rnd, n):
+    """Returns the (hashed owner, next hashed owner) tuples of a complete
+    NSEC3 chain of n records in random order"""
+    keys = sorted(set(rnd.getrandbits(160).to_bytes(20, 'big')
+        for i in range(n)))
+    chain = [(keys[i], keys[(i+1) % len(keys)]) for i in range(len(keys))]
+    rnd.shuffle(chain)
+    return chain
+
+def _b32(h):
+    return util.base32_ext_hex_encode(h).lower().decode()
+
+
+def bench_hashes(runner, rnd, count):
+    names = _random_names(rnd, count)
+    wire = [dn.to_wire() for dn in names]
+    zone_wire = ZONE.to_wire()
+    for iterations in (0, 10, 100):
+        runner.run('compute_hash/python', {'iterations' : iterations},
+                'hash', count, lambda: [rrtypes.nsec3.compute_hash(dn, SALT,
+                    iterations) for dn in names])
+        if not prehash.HAS_NSEC3HASH:
+            continue
+        runner.run('compute_hash/cext', {'iterations' : iterations},
+                'hash', count, lambda: [nsec3hash.compute_hash(w, SALT,
+                    iterations) for w in wire])
+        runner.run('compute_hashes/cext', {'iterations' : iterations,
+            'simd' : nsec3hash.simd_backend()}, 'hash', count,
+            lambda: nsec3hash.compute_hashes(zone_wire, SALT, iterations, 0,
+                count))
+
+def bench_index(runner, rnd, index_type, sizes, lookups):
+    bench_name = index_type.__name__
+    for size in sizes:
+        if not (runner.selected(bench_name + '.insert') or
+                runner.selected(bench_name + '.find_interval')):
+            continue
+        chain = _random_chain(rnd, size)
+        def build():
+            index = index_type(hash_max=SHA1_MAX)
+            for key, int_end in chain:
+                index.insert(key, None, int_end)
+            return index
+        runner.run(bench_name + '.insert', {'records' : size}, 'insert',
+                size, build)
+        if runner.selected(bench_name + '.find_interval'):
+            index = build()
+            keys = [rnd.getrandbits(160).to_bytes(20, 'big')
+                    for i in range(lookups)]
+            runner.run(bench_name + '.find_interval', {'records' : size},
+                    'lookup', lookups, lambda: [index.find_interval(k)
+                        for k in keys])
+            del index
+        del chain
+
+def bench_names(runner, rnd, count):
+    names = _random_names(rnd, count)
+    others = list(names)
+    rnd.shuffle(others)
+    # equal, but distinct objects: the comparison has to look at all labels
+    copies = [name.domainname_from_text(str(dn)) for dn in names]
+    runner.run('DomainName.__lt__', {}, 'comparison', count,
+            lambda: list(map(operator.lt, names, others)))
+    runner.run('DomainName.__eq__', {'case' : 'equal'}, 'comparison', count,
+            lambda: list(map(operator.eq, names, copies)))
+    runner.run('DomainName.__eq__', {'case' : 'different'}, 'comparison',
+            count, lambda: list(map(operator.eq, names, others)))
+    wire = [dn.to_wire() for dn in names]
+    runner.run('domainname_from_wire', {}, 'name', count,
+            lambda: list(map(name.domainname_from_wire, wire)))
+
+def bench_bitmaps(runner, count):
+    bitmap = bytearray(max(BITMAP_TYPES)//8 + 1)
+    for t in BITMAP_TYPES:
+        bitmap[t//8] |= 0x80 >> (t % 8)
+    window_list = [(0, bytes(bitmap))]
+    runner.run('_rrtypes_from_window_list', {'types' : len(BITMAP_TYPES)},
+            'bitmap', count, lambda: [query._rrtypes_from_window_list(
+                window_list) for i in range(count)])
+
+def bench_readers(runner, rnd, count, tmpdir):
+    filename = os.path.join(tmpdir, 'nsec3.zone')
+    with open(filename, 'w') as f:
+        for key, int_end in sorted(_random_chain(rnd, count)):
+            f.write('{0:s}.{1:s}\t300\tIN\tNSEC3 1 0 10 {2:s} {3:s}\t'
+                    'A RRSIG\n'.format(_b32(key), str(ZONE), SALT.hex(),
+                        _b32(int_end)))
+    def read_nsec3():
+        rrf = rrfile.open_input_rrfile(filename)
+        try:
+            n = sum(1 for rr in rrf.nsec3_reader())
+        finally:
+            rrf.close()
+        assert n == count
+    runner.run('nsec3_reader', {'records' : count}, 'record', count,
+            read_nsec3)
+    for processes in sorted({1, os.cpu_count() or 1}):
+        def load_nsec3():
+            records = rrfile.load_nsec3_records(filename, processes)
+            records.close()
+            assert len(records) == count
+        runner.run('load_nsec3_records', {'records' : count,
+            'processes' : processes}, 'record', count, load_nsec3)
+
+    filename = os.path.join(tmpdir, 'nsec.zone')
+    names = sorted(_random_names(rnd, count))
+    names = [dn for i, dn in enumerate(names) if i == 0 or dn != names[i-1]]
+    with open(filename, 'w') as f:
+        for i, dn in enumerate(names):
+            f.write('{0:s}\t300\tIN\tNSEC {1:s}\tA RRSIG NSEC\n'.format(
+                str(dn), str(names[(i+1) % len(names)])))
+    def read_nsec():
+        rrf = rrfile.open_input_rrfile(filename)
+        try:
+            n = sum(1 for rr in rrf.nsec_reader())
+        finally:
+            rrf.close()
+        assert n == len(names)
+    runner.run('nsec_reader', {'records' : len(names)}, 'record',
+            len(names), read_nsec)
+
+def _ring_producer(ring, count, start, counters, digests):
+    start.wait()
+    for i in range(count):
+        ring.put(counters, digests, 1024, i)
+    ring.close()
+
+def bench_rings(runner, count, element_size):
+    counters = bytes(8*element_size)
+    digests = bytes(prehash.SHA1_LENGTH*element_size)
+    params = {'element_size' : element_size}
+
+    ring = prehash.HashRing(element_size)
+    def local():
+        for i in range(count):
+            ring.put(counters, digests, 1024, i)
+            ring.get_nowait()
+    try:
+        runner.run('HashRing/local', params, 'element', count, local)
+    finally:
+        ring.close()
+        ring.unlink()
+
+    def remote():
+        ring = prehash.HashRing(element_size)
+        start = multiprocessing.Event()
+        p = multiprocessing.Process(target=_ring_producer,
+                args=(ring, count, start, counters, digests))
+        try:
+            p.start()
+            rings = prehash.HashRingSet([ring])
+            t = time.perf_counter()
+            start.set()
+            for i in range(count):
+                rings.get()
+            return time.perf_counter() - t
+        finally:
+            p.join()
+            ring.close()
+            ring.unlink()
+    runner.run('HashRing/process', params, 'element', count, remote)
+
+
+def machine_info():
+    info = {
+            'n3map' : n3map.__version__,
+            'python' : platform.python_version(),
+            'implementation' : platform.python_implementation(),
+            'platform' : platform.platform(),
+            'machine' : platform.machine(),
+            'processor' : platform.processor(),
+            'cpus' : os.cpu_count(),
+            'nsec3hash' : prehash.HAS_NSEC3HASH,
+            }
+    if prehash.HAS_NSEC3HASH:
+        info['simd_backends'] = nsec3hash.simd_backends()
+    return info
+
+def _sizes(s):
+    try:
+        return [int(x) for x in s.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid list of sizes: ' + s)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--json', metavar='FILE',
+            help='write the results as JSON to FILE (- for stdout)')
+    ap.add_argument('--filter', action='append',
+            help='run only benchmarks whose name contains this string, '
+            'may be given more than once')
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--count', type=int, default=20000,
+            help='number of operations of most benchmarks')
+    ap.add_argument('--index-sizes', type=_sizes,
+            default=[10000, 100000, 1000000],
+            help='comma separated numbers of records of the chain indexes')
+    ap.add_argument('--records', type=int, default=100000,
+            help='number of records read by the zone file readers')
+    ap.add_argument('--element-size', type=int, default=256,
+            help='number of hashes in a prehash ring buffer element')
+    args = ap.parse_args()
+
+    log.logger = log.Logger()
+    runner = Runner(args.repeat, args.filter, verbose=(args.json != '-'))
+    rnd = random.Random(SEED)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    bench_hashes(runner, rnd, args.count)
+    for index_type in (NSEC3Array, NSEC3Tree):
+        bench_index(runner, rnd, index_type, args.index_sizes, args.count)
+    bench_names(runner, rnd, args.count)
+    bench_bitmaps(runner, args.count)
+    with tempfile.TemporaryDirectory(prefix='n3map-bench-') as tmpdir:
+        bench_readers(runner, rnd, args.records, tmpdir)
+    bench_rings(runner, args.count, args.element_size)
+
+    if args.json is not None:
+        doc = {
+                'format' : FORMAT_VERSION,
+                'started' : started.isoformat(),
+                'seed' : SEED,
+                'repeat' : args.repeat,
+                'machine' : machine_info(),
+                'benchmarks' : runner.results,
+                }
+        if args.json == '-':
+            json.dump(doc, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(doc, f, indent=2)
+                f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Benchmark of the UDP I/O path of the asyncio query engine
+
+Sends a fixed number of NXDOMAIN queries to a local stand-in authoritative
+server through AggressiveQueryProvider, keeping up to --concurrency queries
+in flight, once with sendmmsg/recvmmsg and once without. Reports queries/s
+and the number of send/receive system calls per query.
+
+    python3 benchmarks/bench_udp_io.py --queries 20000 --concurrency 256
+"""
+import argparse
+import ipaddress
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from n3map import log
+from n3map import mmsg
+from n3map import name
+from n3map import queryprovider
+
+import standin
+
+
+def run(port, num_queries, concurrency, use_mmsg):
+    ns = queryprovider.NameServer(ipaddress.ip_address('127.0.0.1'), port,
+            '127.0.0.1')
+    qp = queryprovider.AggressiveQueryProvider([ns], timeout=2.0,
+            max_retries=-1, max_errors=-1, engine='asyncio',
+            use_mmsg=use_mmsg)
+    zone = name.fqdn_from_text('example.com')
+    sent = 0
+    received = 0
+    start = time.monotonic()
+    try:
+        while received < num_queries:
+            while sent < num_queries and sent - received < concurrency:
+                qp.query_ff(name.DomainName(
+                    name.Label('q{0:d}'.format(sent).encode()), *zone.labels))
+                sent += 1
+            received += len(qp.collectresponses(block=True))
+        elapsed = time.monotonic() - start
+    finally:
+        qp.stop()
+    send_calls, recv_calls = qp._engine.io_stats()
+    return {
+            'queries' : qp.stats['queries'],
+            'elapsed' : elapsed,
+            'send_calls' : send_calls,
+            'recv_calls' : recv_calls,
+            }
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--port', type=int, default=5399)
+    ap.add_argument('--queries', type=int, default=20000)
+    ap.add_argument('--concurrency', type=int, default=256)
+    args = ap.parse_args()
+
+    log.logger = log.Logger()
+    if not mmsg.HAS_MMSG:
+        log.warn('sendmmsg/recvmmsg not available on this system')
+
+    server = standin.start(args.port, kind='nsec3', size=1000, iterations=0)
+    try:
+        print('{0:>8s} {1:>9s} {2:>9s} {3:>10s} {4:>10s} {5:>9s}'.format(
+            'mode', 'queries', 'q/s', 'send calls', 'recv calls',
+            'calls/q'))
+        modes = [('single', False)]
+        if mmsg.HAS_MMSG:
+            modes.append(('mmsg', True))
+        for mode, use_mmsg in modes:
+            r = run(args.port, args.queries, args.concurrency, use_mmsg)
+            calls = r['send_calls'] + r['recv_calls']
+            print('{0:>8s} {1:9d} {2:9.0f} {3:10d} {4:10d} {5:9.2f}'.format(
+                mode, r['queries'], r['queries']/r['elapsed'],
+                r['send_calls'], r['recv_calls'], calls/r['queries']))
+    finally:
+        server.kill()
+        server.wait()
+
+if __name__ == '__main__':
+    main()
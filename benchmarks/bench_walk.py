@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of complete zone walks
+
+Starts a local stand-in authoritative server (see standin.py) for each
+scenario and runs map.py against it, like a user would. Reports the wall
+time, queries/s, hashes/s, queries per discovered record and the peak
+resident set size of the largest n3map process (the walker or one of its
+prehash processes). The numbers of queries, hashes and records are read
+from the statistics at the end of the output file.
+
+Scenarios in which n3map is expected to give up, like a zone using NSEC3
+white lies, report the status 'detected' with the time and number of queries
+until n3map detected the condition, taken from its last status line.
+
+    python3 benchmarks/bench_walk.py --size 2000 --latency 0.01
+    python3 benchmarks/bench_walk.py --scenario nsec3-parallel -- --processes=2
+
+Arguments after -- are passed to every walk.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import standin
+
+MAP_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+        'map.py')
+
+# name, zone type, stand-in variant, n3map arguments, expected fatal error
+SCENARIOS = [
+        ('nsec3', 'nsec3', 'plain', ['-3'], None),
+        ('nsec3-parallel', 'nsec3', 'plain', ['-3', '-f', '32'], None),
+        ('nsec3-window', 'nsec3', 'plain',
+            ['-3', '-f', '32', '--candidate-window=256'], None),
+        ('nsec3-wildcard', 'nsec3', 'wildcard', ['-3', '-f', '32'], None),
+        ('nsec3-white-lies', 'nsec3', 'white-lies', ['-3'],
+            'minimally-covering NSEC3 record'),
+        ('nsec-a', 'nsec', 'plain', ['-n', '-A'], None),
+        ('nsec-nsec', 'nsec', 'plain', ['-n', '-N'], None),
+        ('nsec-speculate', 'nsec', 'plain', ['-n', '-N', '--speculate=16'],
+            None),
+        ('nsec-wildcard', 'nsec', 'wildcard', ['-n'], None),
+        ]
+
+_STAT_PATTERN = re.compile(r'^; (number of records|queries|tested_hashes)'
+        r' = (\d+)$')
+_STATUS_QUERIES_PATTERN = re.compile(r'^;; r = *\d+; q = *(\d+);')
+
+
+def read_stats(filename):
+    stats = {}
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                m = _STAT_PATTERN.match(line)
+                if m is not None:
+                    stats[m.group(1)] = int(m.group(2))
+    except OSError:
+        pass
+    return stats
+
+def walk(port, zone, args, workdir):
+    """Runs map.py and waits for it to finish. Returns a dict with the exit
+    code, wall time, peak RSS in KiB and the statistics of the walk."""
+    output = os.path.join(workdir, 'walk.zone')
+    if os.path.exists(output):
+        os.unlink(output)
+    cmd = [sys.executable, MAP_PY, '--output=' + output] + args + [
+            '127.0.0.1:{0:d}'.format(port), zone]
+    with open(os.path.join(workdir, 'walk.log'), 'w') as log:
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log,
+                stderr=subprocess.STDOUT)
+        # the rusage of the child includes its reaped children, i.e. the
+        # prehash processes
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.monotonic() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    result = read_stats(output)
+    result['returncode'] = proc.returncode
+    result['elapsed'] = elapsed
+    result['maxrss'] = rusage.ru_maxrss
+    return result
+
+def status_queries(filename):
+    """Returns the number of queries in the last status line of a walk's
+    log, or 0"""
+    queries = 0
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                m = _STATUS_QUERIES_PATTERN.match(line)
+                if m is not None:
+                    queries = int(m.group(1))
+    except OSError:
+        pass
+    return queries
+
+def error_message(filename):
+    """Returns the fatal error message in the log of a failed walk, or its
+    last line"""
+    try:
+        with open(filename, 'r') as f:
+            lines = [l.strip() for l in f if l.strip()]
+    except OSError:
+        return ''
+    for line in lines:
+        if 'fatal:' in line:
+            return line
+    return lines[-1] if len(lines) > 0 else ''
+
+def main():
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        extra = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    names = [s[0] for s in SCENARIOS]
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--port', type=int, default=5398)
+    ap.add_argument('--scenario', action='append', choices=names,
+            help='run only this scenario, may be given more than once')
+    ap.add_argument('--size', type=int, default=1000,
+            help='number of names in the zone, excluding the apex')
+    ap.add_argument('--salt', default='aabb', help='NSEC3 salt in hex')
+    ap.add_argument('--iterations', type=int, default=5)
+    ap.add_argument('--latency', type=float, default=0.0,
+            help='delay of each response in seconds')
+    ap.add_argument('--loss', type=float, default=0.0,
+            help='fraction of UDP queries to drop')
+    ap.add_argument('--zone', default='example.com.')
+    args = ap.parse_args(argv)
+
+    scenarios = [s for s in SCENARIOS
+            if args.scenario is None or s[0] in args.scenario]
+    workdir = tempfile.mkdtemp(prefix='n3map-bench-')
+    print('{0:<17s} {1:>7s} {2:>7s} {3:>7s} {4:>8s} {5:>8s} {6:>10s} '
+            '{7:>6s} {8:>8s}'.format('scenario', 'status', 'records',
+                'queries', 'time/s', 'q/s', 'hashes/s', 'q/rec', 'RSS/MiB'))
+    try:
+        for name, kind, variant, walk_args, expected in scenarios:
+            server = standin.start(args.port, kind=kind, size=args.size,
+                    salt=args.salt, iterations=args.iterations,
+                    latency=args.latency, loss=args.loss, zone=args.zone,
+                    variant=variant)
+            try:
+                r = walk(args.port, args.zone, walk_args + extra, workdir)
+            finally:
+                server.kill()
+                server.wait()
+            log_file = os.path.join(workdir, 'walk.log')
+            status = 'ok'
+            if r['returncode'] != 0:
+                status = 'failed'
+                if (expected is not None and
+                        expected in error_message(log_file)):
+                    status = 'detected'
+                    r['queries'] = status_queries(log_file)
+            records = r.get('number of records', 0)
+            queries = r.get('queries', 0)
+            hashes = r.get('tested_hashes', 0)
+            print('{0:<17s} {1:>7s} {2:7d} {3:7d} {4:8.2f} {5:8.0f} '
+                    '{6:>10s} {7:>6s} {8:8.1f}'.format(name, status,
+                        records, queries, r['elapsed'],
+                        queries/r['elapsed'],
+                        '{0:.0f}'.format(hashes/r['elapsed'])
+                            if kind == 'nsec3' else '-',
+                        '{0:.2f}'.format(queries/records)
+                            if records > 0 else '-',
+                        r['maxrss']/1024.0), flush=True)
+            if status == 'failed':
+                print('    ' + error_message(log_file))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Local stand-in authoritative server for benchmarks
+
+Serves a synthetic, signed-looking NSEC or NSEC3 zone over UDP and TCP on
+the loopback interface. The signatures are not valid, n3map does not verify
+them. Pipelined TCP queries are answered concurrently, so with --latency
+the responses may arrive out of order.
+
+Variants:
+    plain       every name in the zone has an A record
+    wildcard    the zone also has a wildcard *.<zone>, names which do not
+                exist get a synthesized A record along with the NSEC or NSEC3
+                record covering the next closer name
+    white-lies  NSEC3 only: NXDOMAIN responses carry minimally covering
+                NSEC3 records (RFC 7129, appendix B), which cannot be walked
+
+    python3 benchmarks/standin.py --port 5300 --kind nsec3 --size 1000
+
+prints "ready" once the zone is generated.
+"""
+import argparse
+import base64
+import bisect
+import hashlib
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+_B32_TO_B32HEX = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567',
+                                 b'0123456789abcdefghijklmnopqrstuv')
+
+
+def nsec3_hash(name, salt, iterations):
+    x = name.canonicalize().to_wire()
+    h = hashlib.sha1(x + salt).digest()
+    for _ in range(iterations):
+        h = hashlib.sha1(h + salt).digest()
+    return h
+
+def b32hex(h):
+    return base64.b32encode(h).translate(_B32_TO_B32HEX).decode()
+
+def _add_to_hash(h, n):
+    return ((int.from_bytes(h, 'big') + n) % (1 << 160)).to_bytes(20, 'big')
+
+
+VARIANTS = ('plain', 'wildcard', 'white-lies')
+
+class Zone(object):
+    def __init__(self, origin, size, kind='nsec3', salt=b'', iterations=0,
+            seed=1, variant='plain'):
+        if variant not in VARIANTS:
+            raise ValueError('unknown variant: ' + variant)
+        if variant == 'white-lies' and kind != 'nsec3':
+            raise ValueError('white lies are only supported for NSEC3')
+        self.origin = dns.name.from_text(origin)
+        self.kind = kind
+        self.salt = salt
+        self.iterations = iterations
+        self.variant = variant
+        rnd = random.Random(seed)
+        self.names = [self.origin] + [
+                dns.name.from_text('h{0:d}-{1:x}'.format(i,
+                    rnd.getrandbits(24)), self.origin) for i in range(size)]
+        if variant == 'wildcard':
+            self.names.append(dns.name.from_text('*', self.origin))
+        self.nameset = set(self.names)
+        self._sig = ('{0:s} 8 2 3600 20300101000000 20200101000000 1 ' +
+                self.origin.to_text() + ' ' +
+                base64.b64encode(b'x'*64).decode())
+        if kind == 'nsec3':
+            self.hashes = sorted(nsec3_hash(n, salt, iterations)
+                    for n in self.names)
+        else:
+            self.sorted_names = sorted(self.names)
+
+    def _rrsig(self, owner, rrtype):
+        return dns.rrset.from_text(owner, 300, 'IN', 'RRSIG',
+                self._sig.format(rrtype))
+
+    def nsec3_rrsets(self, i):
+        return self._nsec3_rrsets(self.hashes[i],
+                self.hashes[(i+1) % len(self.hashes)])
+
+    def covering_nsec3_rrsets(self, qname):
+        h = nsec3_hash(qname, self.salt, self.iterations)
+        if self.variant == 'white-lies':
+            return self._nsec3_rrsets(_add_to_hash(h, -1), _add_to_hash(h, 1))
+        return self.nsec3_rrsets(bisect.bisect_right(self.hashes, h) - 1)
+
+    def _nsec3_rrsets(self, h, next_h):
+        owner = dns.name.Name([b32hex(h).encode()]).concatenate(self.origin)
+        rdata = '1 0 {0:d} {1:s} {2:s} A RRSIG'.format(self.iterations,
+                self.salt.hex() or '-', b32hex(next_h))
+        return [dns.rrset.from_text(owner, 300, 'IN', 'NSEC3', rdata),
+                self._rrsig(owner, 'NSEC3')]
+
+    def covering_nsec_rrsets(self, qname):
+        return self.nsec_rrsets(
+                bisect.bisect_right(self.sorted_names, qname) - 1)
+
+    def nsec_rrsets(self, i):
+        owner = self.sorted_names[i]
+        next_owner = self.sorted_names[(i+1) % len(self.sorted_names)]
+        rdata = '{0:s} A RRSIG NSEC'.format(next_owner.to_text())
+        return [dns.rrset.from_text(owner, 300, 'IN', 'NSEC', rdata),
+                self._rrsig(owner, 'NSEC')]
+
+    def answer(self, request):
+        r = dns.message.make_response(request)
+        r.flags |= dns.flags.AA
+        qname = request.question[0].name
+        qtype = request.question[0].rdtype
+        if qname == self.origin and qtype == dns.rdatatype.SOA:
+            r.answer.append(dns.rrset.from_text(qname, 300, 'IN', 'SOA',
+                'ns. hostmaster. 1 7200 3600 1209600 300'))
+            return r
+        if qname == self.origin and qtype == dns.rdatatype.DNSKEY:
+            r.answer.append(dns.rrset.from_text(qname, 300, 'IN', 'DNSKEY',
+                '257 3 8 ' + base64.b64encode(b'k'*64).decode()))
+            return r
+        if not qname.is_subdomain(self.origin):
+            r.set_rcode(dns.rcode.REFUSED)
+            return r
+        exists = qname in self.nameset
+        if self.kind == 'nsec' and qtype == dns.rdatatype.NSEC:
+            if exists:
+                r.answer.extend(self.nsec_rrsets(
+                    bisect.bisect_left(self.sorted_names, qname)))
+            else:
+                r.authority.extend(self.covering_nsec_rrsets(qname))
+            return r
+        if not exists:
+            # all names are directly below the origin, so the origin is the
+            # closest encloser unless the next closer name exists
+            next_closer = qname.split(len(self.origin) + 1)[1]
+            if self.variant == 'wildcard' and next_closer not in self.nameset:
+                # the proof that the next closer name does not exist
+                if self.kind == 'nsec':
+                    r.authority.extend(self.covering_nsec_rrsets(qname))
+                else:
+                    r.authority.extend(self.covering_nsec3_rrsets(next_closer))
+            else:
+                r.set_rcode(dns.rcode.NXDOMAIN)
+                if self.kind == 'nsec':
+                    r.authority.extend(self.covering_nsec_rrsets(qname))
+                else:
+                    r.authority.extend(self.covering_nsec3_rrsets(qname))
+                return r
+        r.answer.append(dns.rrset.from_text(qname, 300, 'IN', 'A',
+            '192.0.2.1'))
+        r.answer.append(self._rrsig(qname, 'A'))
+        return r
+
+
+def _recv_exactly(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if len(chunk) == 0:
+            raise EOFError
+        data += chunk
+    return data
+
+def _serve_tcp_connection(zone, conn, latency):
+    lock = threading.Lock()
+    def respond(wire):
+        with lock:
+            try:
+                conn.sendall(struct.pack('!H', len(wire)) + wire)
+            except OSError:
+                pass
+    try:
+        while True:
+            length, = struct.unpack('!H', _recv_exactly(conn, 2))
+            try:
+                request = dns.message.from_wire(_recv_exactly(conn, length))
+            except EOFError:
+                raise
+            except Exception:
+                continue
+            wire = zone.answer(request).to_wire(max_size=65535)
+            if latency > 0:
+                threading.Timer(latency, respond, (wire,)).start()
+            else:
+                respond(wire)
+    except (EOFError, OSError):
+        pass
+
+def serve_tcp(zone, sock, latency=0.0):
+    while True:
+        conn, addr = sock.accept()
+        t = threading.Thread(target=_serve_tcp_connection,
+                args=(zone, conn, latency))
+        t.daemon = True
+        t.start()
+
+def serve(zone, host, port, latency=0.0, loss=0.0, max_udp_size=None,
+        seed=None):
+    rnd = random.Random(seed)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    tcp_sock = socket.socket(family, socket.SOCK_STREAM)
+    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_sock.bind((host, port))
+    tcp_sock.listen(16)
+    t = threading.Thread(target=serve_tcp, args=(zone, tcp_sock, latency))
+    t.daemon = True
+    t.start()
+    print('ready', flush=True)
+    while True:
+        data, addr = sock.recvfrom(65535)
+        if loss > 0 and rnd.random() < loss:
+            continue
+        try:
+            request = dns.message.from_wire(data)
+        except Exception:
+            continue
+        response = zone.answer(request)
+        wire = response.to_wire(max_size=65535)
+        max_size = request.payload
+        if max_udp_size is not None:
+            max_size = min(max_size, max_udp_size)
+        if len(wire) > max_size:
+            response.flags |= dns.flags.TC
+            del response.answer[:]
+            del response.authority[:]
+            wire = response.to_wire()
+        if latency > 0:
+            threading.Timer(latency, sock.sendto, (wire, addr)).start()
+        else:
+            sock.sendto(wire, addr)
+
+
+def start(port, kind='nsec3', size=200, salt='aabb', iterations=5,
+        latency=0.0, loss=0.0, zone='example.com.', host='127.0.0.1',
+        max_udp_size=None, variant='plain'):
+    """Starts the server in a subprocess and waits until it is ready.
+    Returns the subprocess.Popen object."""
+    args = [sys.executable, __file__, '--host', host, '--port', str(port),
+            '--kind', kind, '--size', str(size), '--salt', salt,
+            '--iterations', str(iterations), '--latency', str(latency),
+            '--loss', str(loss), '--zone', zone, '--variant', variant]
+    if max_udp_size is not None:
+        args += ['--max-udp-size', str(max_udp_size)]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    if proc.stdout.readline().strip() != b'ready':
+        proc.kill()
+        raise RuntimeError('stand-in server failed to start')
+    return proc
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=5353)
+    ap.add_argument('--kind', choices=('nsec', 'nsec3'), default='nsec3')
+    ap.add_argument('--size', type=int, default=200,
+            help='number of names in the zone, excluding the apex')
+    ap.add_argument('--salt', default='aabb', help='NSEC3 salt in hex')
+    ap.add_argument('--iterations', type=int, default=5)
+    ap.add_argument('--latency', type=float, default=0.0,
+            help='delay of each response in seconds')
+    ap.add_argument('--loss', type=float, default=0.0,
+            help='fraction of UDP queries to drop')
+    ap.add_argument('--max-udp-size', type=int, default=None,
+            help='truncate larger UDP responses')
+    ap.add_argument('--zone', default='example.com.')
+    ap.add_argument('--variant', choices=VARIANTS, default='plain')
+    args = ap.parse_args()
+    try:
+        zone = Zone(args.zone, args.size, args.kind, bytes.fromhex(args.salt),
+                args.iterations, variant=args.variant)
+    except ValueError as e:
+        ap.error(str(e))
+    try:
+        serve(zone, args.host, args.port, args.latency, args.loss,
+                args.max_udp_size)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+import asyncio
+import collections
+import ipaddress
+import itertools
+import socket
+import threading
+
+import dns.entropy
+import dns.exception
+
+from . import exception
+from . import log
+from . import mmsg
+from . import query
+from .wireresult import WireResult
+
+# number of UDP sockets per address family
+DEFAULT_NUM_SOCKETS = 4
+
+
+class _DatagramSocket(asyncio.DatagramProtocol):
+    """UDP socket using an asyncio datagram transport, one system call per
+    datagram"""
+    def __init__(self, engine):
+        self._engine = engine
+        self.transport = None
+        self.send_calls = 0
+        self.recv_calls = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.recv_calls += 1
+        self._engine._datagram_received(self, data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the query will time out
+        log.debug2("UDP socket error: ", str(exc))
+
+    def sendto(self, data, addr):
+        self.send_calls += 1
+        self.transport.sendto(data, addr)
+
+    def close(self):
+        self.transport.close()
+
+
+class _MMsgDatagramSocket(object):
+    """UDP socket using sendmmsg(2)/recvmmsg(2)
+
+    Datagrams passed to sendto() are queued and sent in one batch after the
+    current iteration of the event loop, all datagrams waiting in the
+    receive buffer are read at once.
+    """
+    def __init__(self, engine, loop, sock):
+        self._engine = engine
+        self._loop = loop
+        self._sock = mmsg.MMsgSocket(sock)
+        self._queue = collections.deque()
+        self._flush_handle = None
+        self._writing = False
+        loop.add_reader(sock.fileno(), self._readable)
+
+    @property
+    def send_calls(self):
+        return self._sock.send_calls
+
+    @property
+    def recv_calls(self):
+        return self._sock.recv_calls
+
+    def sendto(self, data, addr):
+        self._queue.append((data, addr))
+        if self._flush_handle is None and not self._writing:
+            self._flush_handle = self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        queue = self._queue
+        while len(queue) > 0:
+            batch = [queue[i] for i in range(min(len(queue),
+                self._sock.batch_size))]
+            try:
+                n = self._sock.sendmmsg(batch)
+            except OSError as e:
+                # drop the datagram, the query will time out
+                log.debug2("failed to send UDP datagram: ", str(e))
+                n = 1
+            if n == 0:
+                if not self._writing:
+                    self._loop.add_writer(self._sock.fileno(), self._flush)
+                    self._writing = True
+                return
+            for i in range(n):
+                queue.popleft()
+        if self._writing:
+            self._loop.remove_writer(self._sock.fileno())
+            self._writing = False
+
+    def _readable(self):
+        while True:
+            try:
+                datagrams = self._sock.recvmmsg()
+            except OSError as e:
+                log.debug2("UDP socket error: ", str(e))
+                return
+            for data, addr in datagrams:
+                self._engine._datagram_received(self, data, addr)
+            if len(datagrams) < self._sock.batch_size:
+                return
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if self._writing:
+            self._loop.remove_writer(self._sock.fileno())
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+
+
+class AsyncQueryEngine(object):
+    """Sends queries from an asyncio event loop running in its own thread
+
+    All queries are multiplexed over a few unconnected UDP sockets.
+    Responses are matched to their query by source address and message ID
+    and must pass query.wire_is_response(), everything else is
+    ignored. Results are put into the result_queue of each query as (query
+    id, result) tuples, the same way as QueryThread does, so an engine can
+    be shared by several query providers.
+
+    On Linux, datagrams are sent and received in batches using
+    sendmmsg(2)/recvmmsg(2) unless use_mmsg is False.
+
+    Truncated responses, or all queries if tcp_only is True, are sent over
+    the nameserver's persistent TCP connections (NameServer.tcp_pool).
+    """
+    def __init__(self, num_sockets=DEFAULT_NUM_SOCKETS, use_mmsg=True,
+            tcp_only=False):
+        self._num_sockets = num_sockets
+        self._use_mmsg = use_mmsg and mmsg.HAS_MMSG
+        self._tcp_only = tcp_only
+        self._sockets = {}
+        self._socket_cycle = {}
+        # every socket ever created, for io_stats()
+        self._all_sockets = []
+        # (socket, message id, ip, port) -> (request, future)
+        self._pending = {}
+        self._tasks = set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, q):
+        self._loop.call_soon_threadsafe(self._start_query, q)
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for sockets in self._sockets.values():
+            for sock in sockets:
+                sock.close()
+        self._sockets = {}
+
+    def io_stats(self):
+        """Returns the number of send and receive system calls made so far
+        as a tuple (send_calls, recv_calls). Call after stop()."""
+        send_calls = 0
+        recv_calls = 0
+        for sock in self._all_sockets:
+            send_calls += sock.send_calls
+            recv_calls += sock.recv_calls
+        return (send_calls, recv_calls)
+
+    def _start_query(self, q):
+        task = self._loop.create_task(self._query(q))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _query(self, q):
+        t = self._loop.time()
+        # the walker waits for a result for every query id, so one is
+        # queued no matter how the query ends
+        res = exception.QueryError()
+        try:
+            if self._tcp_only:
+                res = await self._tcp_query(q,
+                        query.query_wire(q.query_dn, q.rrtype))
+            else:
+                res = await self._udp_query(q)
+        except asyncio.CancelledError:
+            raise
+        except OSError as e:
+            log.debug2("failed to send query to ", str(q.ns), ": ", str(e))
+        except Exception as e:
+            log.debug2("query to ", str(q.ns), " failed: ", repr(e))
+        finally:
+            q.rtt = self._loop.time() - t
+            q.result_queue.put((q.id, res))
+
+    async def _create_socket(self, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(('0.0.0.0' if family == socket.AF_INET else '::', 0))
+        if self._use_mmsg:
+            return _MMsgDatagramSocket(self, self._loop, sock)
+        transport, protocol = await self._loop.create_datagram_endpoint(
+                lambda: _DatagramSocket(self), sock=sock)
+        return protocol
+
+    async def _socket(self, family):
+        if family not in self._sockets:
+            sockets = []
+            for i in range(self._num_sockets):
+                sockets.append(await self._create_socket(family))
+            self._all_sockets.extend(sockets)
+            # another query may have created the sockets in the meantime
+            if family not in self._sockets:
+                self._sockets[family] = sockets
+                self._socket_cycle[family] = itertools.cycle(sockets)
+            else:
+                for sock in sockets:
+                    sock.close()
+        return next(self._socket_cycle[family])
+
+    async def _udp_query(self, q):
+        family = socket.AF_INET if q.ns.ip.version == 4 else socket.AF_INET6
+        sock = await self._socket(family)
+        msgid = dns.entropy.random_16()
+        key = (sock, msgid, q.ns.ip, q.ns.port)
+        while key in self._pending:
+            msgid = dns.entropy.random_16()
+            key = (sock, msgid, q.ns.ip, q.ns.port)
+        request = query.query_wire(q.query_dn, q.rrtype, msgid)
+        future = self._loop.create_future()
+        self._pending[key] = (request, future)
+        try:
+            sock.sendto(request, (q.ns.ip_str(), q.ns.port))
+            response = await asyncio.wait_for(future, q.timeout)
+        except asyncio.TimeoutError:
+            return exception.TimeOutError()
+        finally:
+            del self._pending[key]
+
+        if response.truncated():
+            return await self._tcp_query(q, request)
+        return query.check_status(response)
+
+    async def _tcp_query(self, q, request):
+        pool = q.ns.tcp_pool
+        retry = True
+        while True:
+            try:
+                # may have to connect first, which blocks
+                future = await self._loop.run_in_executor(None, pool.submit,
+                        request, q.timeout)
+                response = await asyncio.wait_for(asyncio.wrap_future(future),
+                        q.timeout)
+            except (asyncio.TimeoutError, socket.timeout):
+                return exception.TimeOutError()
+            except ConnectionError:
+                # the server closed the connection before responding, send
+                # the query once more over a new connection
+                if not retry:
+                    return exception.QueryError()
+                retry = False
+                continue
+            except dns.exception.DNSException:
+                return exception.QueryError()
+            return query.check_status(response)
+
+    def _datagram_received(self, sock, data, addr):
+        if len(data) < 2:
+            return
+        try:
+            ip = ipaddress.ip_address(addr[0])
+        except ValueError:
+            return
+        key = (sock, int.from_bytes(data[:2], 'big'), ip, addr[1])
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        request, future = pending
+        if future.done() or not query.wire_is_response(request, data):
+            return
+        try:
+            response = WireResult(data)
+        except (dns.exception.DNSException, ValueError, IndexError):
+            # malformed responses are ignored like unexpected ones
+            return
+        future.set_result(response)
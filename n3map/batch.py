@@ -0,0 +1,182 @@
+import os
+import queue
+import re
+import threading
+
+from . import log
+from . import name
+from . import prehash
+from . import queryprovider
+from .exception import N3MapError, FileParseError
+from .statusline import format_statusline_batch
+
+_comment_pattern = re.compile(r'^\s*([;#].*)?$')
+
+
+def read_zone_list(filename):
+    """Reads the zones to map in batch mode
+
+    Each line holds a zone name, optionally followed by the nameservers to
+    query for it. Returns a list of (zone, nameservers) tuples, nameservers
+    is None if none were given. Zones listed more than once are only
+    mapped once."""
+    zones = []
+    seen = set()
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f, 1):
+                if _comment_pattern.match(line):
+                    continue
+                fields = line.split()
+                try:
+                    zone = name.fqdn_from_text(fields[0])
+                except N3MapError as e:
+                    raise FileParseError(filename, i, str(e))
+                key = str(zone).lower()
+                if key in seen:
+                    log.warn("{}:{:d}: zone {} is listed twice, ignoring it"
+                            .format(filename, i, str(zone)))
+                    continue
+                seen.add(key)
+                zones.append((zone, fields[1:] if len(fields) > 1 else None))
+    except (OSError, UnicodeError) as e:
+        raise N3MapError("unable to read zone list: \n", str(e))
+    return zones
+
+def zone_filename(zone):
+    """Returns the name of the output file of zone in batch mode"""
+    s = str(zone).rstrip('.') or 'root'
+    return s.replace(os.sep, '_') + '.zone'
+
+
+class BatchScheduler(object):
+    """Runs the walks of a batch using a fixed number of worker threads
+
+    The walks share:
+     - one pool of prehash processes, created when the first NSEC3 walk
+       needs it, see prehash.SharedPrehashPool
+     - one query engine for their parallel queries (-f, --speculate)
+     - the global rate limit (--limit-rate)
+     - a rate limit and TCP connections per nameserver address and port,
+       even if the nameserver is used for several zones
+     - the status line, which shows the progress of the batch and the
+       statistics of the running walks registered with track(), instead of
+       the status of a single walk
+    """
+    def __init__(self, num_jobs, query_interval=None, ns_query_interval=None,
+            adaptive_rate=False, engine=None, engine_threads=1,
+            use_mmsg=True, tcp_only=False, processes=1,
+            queue_element_size=256, use_openssl=True, use_simd=True):
+        self.num_jobs = num_jobs
+        self._lock = threading.Lock()
+        self.rate_limit = None
+        if query_interval is not None:
+            self.rate_limit = queryprovider.RateLimit(1.0/query_interval)
+        self._ns_query_interval = ns_query_interval
+        self._adaptive_rate = adaptive_rate
+        # (ip, port) -> (rate control, TCP pool)
+        self._ns_shared = {}
+        self.query_engine = None
+        if engine is not None:
+            self.query_engine = queryprovider.create_query_engine(engine,
+                    engine_threads, use_mmsg, tcp_only)
+        self._prehash_args = (processes, queue_element_size, use_openssl,
+                use_simd)
+        self._prehash_pool = None
+        # zone name -> statistics of the running walks. The status line is
+        # updated while logging, possibly with self._lock held, so it needs
+        # a lock of its own.
+        self._running = {}
+        self._status_lock = threading.Lock()
+
+    def track(self, zone, stats):
+        """Shows the statistics of the walk of zone in the status line
+        until it finishes"""
+        with self._status_lock:
+            self._running[str(zone)] = stats
+
+    def share_nameservers(self, ns_list):
+        """Makes the nameservers in ns_list use the rate control and TCP
+        connections of earlier nameservers with the same address and
+        port"""
+        with self._lock:
+            for ns in ns_list:
+                key = (ns.ip, ns.port)
+                if key not in self._ns_shared:
+                    self._ns_shared[key] = (queryprovider.create_rate_control(
+                        self._ns_query_interval, self._adaptive_rate),
+                        ns.tcp_pool)
+                ns.rate_control, ns.tcp_pool = self._ns_shared[key]
+
+    def prehash_job(self):
+        """Returns the ring buffers and the SharedPrehashJob for a new NSEC3
+        walk"""
+        with self._lock:
+            if self._prehash_pool is None:
+                self._prehash_pool = prehash.SharedPrehashPool(
+                        *self._prehash_args)
+            pool = self._prehash_pool
+        return pool.open_job()
+
+    def run(self, zones, map_zone):
+        """Calls map_zone(zone, nameservers) for all (zone, nameservers)
+        tuples in zones, up to num_jobs at the same time. Returns the list
+        of zones which failed."""
+        pending = queue.Queue()
+        for z in zones:
+            pending.put(z)
+        failed = []
+        done = [0]
+        def worker():
+            while True:
+                try:
+                    zone, ns_names = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    map_zone(zone, ns_names)
+                except (N3MapError, OSError) as e:
+                    log.error("failed to map ", str(zone), ": ", str(e))
+                    with self._status_lock:
+                        failed.append(zone)
+                except Exception as e:
+                    log.error("failed to map ", str(zone),
+                            ": unexpected error: ", repr(e))
+                    with self._status_lock:
+                        failed.append(zone)
+                finally:
+                    with self._status_lock:
+                        self._running.pop(str(zone), None)
+                        done[0] += 1
+        def status_generator():
+            with self._status_lock:
+                running = [(zone, stats.get('queries', 0))
+                        for zone, stats in self._running.items()]
+                return (len(zones), done[0], len(failed), running)
+        log.logger.set_status_generator(status_generator,
+                format_statusline_batch)
+        try:
+            threads = []
+            for i in range(min(self.num_jobs, len(zones))):
+                t = threading.Thread(target=worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                while t.is_alive():
+                    t.join(log.BUFFER_INTERVAL)
+                    log.update()
+        finally:
+            log.logger.set_status_generator(None, None)
+        return failed
+
+    def close(self):
+        if self.query_engine is not None:
+            self.query_engine.stop()
+            self.query_engine = None
+        if self._prehash_pool is not None:
+            self._prehash_pool.close()
+            self._prehash_pool = None
+        for rate_control, tcp_pool in self._ns_shared.values():
+            tcp_pool.close()
+        self._ns_shared = {}
@@ -0,0 +1,462 @@
+"""Binary NSEC3 chain files
+
+A compact alternative to the text output for NSEC3 zones which can be
+appended to during a walk and read using mmap(2). All integers are in
+network byte order:
+
+    offset 0        header (_HEADER), followed by the zone name in wire
+                    format and the salt
+    TABLE_OFFSET    table of the distinct type bit maps fields (RFC 5155,
+                    section 3.2.1) of the records, each preceded by its
+                    length (2 bytes), TABLE_SIZE bytes are reserved
+    RECORDS_OFFSET  fixed-width records (_RECORD): hashed owner name, next
+                    hashed owner name, offset of the type bit maps in the
+                    table, TTL and flags
+
+The number of records follows from the file size, so the file is
+consistent after each write. When a file written by n3map is closed, its
+records are sorted by hashed owner name, which makes lookups a binary
+search.
+"""
+import bisect
+import mmap
+import os
+import struct
+
+import dns.rdatatype
+
+from . import log
+from . import name
+from . import util
+from .exception import ChainFileError, N3MapError
+from .rrtypes import nsec3
+from .wireresult import TypeBitmap
+
+# file names with this extension are written as chain files
+EXTENSION = '.n3c'
+MAGIC = b'N3MAPCHN'
+VERSION = 1
+
+# magic, version, flags, hash algorithm, salt length, zone name length,
+# iterations, length of the type bit maps table, label counter
+_HEADER = struct.Struct('!8sHHBBBxHxxIQ')
+# hashed owner name, next hashed owner name, type bit maps offset, TTL,
+# flags
+_RECORD = struct.Struct('!20s20sIIB3x')
+RECORD_SIZE = _RECORD.size
+TABLE_OFFSET = 1024
+TABLE_SIZE = 65536
+RECORDS_OFFSET = TABLE_OFFSET + TABLE_SIZE
+# type bit maps offset of records whose bit maps did not fit into the table
+NO_BITMAP = 0xffffffff
+
+# header flags
+FLAG_PARAMETERS = 0x1
+FLAG_LABEL_COUNTER = 0x2
+FLAG_SORTED = 0x4
+
+
+def is_chain_file(filename):
+    """Returns True if filename exists and is a chain file"""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def types_to_bitmap(types):
+    """Encodes a list of rrtype mnemonics as type bit maps field"""
+    if isinstance(types, TypeBitmap):
+        return types.to_wire()
+    windows = {}
+    for t in types:
+        try:
+            value = dns.rdatatype.from_text(t)
+        except dns.rdatatype.UnknownRdatatype:
+            raise ChainFileError('unknown rrtype: ' + str(t))
+        bitmap = windows.setdefault(value >> 8, bytearray(32))
+        bitmap[(value & 0xff) >> 3] |= 0x80 >> (value & 0x7)
+    wire = bytearray()
+    for window in sorted(windows):
+        bitmap = windows[window].rstrip(b'\x00')
+        wire.append(window)
+        wire.append(len(bitmap))
+        wire += bitmap
+    return bytes(wire)
+
+
+class _Header(object):
+    def __init__(self):
+        self.flags = 0
+        self.algorithm = 0
+        self.iterations = 0
+        self.table_length = 0
+        self.label_counter = 0
+        self.zone = None
+        self.salt = b''
+
+    @classmethod
+    def from_bytes(cls, data, filename):
+        h = cls()
+        try:
+            (magic, version, h.flags, h.algorithm, salt_length, zone_length,
+                    h.iterations, h.table_length,
+                    h.label_counter) = _HEADER.unpack_from(data)
+        except struct.error:
+            raise ChainFileError(filename + ': truncated header')
+        if magic != MAGIC:
+            raise ChainFileError(filename + ': not a chain file')
+        if version != VERSION:
+            raise ChainFileError(filename +
+                    ': unsupported chain file version {0:d}'.format(version))
+        offset = _HEADER.size
+        if zone_length > 0:
+            try:
+                h.zone = name.domainname_from_wire(
+                        bytes(data[offset:offset+zone_length]))
+            except N3MapError:
+                raise ChainFileError(filename + ': invalid zone name')
+        offset += zone_length
+        h.salt = bytes(data[offset:offset+salt_length])
+        if h.table_length > TABLE_SIZE:
+            raise ChainFileError(filename + ': invalid header')
+        return h
+
+    def to_bytes(self):
+        zone = self.zone.to_wire() if self.zone is not None else b''
+        return _HEADER.pack(MAGIC, VERSION, self.flags, self.algorithm,
+                len(self.salt), len(zone), self.iterations,
+                self.table_length, self.label_counter) + zone + self.salt
+
+
+class _Owners(object):
+    """Sequence of the hashed owner names of ChainRecords, for bisect"""
+    def __init__(self, records):
+        self._records = records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, i):
+        return self._records._owner(i)
+
+
+class ChainRecords(object):
+    """The records of a chain file
+
+    Behaves like a read-only sequence of nsec3.NSEC3 objects, which are
+    created on demand. records[h] returns the record with hashed owner name
+    h and raises KeyError if there is none.
+    """
+    def __init__(self, header, table, buf, count):
+        self.zone = header.zone
+        self.salt = header.salt
+        self.iterations = header.iterations
+        self.algorithm = header.algorithm
+        self.sorted = bool(header.flags & FLAG_SORTED)
+        self._table = table
+        self._buf = buf
+        self._count = count
+        self._index = None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self.record(i)
+
+    def _owner(self, i):
+        offset = i*RECORD_SIZE
+        return bytes(self._buf[offset:offset+nsec3.SHA1_LENGTH])
+
+    def _types(self, offset):
+        if offset == NO_BITMAP or offset + 2 > len(self._table):
+            return []
+        length = (self._table[offset] << 8) | self._table[offset+1]
+        return TypeBitmap(bytes(self._table[offset+2:offset+2+length]))
+
+    def record(self, i):
+        """Returns the i-th record as nsec3.NSEC3 object"""
+        owner, next_owner, bitmap, ttl, flags = _RECORD.unpack_from(
+                self._buf, i*RECORD_SIZE)
+        owner_dn = name.DomainName(name.Label(
+            util.base32_ext_hex_encode(owner).lower()), *self.zone.labels)
+        return nsec3.NSEC3(owner_dn, ttl, 'IN', self.algorithm, flags,
+                self.iterations, self.salt, next_owner, self._types(bitmap))
+
+    def intervals(self):
+        """Returns the lists of hashed owner names and next hashed owner
+        names of all records, in file order"""
+        buf = self._buf
+        n = nsec3.SHA1_LENGTH
+        offsets = range(0, self._count*RECORD_SIZE, RECORD_SIZE)
+        keys = [bytes(buf[o:o+n]) for o in offsets]
+        ends = [bytes(buf[o+n:o+2*n]) for o in offsets]
+        return keys, ends
+
+    def find(self, nsec3_hash):
+        """Returns the index of the record with hashed owner name nsec3_hash
+        or None"""
+        if self.sorted:
+            lo = bisect.bisect_left(_Owners(self), nsec3_hash)
+            if lo < self._count and self._owner(lo) == nsec3_hash:
+                return lo
+            return None
+        if self._index is None:
+            keys = self.intervals()[0]
+            self._index = dict(zip(keys, range(len(keys))))
+        return self._index.get(nsec3_hash)
+
+    def __getitem__(self, nsec3_hash):
+        i = self.find(nsec3_hash)
+        if i is None:
+            raise KeyError(nsec3_hash)
+        return self.record(i)
+
+
+class ChainFile(object):
+    """Chain file opened for reading or writing
+
+    Offers the interface of rrfile.RRFile for NSEC3 records. Use
+    create_chain_file(), open_chain_file() or append_chain_file() to open
+    one.
+    """
+    def __init__(self, f, filename, header, writable):
+        self.f = f
+        self.filename = filename
+        self._header = header
+        self._writable = writable
+        self._mmap = None
+        self._existing = None
+        # type bit maps field -> offset in the table
+        self._bitmaps = {}
+        self._table = b''
+        self._table_full = False
+        self.label_counter = None
+        if header.flags & FLAG_LABEL_COUNTER:
+            self.label_counter = header.label_counter
+
+    @property
+    def zone(self):
+        return self._header.zone
+
+    def _read_table(self):
+        self.f.seek(TABLE_OFFSET)
+        table = self.f.read(self._header.table_length)
+        if len(table) != self._header.table_length:
+            raise ChainFileError(self.filename + ': truncated file')
+        return table
+
+    def _record_count(self):
+        size = os.fstat(self.f.fileno()).st_size
+        return max(0, size - RECORDS_OFFSET)//RECORD_SIZE
+
+    def records(self):
+        """Returns the records in the file as ChainRecords object. For a
+        file opened for reading, the records are memory-mapped, otherwise
+        they are read into memory."""
+        table = self._read_table()
+        count = self._record_count()
+        if not self._writable:
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self.f.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+            buf = memoryview(self._mmap)[RECORDS_OFFSET:
+                    RECORDS_OFFSET+count*RECORD_SIZE]
+            return ChainRecords(self._header, table, buf, count)
+        self.f.seek(RECORDS_OFFSET)
+        buf = self.f.read(count*RECORD_SIZE)
+        records = ChainRecords(self._header, table, buf, count)
+        if self._existing is None:
+            self._existing = records
+        return records
+
+    def nsec3_reader(self):
+        log.info("reading NSEC3 RRs from ", str(self.filename))
+        return iter(self.records())
+
+    def nsec_reader(self):
+        raise ChainFileError(self.filename +
+                ': chain files can only hold NSEC3 records')
+
+    def _write_header(self):
+        data = self._header.to_bytes()
+        os.pwrite(self.f.fileno(), data, 0)
+
+    def write_header(self, zone, title):
+        if self._header.zone is None:
+            self._header.zone = zone
+            self._write_header()
+        elif self._header.zone != zone:
+            raise ChainFileError(self.filename + ': chain file of zone ' +
+                    str(self._header.zone))
+
+    def _set_parameters(self, rr):
+        h = self._header
+        if not (h.flags & FLAG_PARAMETERS):
+            h.salt = rr.salt
+            h.iterations = rr.iterations
+            h.algorithm = rr.algorithm
+            h.flags |= FLAG_PARAMETERS
+            if h.zone is None:
+                h.zone = rr.zone
+            self._write_header()
+        elif (rr.salt != h.salt or rr.iterations != h.iterations or
+                rr.algorithm != h.algorithm):
+            raise ChainFileError(self.filename +
+                    ': NSEC3 parameters differ from the other records')
+
+    def _bitmap_offset(self, types):
+        bitmap = types_to_bitmap(types)
+        offset = self._bitmaps.get(bitmap)
+        if offset is not None:
+            return offset
+        h = self._header
+        if h.table_length + 2 + len(bitmap) > TABLE_SIZE:
+            if not self._table_full:
+                log.warn(self.filename, ': too many different type bit ',
+                        'maps, the types of some records are not saved')
+                self._table_full = True
+            return NO_BITMAP
+        offset = h.table_length
+        entry = struct.pack('!H', len(bitmap)) + bitmap
+        os.pwrite(self.f.fileno(), entry, TABLE_OFFSET + offset)
+        self._bitmaps[bitmap] = offset
+        h.table_length += len(entry)
+        self._write_header()
+        return offset
+
+    def write_record(self, rr):
+        if not isinstance(rr, nsec3.NSEC3):
+            raise ChainFileError(self.filename +
+                    ': chain files can only hold NSEC3 records')
+        self._set_parameters(rr)
+        if self._header.flags & FLAG_SORTED:
+            self._header.flags &= ~FLAG_SORTED
+            self._write_header()
+        self.f.write(_RECORD.pack(rr.hashed_owner, rr.next_hashed_owner,
+            self._bitmap_offset(rr.types), rr.ttl, rr.flags))
+
+    def write_chain(self, records):
+        # on resume, the records read from this file are already in it
+        if records is self._existing:
+            return
+        for rr in records:
+            self.write_record(rr)
+
+    def write_number_of_rrs(self, n):
+        pass
+
+    def write_label_counter(self, label_counter):
+        self.label_counter = label_counter
+        self._header.label_counter = label_counter
+        self._header.flags |= FLAG_LABEL_COUNTER
+        self._write_header()
+
+    def write_stats(self, stats):
+        pass
+
+    def fsync(self):
+        os.fsync(self.f.fileno())
+
+    def seek(self, offset):
+        pass
+
+    def into_backup(self):
+        pass
+
+    def unlink_backup(self):
+        pass
+
+    def _sort(self):
+        """Rewrites the file with its records sorted by hashed owner name.
+        The sorted file is written next to it and then replaces it."""
+        count = self._record_count()
+        self.f.seek(RECORDS_OFFSET)
+        data = self.f.read(count*RECORD_SIZE)
+        # the hashed owner names are unique and come first
+        records = [data[i:i+RECORD_SIZE]
+                for i in range(0, len(data), RECORD_SIZE)]
+        records.sort()
+        self._header.flags |= FLAG_SORTED
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self._header.to_bytes())
+            f.seek(TABLE_OFFSET)
+            f.write(self._read_table())
+            f.seek(RECORDS_OFFSET)
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self._writable:
+                self.f.flush()
+                if not (self._header.flags & FLAG_SORTED):
+                    self._sort()
+                else:
+                    self.fsync()
+        finally:
+            if self._mmap is not None:
+                try:
+                    self._mmap.close()
+                except BufferError:
+                    # a ChainRecords object still uses it, the mapping is
+                    # released along with that object
+                    pass
+                self._mmap = None
+            self.f.close()
+            self.f = None
+
+
+def create_chain_file(filename):
+    """Creates a new, empty chain file, replacing an existing file"""
+    f = open(filename, 'w+b')
+    try:
+        cf = ChainFile(f, filename, _Header(), True)
+        cf._write_header()
+        f.truncate(RECORDS_OFFSET)
+        f.seek(RECORDS_OFFSET)
+    except:
+        f.close()
+        raise
+    return cf
+
+def _open(filename, mode, writable):
+    f = open(filename, mode)
+    try:
+        header = _Header.from_bytes(f.read(TABLE_OFFSET), filename)
+        return ChainFile(f, filename, header, writable)
+    except:
+        f.close()
+        raise
+
+def open_chain_file(filename):
+    """Opens an existing chain file for reading"""
+    return _open(filename, 'rb', False)
+
+def append_chain_file(filename):
+    """Opens an existing chain file for appending records
+
+    A partially written record at the end of the file, e.g. from a walk
+    that was killed, is removed."""
+    cf = _open(filename, 'r+b', True)
+    try:
+        table = cf._read_table()
+        offset = 0
+        while offset + 2 <= len(table):
+            length = (table[offset] << 8) | table[offset+1]
+            cf._bitmaps[table[offset+2:offset+2+length]] = offset
+            offset += 2 + length
+        end = RECORDS_OFFSET + cf._record_count()*RECORD_SIZE
+        cf.f.truncate(end)
+        cf.f.seek(end)
+    except:
+        cf.f.close()
+        raise
+    return cf
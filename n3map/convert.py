@@ -0,0 +1,68 @@
+import sys
+import os
+import getopt
+
+from . import log
+from . import rrfile
+from .exception import N3MapError
+
+def usage(argv):
+    sys.stderr.write("usage: " + os.path.basename(argv[0]) +
+            " [-v] infile outfile\n")
+    sys.exit(2)
+
+def convert(infile, outfile):
+    """Copies the NSEC3 records in infile to outfile. The format of infile
+    is detected, outfile is written as chain file if its name ends in
+    chainfile.EXTENSION. Returns the number of records."""
+    if (os.path.exists(outfile) and
+            os.path.samefile(infile, outfile)):
+        raise N3MapError("input and output file are the same")
+    records_file = rrfile.open_input_rrfile(infile)
+    output_file = None
+    try:
+        records = records_file.nsec3_reader()
+        first = next(records, None)
+        if first is None:
+            raise N3MapError(infile, ": no NSEC3 records found")
+        output_file = rrfile.open_output_rrfile(outfile)
+        output_file.write_header(first.zone, "List of NSEC3 RRs")
+        output_file.write_record(first)
+        n = 1
+        for rr in records:
+            output_file.write_record(rr)
+            n += 1
+        output_file.write_number_of_rrs(n)
+        # the label counter of a text file is known after reading it
+        if records_file.label_counter is not None:
+            output_file.write_label_counter(records_file.label_counter)
+    finally:
+        records_file.close()
+        if output_file is not None:
+            output_file.close()
+    return n
+
+def convert_main(argv):
+    log.logger = log.Logger()
+    try:
+        try:
+            opts, args = getopt.gnu_getopt(argv[1:], "v")
+        except getopt.GetoptError:
+            usage(argv)
+        for opt, arg in opts:
+            if opt == '-v':
+                log.logger.loglevel += 1
+        if len(args) != 2:
+            usage(argv)
+        n = convert(args[0], args[1])
+        log.info("wrote {0:d} records to {1:s}".format(n, args[1]))
+    except (IOError, N3MapError) as e:
+        log.fatal(e)
+    return 0
+
+def main():
+    try:
+        sys.exit(convert_main(sys.argv))
+    except KeyboardInterrupt:
+        sys.stderr.write("\nreceived SIGINT, terminating\n")
+        sys.exit(3)
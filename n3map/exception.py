@@ -76,6 +76,9 @@ class MaxDomainNameLengthError(N3MapError):
 class ParseError(N3MapError):
     pass
 
+class ChainFileError(N3MapError):
+    pass
+
 class FileParseError(N3MapError):
     def __init__(self, filename, line, msg):
         super(FileParseError, self).__init__(filename, line, msg)
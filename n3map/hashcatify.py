@@ -21,15 +21,14 @@ def hashcatify_main(argv):
         else:
             out = sys.stdout
 
-        records_file = rrfile.open_input_rrfile(argv[1])
-
-        for nsec3 in records_file.nsec3_reader():
-            nsec3_hash = util.base32_ext_hex_encode(nsec3.hashed_owner).lower()
+        for hashed_owner, zone, salt, iterations in (
+                rrfile.nsec3_hashes_from_file(argv[1])):
+            nsec3_hash = util.base32_ext_hex_encode(hashed_owner).lower()
             nsec3_hash = nsec3_hash.decode()
-            zone = str(nsec3.zone)
+            zone = str(zone)
             zone = re.sub('\.$', '', zone)
-            iterations = "{0:d}".format(nsec3.iterations)
-            salt = nsec3.salt.hex()
+            iterations = "{0:d}".format(iterations)
+            salt = salt.hex()
             out.write(":".join((nsec3_hash, "." + zone, salt, iterations))
                     + "\n")
     except (IOError, N3MapError) as e:
@@ -20,13 +20,12 @@ def johnify_main(argv):
         else:
             out = sys.stdout
 
-        records_file = rrfile.open_input_rrfile(argv[1])
-
-        for nsec3 in records_file.nsec3_reader():
-            nsec3_hash = nsec3.hashed_owner.hex()
-            zone = str(nsec3.zone)
-            iterations = "{0:d}".format(nsec3.iterations)
-            salt = nsec3.salt.hex()
+        for hashed_owner, zone, salt, iterations in (
+                rrfile.nsec3_hashes_from_file(argv[1])):
+            nsec3_hash = hashed_owner.hex()
+            zone = str(zone)
+            iterations = "{0:d}".format(iterations)
+            salt = salt.hex()
             out.write("$NSEC3$" + "$".join((iterations, salt,
                 nsec3_hash, zone)) + "\n")
     except (IOError, N3MapError) as e:
@@ -5,6 +5,7 @@ import array
 import termios
 
 import signal
+import threading
 import time
 import collections
 
@@ -138,6 +139,8 @@ class ProgressLineLogger(Logger):
         self._current_status = None
         self._statuslines = None
         self._enabled = False
+        # the status line may be updated from several walker threads
+        self._lock = threading.RLock()
 
     def from_logger(logger):
         plogger = ProgressLineLogger(logger.loglevel, logger._file)
@@ -160,12 +163,16 @@ class ProgressLineLogger(Logger):
         self._flush_interval = 0
 
     def block_signals(self):
-        if not self._enabled:
+        # signal handlers can only be changed in the main thread, which is
+        # also the only one signals are delivered to
+        if (not self._enabled or
+                threading.current_thread() is not threading.main_thread()):
             return
         signal.signal(signal.SIGWINCH, signal.SIG_IGN)
 
     def unblock_signals(self):
-        if not self._enabled:
+        if (not self._enabled or
+                threading.current_thread() is not threading.main_thread()):
             return
         setup_signal_handling()
         # in case a signal would have arrived in the meantime
@@ -174,21 +181,27 @@ class ProgressLineLogger(Logger):
 
 
     def set_status_generator(self, generator, formatfunc):
-        self.flush()
-        self._generator, self._formatter = generator, formatfunc
-        if generator is not None:
-            self.enable()
-        else:
-            self.disable()
+        with self._lock:
+            self.flush()
+            self._generator, self._formatter = generator, formatfunc
+            if generator is not None:
+                self.enable()
+            else:
+                self.disable()
 
     def flush(self):
-        self._format_statuslines()
-        self._write_log(''.join(self._buffer))
-        self._buffer.clear()
-        self._file.flush()
-        self._last_flush = time.monotonic()
+        with self._lock:
+            self._format_statuslines()
+            self._write_log(''.join(self._buffer))
+            self._buffer.clear()
+            self._file.flush()
+            self._last_flush = time.monotonic()
 
     def do_log(self, level, *msg):
+        with self._lock:
+            self._do_log(level, *msg)
+
+    def _do_log(self, level, *msg):
         if level == LOG_FATAL:
             self.set_status_generator(None, None)
             msg = self._colorize_msg(level, *msg)
@@ -203,12 +216,14 @@ class ProgressLineLogger(Logger):
             self.update(force=(level <= LOG_WARN))
 
     def update(self, force=False):
-        if self._generator is not None:
-            gen = self._generator
-            self._current_status = gen()
-        if not force and time.monotonic() - self._last_flush < self._flush_interval:
-            return
-        self.flush()
+        with self._lock:
+            if self._generator is not None:
+                gen = self._generator
+                self._current_status = gen()
+            if (not force and
+                    time.monotonic() - self._last_flush < self._flush_interval):
+                return
+            self.flush()
 
     def _format_statuslines(self):
         if self._current_status is None or self._formatter is None:
@@ -6,6 +6,8 @@ import os
 import time
 from datetime import timedelta
 
+from . import batch
+from . import chainfile
 from . import log
 from . import prehash
 from . import queryprovider
@@ -14,7 +16,8 @@ from . import rrfile
 from .exception import N3MapError, FileParseError, HashLimitReached
 from .nsec3walker import NSEC3Walker
 from .predict import create_zone_predictor
-from .nsecwalker import NSECWalkerN, NSECWalkerMixed, NSECWalkerA
+from .nsecwalker import (NSECWalkerN, NSECWalkerMixed, NSECWalkerA,
+        NSECWalkerParallel)
 
 import n3map.name
 import n3map.walker
@@ -79,7 +82,7 @@ def get_nameservers(zone, ipproto='', ns_names=None):
         log.info("using nameserver: ", str(ns))
     return nslist
 
-def read_input_file(input_filename, cont, zone, zone_type):
+def read_input_file(input_filename, cont, zone, zone_type, processes=1):
     chain = None
     records_file = None
     label_counter = None
@@ -91,10 +94,20 @@ def read_input_file(input_filename, cont, zone, zone_type):
                     .format(input_filename))
             return (None, None)
         else:
-            log.fatal("unable to open input file: \n", str(e))
+            raise N3MapError("unable to open input file: \n", str(e))
     try:
         chain = []
-        if zone_type == 'nsec3':
+        if isinstance(records_file, chainfile.ChainFile):
+            chain, label_counter = read_chain_file(records_file, zone,
+                    zone_type)
+        elif (zone_type == 'nsec3' and processes > 1 and
+                rrfile.can_load_nsec3_records(input_filename)):
+            chain = rrfile.load_nsec3_records(input_filename, processes)
+            if len(chain) > 0 and chain.zone != zone:
+                raise N3MapError("not all read records are part of the "
+                        "specified zone")
+            label_counter = chain.label_counter
+        elif zone_type == 'nsec3':
             for rr in records_file.nsec3_reader():
                 check_part_of_zone(rr, zone)
                 chain.append(rr)
@@ -104,9 +117,9 @@ def read_input_file(input_filename, cont, zone, zone_type):
                 check_part_of_zone(rr, zone)
                 chain.append(rr)
     except IOError as e:
-        log.fatal("unable to read input file: \n", str(e))
+        raise N3MapError("unable to read input file: \n", str(e))
     except FileParseError as e:
-        log.fatal("unable to parse input file: \n", str(e))
+        raise N3MapError("unable to parse input file: \n", str(e))
     finally:
         if records_file is not None:
             records_file.close()
@@ -114,9 +127,160 @@ def read_input_file(input_filename, cont, zone, zone_type):
         try:
             records_file.into_backup()
         except OSError as e:
-            log.fatal("failed to create backup file: \n", str(e))
+            raise N3MapError("failed to create backup file: \n", str(e))
     return (chain, label_counter)
 
+def read_chain_file(chain_file, zone, zone_type):
+    """Returns the records of a chainfile.ChainFile without reading them
+    into memory, and its label counter"""
+    if zone_type != 'nsec3':
+        raise N3MapError(chain_file.filename,
+                ": chain files can only hold NSEC3 records")
+    if chain_file.zone is not None and chain_file.zone != zone:
+        raise N3MapError(chain_file.filename, ": records of zone ",
+                str(chain_file.zone), " found, expected ", str(zone))
+    return (chain_file.records(), chain_file.label_counter)
+
+def open_output_file(filename, zone_type):
+    if filename.endswith(chainfile.EXTENSION) and zone_type != 'nsec3':
+        raise N3MapError(filename, ": chain files can only hold NSEC3 records")
+    try:
+        return rrfile.open_output_rrfile(filename)
+    except IOError as e:
+        raise N3MapError("unable to open output file: ", str(e))
+
+def open_continue_file(filename, zone, zone_type, processes=1):
+    """Reads the records in filename and opens it for writing, see -c
+
+    Returns a tuple (chain, label_counter, output file). Chain files are
+    appended to in place, other files are kept as backup file until the
+    walk is finished and then rewritten. NSEC3 text files are read using
+    up to processes processes, see rrfile.load_nsec3_records()."""
+    if not chainfile.is_chain_file(filename):
+        chain, label_counter = read_input_file(filename, True, zone,
+                zone_type, processes)
+        return (chain, label_counter, open_output_file(filename, zone_type))
+    try:
+        chain_file = chainfile.append_chain_file(filename)
+    except IOError as e:
+        raise N3MapError("unable to open output file: ", str(e))
+    try:
+        chain, label_counter = read_chain_file(chain_file, zone, zone_type)
+    except IOError as e:
+        chain_file.close()
+        raise N3MapError("unable to read input file: \n", str(e))
+    except N3MapError:
+        chain_file.close()
+        raise
+    return (chain, label_counter, chain_file)
+
+def apply_ns_rate_limit(nslist, options):
+    if options['ns_query_interval'] is not None:
+        for ns in nslist:
+            ns.rate_control = queryprovider.create_rate_control(
+                    options['ns_query_interval'], options['adaptive_rate'])
+
+def create_query_provider(nslist, options, stats, rate_limit=None,
+        shared_engine=None):
+    return queryprovider.QueryProvider(nslist,
+            timeout=options['timeout'], max_retries=options['max_retries'],
+            max_errors=options['max_errors'],
+            query_interval = options['query_interval'], stats=stats,
+            ns_policy=options['ns_policy'],
+            adaptive_rate=options['adaptive_rate'],
+            hedge_percentile=options['hedge'],
+            tcp_only=options['tcp_only'],
+            rate_limit=rate_limit,
+            shared_engine=shared_engine)
+
+def create_walker(zone, qprovider, options, stats, chain, label_counter,
+        output_rrfile, hash_queues=None, prehash_pool=None, predictor=None):
+    if options['zone_type'] == 'nsec3':
+        if output_rrfile is not None:
+            output_rrfile.write_header(zone, "List of NSEC3 RRs")
+        if options['label_counter'] is not None:
+            label_counter = options['label_counter']
+        return NSEC3Walker(zone,
+                           qprovider,
+                           hash_queues,
+                           prehash_pool,
+                           nsec3_records=[] if chain is None else chain,
+                           ignore_overlapping=options['ignore_overlapping'],
+                           chain_index=options['chain_index'],
+                           label_counter=label_counter,
+                           output_file=output_rrfile,
+                           stats=stats,
+                           predictor=predictor,
+                           aggressive=options['aggressive'],
+                           query_engine=options['query_engine'],
+                           use_mmsg=options['use_mmsg'],
+                           hashlimit=options['hashlimit'],
+                           candidate_window=options['candidate_window']
+                           )
+
+    elif options['zone_type'] == 'nsec':
+        if output_rrfile is not None:
+            output_rrfile.write_header(zone, "List of NSEC RRs")
+
+        if options['query_mode'] == "mixed":
+            walker_class = NSECWalkerMixed
+        elif options['query_mode'] == "A":
+            walker_class = NSECWalkerA
+        else:
+            walker_class = NSECWalkerN
+        if walker_class is NSECWalkerN:
+            walker_args = {
+                    'speculate' : options['speculate'],
+                    'query_engine' : options['query_engine'],
+                    'use_mmsg' : options['use_mmsg'],
+                    }
+        else:
+            walker_args = {
+                    'ldh' : options['query_chars'] == 'ldh',
+                    'never_prefix_label' : options['no_prefix_labels'],
+                    }
+        if options['parallel'] > 1:
+            return NSECWalkerParallel(zone,
+                                      qprovider,
+                                      walker_class,
+                                      options['parallel'],
+                                      walker_args=walker_args,
+                                      nsec_chain=chain,
+                                      startname=options['start'],
+                                      endname=options['end'],
+                                      stats=stats,
+                                      output_file=output_rrfile)
+        return walker_class(zone,
+                            qprovider,
+                            nsec_chain=chain,
+                            startname=options['start'],
+                            endname=options['end'],
+                            stats=stats,
+                            output_file=output_rrfile,
+                            **walker_args)
+    return None
+
+def walk_zone(zone, walker):
+    starttime = time.monotonic()
+    stopped_prematurely = False
+    try:
+        walker.walk()
+    except HashLimitReached:
+        stopped_prematurely = True
+    elapsed = timedelta(seconds=time.monotonic() - starttime)
+    if stopped_prematurely:
+        log.info("stopped mapping of {0:s} after {1:s}: hashlimit reached"
+                 .format( str(zone), str(elapsed)))
+    else:
+        log.info("finished mapping of {0:s} in {1:s}"
+                 .format( str(zone), str(elapsed)))
+
+def check_zone(zone, qprovider, options):
+    if options['soa_check']:
+        n3map.walker.check_soa(zone, qprovider)
+
+    if options['dnskey_check']:
+        n3map.walker.check_dnskey(zone, qprovider)
 
 
 def n3map_main(argv):
@@ -126,12 +290,16 @@ def n3map_main(argv):
     except N3MapError as e:
         log.fatal_exit(2, e)
 
+    if options['batch'] is not None:
+        return n3map_batch(options, ns_names)
+
     output_rrfile = None
     chain = None
     label_counter = None
     walker = None
     process_pool = None
     hash_queues = None
+    predictor = None
     if options['progress']:
         log.logger = log.ProgressLineLogger.from_logger(log.logger)
 
@@ -140,18 +308,11 @@ def n3map_main(argv):
 
     try:
         nslist = get_nameservers(zone, options['ipproto'], ns_names)
+        apply_ns_rate_limit(nslist, options)
         stats = {}
         options['timeout'] /= 1000.0
-        qprovider = queryprovider.QueryProvider(nslist,
-                timeout=options['timeout'], max_retries=options['max_retries'],
-                max_errors=options['max_errors'],
-                query_interval = options['query_interval'], stats=stats)
-
-        if options['soa_check']:
-            n3map.walker.check_soa(zone, qprovider)
-
-        if options['dnskey_check']:
-            n3map.walker.check_dnskey(zone, qprovider)
+        qprovider = create_query_provider(nslist, options, stats)
+        check_zone(zone, qprovider, options)
 
         if options['zone_type'] == 'auto':
             options['zone_type'] = n3map.walker.detect_dnssec_type(zone,
@@ -163,103 +324,33 @@ def n3map_main(argv):
         if options['zone_type'] == 'nsec3':
             (hash_queues, process_pool) = prehash.create_prehash_pool(
                 options['processes'], options['queue_element_size'],
-                options['use_openssl'])
+                options['use_openssl'], options['use_simd'])
             if options['predict']:
                 proc,pipe = create_zone_predictor()
                 predictor = (proc,pipe)
-            else:
-                predictor = None
 
 
         if options['continue'] is not None:
-            chain, label_counter = read_input_file(options['continue'], True,
-                    zone, options['zone_type'])
-            try:
-                output_rrfile =  rrfile.open_output_rrfile(options['continue'])
-            except IOError as e:
-                log.fatal("unable to open output file: ", str(e))
+            chain, label_counter, output_rrfile = open_continue_file(
+                    options['continue'], zone, options['zone_type'],
+                    options['processes'])
         else:
             if options['input'] is not None:
                 chain, label_counter = read_input_file(options['input'], False,
-                        zone, options['zone_type'])
+                        zone, options['zone_type'], options['processes'])
             if options['output'] is not None:
                 if options['output'] == '-':
                     output_rrfile = rrfile.RRFileStream(sys.stdout)
                 else:
-                    try:
-                        output_rrfile =  rrfile.open_output_rrfile(
-                                options['output'])
-                    except IOError as e:
-                        log.fatal("unable to open output file: ", str(e))
-
-
+                    output_rrfile = open_output_file(options['output'],
+                            options['zone_type'])
 
-        if options['zone_type'] == 'nsec3':
-            if output_rrfile is not None:
-                output_rrfile.write_header(zone, "List of NSEC3 RRs")
-            if options['label_counter'] is not None:
-                label_counter = options['label_counter']
-            walker = NSEC3Walker(zone,
-                                 qprovider,
-                                 hash_queues,
-                                 process_pool,
-                                 nsec3_records=[] if chain is None else chain,
-                                 ignore_overlapping=options['ignore_overlapping'],
-                                 label_counter=label_counter,
-                                 output_file=output_rrfile,
-                                 stats=stats,
-                                 predictor=predictor,
-                                 aggressive=options['aggressive'],
-                                 hashlimit=options['hashlimit']
-                                 )
-
-        elif options['zone_type'] == 'nsec':
-            if output_rrfile is not None:
-                output_rrfile.write_header(zone, "List of NSEC RRs")
-
-            if options['query_mode'] == "mixed":
-                walker = NSECWalkerMixed(zone,
-                                         qprovider,
-                                         options['query_chars'] == 'ldh',
-                                         nsec_chain=chain,
-                                         startname=options['start'],
-                                         endname=options['end'],
-                                         stats=stats,
-                                         output_file=output_rrfile,
-                                         never_prefix_label=options['no_prefix_labels'])
-            elif options['query_mode'] == "A":
-                walker = NSECWalkerA(zone,
-                                     qprovider,
-                                     options['query_chars'] == 'ldh',
-                                     nsec_chain=chain,
-                                     startname=options['start'],
-                                     endname=options['end'],
-                                     stats=stats,
-                                     output_file=output_rrfile,
-                                     never_prefix_label=options['no_prefix_labels'])
-            else:
-                walker = NSECWalkerN(zone,
-                                     qprovider,
-                                     nsec_chain=chain,
-                                     startname=options['start'],
-                                     endname=options['end'],
-                                     stats=stats,
-                                     output_file=output_rrfile)
+        walker = create_walker(zone, qprovider, options, stats, chain,
+                label_counter, output_rrfile, hash_queues, process_pool,
+                predictor)
         finished = False
         if walker is not None:
-            starttime = time.monotonic()
-            stopped_prematurely = False
-            try:
-                walker.walk()
-            except HashLimitReached:
-                stopped_prematurely = True
-            elapsed = timedelta(seconds=time.monotonic() - starttime)
-            if stopped_prematurely:
-                log.info("stopped mapping of {0:s} after {1:s}: hashlimit reached"
-                         .format( str(zone), str(elapsed)))
-            else:
-                log.info("finished mapping of {0:s} in {1:s}"
-                         .format( str(zone), str(elapsed)))
+            walk_zone(zone, walker)
             finished = True
 
         if output_rrfile is not None:
@@ -274,6 +365,98 @@ def n3map_main(argv):
     finally:
         if output_rrfile is not None:
             output_rrfile.close()
+        if hash_queues is not None:
+            prehash.release_hash_rings(hash_queues)
+    return 0
+
+def n3map_batch(options, ns_names):
+    """Maps all zones listed in the file options['batch'], see
+    batch.BatchScheduler. Output files are continued like with -c."""
+    try:
+        zones = batch.read_zone_list(options['batch'])
+    except N3MapError as e:
+        log.fatal(e)
+    if options['progress']:
+        # the scheduler shows the progress of all walks in one status line
+        log.logger = log.ProgressLineLogger.from_logger(log.logger)
+
+    log.info("n3map {}: starting batch mapping of {:d} zones".format(
+        n3map.__version__, len(zones)))
+    options['timeout'] /= 1000.0
+    if options['aggressive'] > 0 or options['speculate'] > 0:
+        engine = options['query_engine']
+    else:
+        engine = None
+    scheduler = batch.BatchScheduler(options['jobs'],
+            query_interval=options['query_interval'],
+            ns_query_interval=options['ns_query_interval'],
+            adaptive_rate=options['adaptive_rate'],
+            engine=engine,
+            engine_threads=options['jobs']*max(options['aggressive'],
+                options['speculate'] + 1),
+            use_mmsg=options['use_mmsg'],
+            tcp_only=options['tcp_only'],
+            processes=options['processes'],
+            queue_element_size=options['queue_element_size'],
+            use_openssl=options['use_openssl'],
+            use_simd=options['use_simd'])
+    # the global rate limit is enforced by the scheduler
+    zone_options = dict(options, query_interval=None)
+
+    def map_zone(zone, zone_ns_names):
+        options = dict(zone_options)
+        output_rrfile = None
+        hash_queues = None
+        prehash_job = None
+        log.info("starting mapping of {}".format(str(zone)))
+        try:
+            nslist = get_nameservers(zone, options['ipproto'],
+                    zone_ns_names if zone_ns_names is not None else ns_names)
+            scheduler.share_nameservers(nslist)
+            stats = {}
+            qprovider = create_query_provider(nslist, options, stats,
+                    scheduler.rate_limit, scheduler.query_engine)
+            scheduler.track(zone, stats)
+            check_zone(zone, qprovider, options)
+            if options['zone_type'] == 'auto':
+                options['zone_type'] = n3map.walker.detect_dnssec_type(zone,
+                        qprovider, options['detection_attempts'])
+                if options['detect_only']:
+                    print("{}: {}".format(str(zone), options['zone_type']))
+                    return
+            if options['zone_type'] == 'nsec3':
+                hash_queues, prehash_job = scheduler.prehash_job()
+            chain = None
+            label_counter = None
+            if options['output_dir'] is not None:
+                filename = os.path.join(options['output_dir'],
+                        batch.zone_filename(zone))
+                chain, label_counter, output_rrfile = open_continue_file(
+                        filename, zone, options['zone_type'])
+            walker = create_walker(zone, qprovider, options, stats, chain,
+                    label_counter, output_rrfile, hash_queues, prehash_job)
+            walker.show_status = False
+            walk_zone(zone, walker)
+            if output_rrfile is not None:
+                output_rrfile.write_stats(stats)
+                output_rrfile.unlink_backup()
+        finally:
+            if output_rrfile is not None:
+                output_rrfile.close()
+            if prehash_job is not None:
+                prehash_job.stop()
+            if hash_queues is not None:
+                prehash.release_hash_rings(hash_queues)
+
+    try:
+        failed = scheduler.run(zones, map_zone)
+    finally:
+        scheduler.close()
+    if len(failed) > 0:
+        log.error("failed to map {:d} of {:d} zones".format(len(failed),
+            len(zones)))
+        return 1
+    log.info("finished mapping of {:d} zones".format(len(zones)))
     return 0
 
 def default_options():
@@ -283,18 +466,31 @@ def default_options():
             'input' : None,
             'continue' : None,
             'aggressive' : 0,
+            'query_engine' : 'asyncio',
+            'use_mmsg' : True,
             'ignore_overlapping' : False,
             'query_mode' : 'mixed',
             'query_chars' : 'binary',
             'start' : None,
             'end' : None,
             'no_prefix_labels' : False,
+            'parallel' : 1,
+            'speculate' : 0,
+            'batch' : None,
+            'output_dir' : None,
+            'jobs' : 8,
             'label_counter' : None,
             'hashlimit' : 0,
+            'candidate_window' : 0,
             'timeout' : 2500,
             'max_retries' : 5,
             'max_errors' : 1,
             'query_interval' : None,
+            'ns_query_interval' : None,
+            'ns_policy' : 'round-robin',
+            'adaptive_rate' : False,
+            'hedge' : None,
+            'tcp_only' : False,
             'detection_attempts' : 5,
             'soa_check' : True,
             'dnskey_check' : True,
@@ -303,6 +499,8 @@ def default_options():
             'progress' : True,
             'queue_element_size' : 256,
             'use_openssl' : True,
+            'use_simd' : True,
+            'chain_index' : 'array',
             'ipproto' : '',
             'detect_only' : False,
             }
@@ -314,6 +512,8 @@ def invalid_argument(opt, arg):
 def parse_arguments(argv):
     long_opts = [
             'aggressive=',
+            'query-engine=',
+            'no-mmsg',
             'auto',
             'binary',
             'continue=',
@@ -323,8 +523,14 @@ def parse_arguments(argv):
             'input=',
             'label-counter=',
             'hashlimit=',
+            'candidate-window=',
             'ldh',
             'limit-rate=',
+            'ns-limit-rate=',
+            'ns-policy=',
+            'adaptive-rate',
+            'hedge=',
+            'tcp-only',
             'max-retries=',
             'max-errors=',
             'mixed',
@@ -341,8 +547,15 @@ def parse_arguments(argv):
             'quiet',
             'start=',
             'no-prefix-labels',
+            'parallel=',
+            'speculate=',
+            'batch=',
+            'output-dir=',
+            'jobs=',
             'timeout=',
             'no-openssl',
+            'no-simd',
+            'chain-index=',
             'verbose',
             'color=',
             'version',
@@ -394,7 +607,8 @@ def parse_arguments(argv):
                 options['label_counter'] = int(arg, 0)
             except ValueError:
                 invalid_argument(opt, arg)
-            if options['label_counter']  < 0:
+            if (options['label_counter']  < 0 or
+                    options['label_counter'] > prehash.MAX_LABEL_COUNTER):
                 invalid_argument(opt, arg)
 
         elif opt in ('--hashlimit',):
@@ -403,9 +617,22 @@ def parse_arguments(argv):
             except ValueError:
                 invalid_argument(opt, arg)
 
+        elif opt in ('--candidate-window',):
+            try:
+                options['candidate_window'] = int(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if options['candidate_window'] < 0:
+                invalid_argument(opt, arg)
+
         elif opt in ('--ignore-overlapping',):
             options['ignore_overlapping'] = True
 
+        elif opt in ('--chain-index',):
+            if arg not in ('array', 'tree'):
+                invalid_argument(opt, arg)
+            options['chain_index'] = arg
+
         elif opt in ('-m', '--query-mode'):
             if arg not in ('mixed', 'NSEC', 'A'):
                 invalid_argument(opt, arg)
@@ -429,6 +656,36 @@ def parse_arguments(argv):
         elif opt in ('--no-prefix-labels',):
             options['no_prefix_labels'] = True
 
+        elif opt in ('--parallel',):
+            try:
+                options['parallel'] = int(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if options['parallel'] < 1:
+                invalid_argument(opt, arg)
+
+        elif opt in ('--speculate',):
+            try:
+                options['speculate'] = int(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if options['speculate'] < 0:
+                invalid_argument(opt, arg)
+
+        elif opt in ('--batch',):
+            options['batch'] = arg
+
+        elif opt in ('--output-dir',):
+            options['output_dir'] = arg
+
+        elif opt in ('--jobs',):
+            try:
+                options['jobs'] = int(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if options['jobs'] < 1:
+                invalid_argument(opt, arg)
+
         elif opt in ('-e', '--end'):
             options['end'] = arg
 
@@ -438,6 +695,31 @@ def parse_arguments(argv):
             except ValueError:
                 invalid_argument(opt, arg)
 
+        elif opt in ('--ns-limit-rate',):
+            try:
+                options['ns_query_interval'] = _query_interval(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+
+        elif opt in ('--ns-policy',):
+            if arg not in queryprovider.NS_POLICIES:
+                invalid_argument(opt, arg)
+            options['ns_policy'] = arg
+
+        elif opt in ('--adaptive-rate',):
+            options['adaptive_rate'] = True
+
+        elif opt in ('--tcp-only',):
+            options['tcp_only'] = True
+
+        elif opt in ('--hedge',):
+            try:
+                options['hedge'] = float(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if not 0 < options['hedge'] <= 100:
+                invalid_argument(opt, arg)
+
         elif opt in ('--max-retries',):
             try:
                 options['max_retries'] = int(arg)
@@ -477,6 +759,14 @@ def parse_arguments(argv):
             if options['aggressive'] < 1:
                 invalid_argument(opt, arg)
 
+        elif opt in ('--query-engine',):
+            if arg not in ('asyncio', 'threads'):
+                invalid_argument(opt, arg)
+            options['query_engine'] = arg
+
+        elif opt in ('--no-mmsg',):
+            options['use_mmsg'] = False
+
         elif opt in ('-p', '--predict',):
             options['predict'] = True
 
@@ -514,6 +804,9 @@ def parse_arguments(argv):
         elif opt in ('--no-openssl',):
             options['use_openssl'] = False
 
+        elif opt in ('--no-simd',):
+            options['use_simd'] = False
+
         elif opt in ('-v', '--verbose'):
             log.logger.loglevel += 1
 
@@ -530,7 +823,18 @@ def parse_arguments(argv):
         else:
             invalid_argument(opt, "")
 
-    if len(args) < 1:
+    if options['batch'] is not None:
+        # all arguments are nameservers
+        zone = None
+        ns_names = args if len(args) > 0 else None
+        if (options['output'] is not None or options['input'] is not None or
+                options['continue'] is not None or options['predict'] or
+                options['label_counter'] is not None):
+            log.fatal_exit(2, 'Invalid arguments: --batch cannot be ',
+                    'combined with -o, -i, -c, -p or --label-counter')
+    elif options['output_dir'] is not None:
+        log.fatal_exit(2, 'Invalid arguments: --output-dir requires --batch')
+    elif len(args) < 1:
         log.fatal_exit(2, 'missing arguments', "\n", "Try `",
                 str(os.path.basename(argv[0])),
                 " --help' for more information.")
@@ -545,6 +849,11 @@ def parse_arguments(argv):
             options['output'] is not None):
         log.fatal_exit(2, 'Invalid arguments: use -c xor (-i or -o)')
 
+    if options['speculate'] > 0 and (options['query_mode'] != 'NSEC' or
+            options['parallel'] > 1):
+        log.fatal_exit(2, 'Invalid arguments: --speculate requires ',
+                '--query-mode=NSEC and cannot be combined with --parallel')
+
     return (options, ns_names, zone)
 
 def version():
@@ -554,7 +863,9 @@ def version():
 def usage(program_name):
     def_opts = default_options()
     sys.stdout.write(
-            'Usage: {0:s} [option]... [-o file] [nameserver[:port]]... zone'
+            'Usage: {0:s} [option]... [-o file] [nameserver[:port]]... zone\n'
+            '       {0:s} [option]... --batch=FILE [--output-dir=DIR] '
+            '[nameserver[:port]]...'
             .format(program_name))
     sys.stdout.write(
 '''
@@ -572,13 +883,26 @@ Enumeration:
   -a, --auto                 autodetect enumeration method (default)
   -3, --nsec3                use NSEC3 enumeration
   -n, --nsec                 use NSEC enumeration
-  -o, --output=FILE          write all records to FILE (use '-' for stdout)
+  -o, --output=FILE          write all records to FILE (use '-' for stdout).
+                               NSEC3 records are written to a binary chain
+                               file if FILE ends in '.n3c'.
   -i, --input=FILE           read records from FILE and continue
                                the enumeration.
   -c, --continue=FILE        same as -i FILE -o FILE, but will preserve FILE as
                                a backup file until the enumeration is finished.
                                Will create FILE if it does not exist yet.
 
+Batch Options:
+      --batch=FILE           map all zones listed in FILE, one per line,
+                               optionally followed by the nameservers to
+                               query for the zone. The walks share the
+                               pre-hashing processes, the query engine and
+                               the rate limits.
+      --output-dir=DIR       write the records of each zone to DIR/ZONE.zone.
+                               Existing files are continued like with -c.
+      --jobs=N               map up to N zones at the same time
+                               (default {jobs:d})
+
 NSEC Options:
   -m, --query-mode=MODE      sets the query mode. Possible values are
                                'mixed', 'A', and 'NSEC' (default {qmode:s})
@@ -598,6 +922,14 @@ NSEC Options:
                                many zones, but is useful to avoid descending
                                into subzones when querying non-authoritative
                                namservers or to speed up the enumeration of TLDs.
+      --parallel=N           split the namespace into ranges and walk them
+                               using N concurrent walkers. The partial chains
+                               are joined where the ranges meet. Multiplies
+                               the load on the nameservers by up to N.
+      --speculate=N          while waiting for the next record, send up to N
+                               NSEC queries for names guessed to lie further
+                               ahead in the chain. Applies to 'NSEC' query
+                               mode.
 
 NSEC3 Options:
   -f, --aggressive=N         send up to N queries in parallel. This may speed
@@ -607,6 +939,12 @@ NSEC3 Options:
                                because it cannot completely avoid queries which
                                resolve to the same NSEC3 records.
                                Use with caution.
+      --query-engine=ENGINE  how parallel queries (-f) are sent. 'asyncio'
+                               multiplexes all queries over a few UDP sockets,
+                               'threads' uses one thread per parallel query
+                               (default {query_engine:s})
+      --no-mmsg              do not batch UDP datagrams using sendmmsg/recvmmsg
+                               (asyncio query engine on Linux only)
       --ignore-overlapping   ignore overlapping NSEC3 records. Useful when
                                enumerating large zones that may change during
                                enumeration.
@@ -617,9 +955,15 @@ NSEC3 Options:
       --processes=N          defines the number of pre-hashing processes.
                                Default is 1 or the number of CPUs - 1 on
                                multiprocessor systems ({processes:d} on this system)
+                               Also used to read NSEC3 input files (-i, -c)
+                               in parallel.
       --hashlimit=N[K|M|G|T]
                              stop the enumeration after checking N hashes, even
                                if it is not finished. Default = 0 (unlimited).
+      --candidate-window=N   choose the next name to query among N uncovered
+                               hashes, preferring those in the largest gaps
+                               of the NSEC3 chain. Default = 0 (query hashes
+                               in the order they are computed)
 
 Advanced NSEC3 Options:
   Use with caution.
@@ -627,11 +971,38 @@ Advanced NSEC3 Options:
       --queue-element-size=N set the queue elment size. (default {queue_element_sz:d})
       --no-openssl           do not use OpenSSL for hashing (slower, especially
                               at high iteration counts)
+      --no-simd              do not use SIMD instructions to compute the NSEC3
+                              iterations of several names in parallel
+      --chain-index=TYPE     data structure used to look up received NSEC3
+                              records. Possible values are 'array' and 'tree'
+                              (default {chain_index:s})
 
 General Options:
   -q, --quiet                do not display progress information during enumeration
       --limit-rate=N{{/s|/m|/h}}
-                             limit the query rate (default = unlimited)
+                             limit the query rate (default = unlimited). In
+                               batch mode, this limits the total query rate
+                               of all zones.
+      --ns-limit-rate=N{{/s|/m|/h}}
+                             limit the query rate to each nameserver. In batch
+                               mode, this applies to each nameserver address
+                               and port across all zones. With
+                               --adaptive-rate, this is the maximum rate.
+      --adaptive-rate        adapt the query rate of each nameserver: increase
+                               it while responses arrive in time, halve it on
+                               timeouts or REFUSED/SERVFAIL responses.
+                               --limit-rate sets the maximum rate.
+      --hedge=P              if a server did not respond within the P-th
+                               percentile of its recent round-trip times, send
+                               the query to another server as well and use
+                               the first response. Has no effect with a
+                               single server. Not used with -f.
+      --tcp-only             send all queries over TCP. Useful if most UDP
+                               responses are truncated.
+      --ns-policy=POLICY     how nameservers are selected for each query.
+                               'round-robin', 'latency' (prefer servers with
+                               a low round-trip time and loss rate) or
+                               'least-outstanding' (default {ns_policy:s})
       --max-retries=N        limit the maximum number of retries when a DNS query
                                times out. Defaults to {max_retries:d}.
                                N=-1 means no limit.
@@ -654,6 +1025,10 @@ General Options:
       -6                     Use IPv6 only.
 '''.format(qmode=def_opts['query_mode'], processes=def_opts['processes'],
         queue_element_sz=def_opts['queue_element_size'],
+        chain_index=def_opts['chain_index'],
+        jobs=def_opts['jobs'],
+        query_engine=def_opts['query_engine'],
+        ns_policy=def_opts['ns_policy'],
         timeout=def_opts['timeout'], max_retries=def_opts['max_retries'],
         max_errors=def_opts['max_errors'],
         detection_attempts=def_opts['detection_attempts'])
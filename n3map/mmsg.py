@@ -0,0 +1,169 @@
+"""Batched UDP I/O using sendmmsg(2) and recvmmsg(2)
+
+Linux only, the system calls are accessed using ctypes. HAS_MMSG is False
+if they are not available.
+"""
+import ctypes
+import errno
+import os
+import socket
+import struct
+import sys
+
+HAS_MMSG = False
+try:
+    if sys.platform.startswith('linux'):
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _sendmmsg = _libc.sendmmsg
+        _recvmmsg = _libc.recvmmsg
+        HAS_MMSG = True
+except (OSError, AttributeError):
+    pass
+
+MSG_DONTWAIT = 0x40
+# sizeof(struct sockaddr_storage)
+_SOCKADDR_SIZE = 128
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+if HAS_MMSG:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+
+def _sockaddr(family, addr):
+    if family == socket.AF_INET:
+        return (struct.pack('=H', family) + struct.pack('!H', addr[1]) +
+                socket.inet_pton(family, addr[0]) + bytes(8))
+    return (struct.pack('=H', family) + struct.pack('!HI', addr[1], 0) +
+            socket.inet_pton(family, addr[0]) + struct.pack('=I', 0))
+
+def _sockaddr_to_addr(family, raw):
+    port, = struct.unpack('!H', raw[2:4])
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(family, raw[4:8]), port)
+    return (socket.inet_ntop(family, raw[8:24]), port)
+
+
+class MMsgSocket(object):
+    """Non-blocking UDP socket which sends and receives up to batch_size
+    datagrams per system call.
+
+    Attributes send_calls and recv_calls count the system calls made.
+    """
+    def __init__(self, sock, batch_size=32, bufsize=65535):
+        self.sock = sock
+        self.family = sock.family
+        self.batch_size = batch_size
+        self.send_calls = 0
+        self.recv_calls = 0
+        self._addr_cache = {}
+
+        n = batch_size
+        self._send_hdrs = (_mmsghdr * n)()
+        self._send_iovs = (_iovec * n)()
+        for i in range(n):
+            hdr = self._send_hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._send_iovs[i])
+            hdr.msg_iovlen = 1
+
+        self._recv_hdrs = (_mmsghdr * n)()
+        self._recv_iovs = (_iovec * n)()
+        self._recv_bufs = ctypes.create_string_buffer(n * bufsize)
+        self._recv_names = ctypes.create_string_buffer(n * _SOCKADDR_SIZE)
+        self._bufsize = bufsize
+        self._recv_base = ctypes.addressof(self._recv_bufs)
+        self._names_base = ctypes.addressof(self._recv_names)
+        for i in range(n):
+            self._recv_iovs[i].iov_base = self._recv_base + i * bufsize
+            self._recv_iovs[i].iov_len = bufsize
+            hdr = self._recv_hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._recv_iovs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_name = self._names_base + i * _SOCKADDR_SIZE
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _raw_addr(self, addr):
+        raw = self._addr_cache.get(addr)
+        if raw is None:
+            raw = ctypes.create_string_buffer(_sockaddr(self.family, addr))
+            self._addr_cache[addr] = raw
+        return raw
+
+    def sendmmsg(self, datagrams):
+        """Sends the (data, addr) tuples in datagrams
+
+        Returns the number of datagrams sent, which may be less than
+        len(datagrams) (at most batch_size, 0 if the call would block).
+        Raises OSError on other errors, the first datagram could not be
+        sent in this case.
+        """
+        n = min(len(datagrams), self.batch_size)
+        if n == 0:
+            return 0
+        # the data is not copied, datagrams keeps the bytes objects alive
+        # until the call returns
+        for i in range(n):
+            data, addr = datagrams[i]
+            raw = self._raw_addr(addr)
+            self._send_iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(data),
+                    ctypes.c_void_p).value
+            self._send_iovs[i].iov_len = len(data)
+            hdr = self._send_hdrs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(raw)
+            hdr.msg_namelen = len(raw) - 1
+        self.send_calls += 1
+        ret = _sendmmsg(self.sock.fileno(), self._send_hdrs, n, MSG_DONTWAIT)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, os.strerror(err))
+        return ret
+
+    def recvmmsg(self):
+        """Returns a list of up to batch_size received (data, addr) tuples,
+        empty if no datagram is waiting."""
+        for i in range(self.batch_size):
+            self._recv_hdrs[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+        self.recv_calls += 1
+        ret = _recvmmsg(self.sock.fileno(), self._recv_hdrs, self.batch_size,
+                MSG_DONTWAIT, None)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        res = []
+        for i in range(ret):
+            data = ctypes.string_at(self._recv_base + i * self._bufsize,
+                    self._recv_hdrs[i].msg_len)
+            raw = ctypes.string_at(self._names_base + i * _SOCKADDR_SIZE,
+                    _SOCKADDR_SIZE)
+            res.append((data, _sockaddr_to_addr(self.family, raw)))
+        return res
+
+    def close(self):
+        self.sock.close()
@@ -2,11 +2,18 @@ from . import log
 from . import util
 from .exception import ZoneChangedError
 from .tree.nsec3tree import NSEC3Tree, OverLapError
+from .tree.nsec3array import NSEC3Array
 from .rrtypes.nsec3 import SHA1_MAX
 
+INDEX_TYPES = {
+        'array' : NSEC3Array,
+        'tree' : NSEC3Tree,
+    }
+
 class NSEC3Chain(object):
-    def __init__(self, iterable=None, ignore_overlapping=False):
-        self.tree = NSEC3Tree(hash_max=SHA1_MAX)
+    def __init__(self, iterable=None, ignore_overlapping=False,
+            index='array'):
+        self.tree = INDEX_TYPES[index](hash_max=SHA1_MAX)
         self.salt = None
         self.iterations = None
         self.zone = None
@@ -63,6 +70,28 @@ class NSEC3Chain(object):
                     "another NSEC3 record")
         return (not was_updated)
 
+    def load(self, zone, salt, iterations, keys, ends, is_sorted=False):
+        """Inserts the intervals given by the lists of hashed owner names
+        keys and next hashed owner names ends into an empty chain
+
+        Much faster than inserting the records one by one, e.g. for the
+        records of a chain file (see chainfile.ChainRecords.intervals()).
+        If is_sorted is False, the intervals are sorted first and of several
+        intervals with the same hashed owner name, the last one is used.
+        """
+        self.zone = zone
+        self.salt = salt
+        self.iterations = iterations
+        if not is_sorted:
+            intervals = dict(zip(keys, ends))
+            keys = sorted(intervals)
+            ends = [intervals[k] for k in keys]
+        try:
+            self.tree.load(keys, ends)
+        except OverLapError:
+            raise ZoneChangedError("NSEC3 record overlaps with " +
+                    "another NSEC3 record")
+
     def find_hash(self, h):
         n = self.tree.find(h)
         if n is None:
@@ -73,6 +102,44 @@ class NSEC3Chain(object):
     def covers(self, nsec3_hash):
         return (self.tree.find_interval(nsec3_hash) is not None)
 
+    def first_uncovered(self, digests, start=0):
+        """Returns the index of the first hash in digests, beginning at index
+        start, that is not covered by the chain, or None if all are covered.
+
+        digests are concatenated 20 byte hashes.
+        """
+        return self.tree.first_uncovered(digests, start)
+
+    def uncovered_gap(self, nsec3_hash):
+        """Returns the uncovered interval containing nsec3_hash as a tuple
+        (start, end) of exclusive bounds, or None if nsec3_hash is covered.
+        start is the next hashed owner name of the preceding record, end
+        the hashed owner name of the following one."""
+        return self.tree.uncovered_gap(nsec3_hash)
+
+    def gap_size(self, gap):
+        """Returns the number of hashes within gap, see uncovered_gap()"""
+        start, end = gap
+        return ((int.from_bytes(end, "big") - int.from_bytes(start, "big"))
+                % self.tree.hash_max)
+
+    def expected_records(self, gap):
+        """Returns the expected number of records within gap, assuming the
+        records received so far are evenly spread over the hash space"""
+        covered = self.tree.covered_distance
+        if covered == 0:
+            return float('inf')
+        return self.gap_size(gap) * self.size() / covered
+
+    def covered_intervals(self):
+        """Returns the covered intervals as a tuple (starts, ends)
+
+        starts and ends are the concatenated 20 byte interval boundaries
+        (inclusive), sorted by start. The interval of the last record, which
+        wraps around, is split in two.
+        """
+        return self.tree.covered_intervals()
+
     def covers_zone(self):
         return (self.tree.hash_max <= self.tree.covered_distance)
 
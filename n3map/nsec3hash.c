@@ -2,22 +2,104 @@
 #include <Python.h>
 #include <openssl/evp.h>
 
+#include "sha1mb.h"
+
 struct hash_ctx {
 	int iterations;
 	Py_ssize_t salt_length;
 	const unsigned char *salt;
 };
 
+/* see RFC1035, section 2.3.4 "Size limits" */
+#define MAX_DOMAINNAME 255
+#define SHA1_LENGTH 20
+/* a hex label of a 64 bit counter has at most 16 characters */
+#define MAX_HEX_LABEL 16
+/* the label is right-aligned in front of the zone */
+#define LABEL_END (1 + MAX_HEX_LABEL)
+/* maximum number of lanes of the multi-buffer SHA-1 implementations */
+#define MAX_LANES 16
+
+/*
+ * Wire format buffer for the names <hex(counter)>.<zone>
+ *
+ * The zone is copied only once, directly behind the label. The label is
+ * right-aligned so that it can grow towards the front without moving the
+ * zone.
+ */
+struct label_buf {
+	unsigned char buf[LABEL_END + MAX_DOMAINNAME];
+	int lbl_length;
+	Py_ssize_t zone_length;
+};
+
 int compute_hash(const unsigned char *dn, unsigned int dn_length,
 		struct hash_ctx *ctx, unsigned char *result,
 		unsigned int *presult_len);
+static int compute_hash_md(EVP_MD_CTX *mdctx, const unsigned char *dn,
+		unsigned int dn_length, struct hash_ctx *ctx,
+		unsigned char *result, unsigned int *presult_len);
+static int compute_first_iteration(EVP_MD_CTX *mdctx,
+		const unsigned char *dn, unsigned int dn_length,
+		struct hash_ctx *ctx, unsigned char *result,
+		unsigned int *presult_len);
+static int compute_iterations(EVP_MD_CTX *mdctx, struct hash_ctx *ctx,
+		const struct sha1mb_msg *msg, unsigned char *digests,
+		Py_ssize_t count);
+static int compute_hash_range(const unsigned char *zone,
+		Py_ssize_t zone_length, struct hash_ctx *ctx,
+		unsigned long long counter, Py_ssize_t count,
+		unsigned char *result);
+static int intervals_cover(const unsigned char *starts,
+		const unsigned char *ends, Py_ssize_t n,
+		const unsigned char *digest);
 
 PyMODINIT_FUNC PyInit_nsec3hash(void);
 static PyObject *py_compute_hash(PyObject *self, PyObject *args);
+static PyObject *py_compute_hashes(PyObject *self, PyObject *args);
+static PyObject *py_simd_backend(PyObject *self, PyObject *args);
+static PyObject *py_simd_backends(PyObject *self, PyObject *args);
+static PyObject *py_set_simd_backend(PyObject *self, PyObject *args);
+static PyObject *py_filter_uncovered(PyObject *self, PyObject *args);
+static PyObject *py_first_uncovered(PyObject *self, PyObject *args);
+static PyObject *py_memory_fence(PyObject *self, PyObject *args);
 
 static PyMethodDef nsec3_methods[] = {
 	{"compute_hash", py_compute_hash, METH_VARARGS,
 		"compute an NSEC3 hash"},
+	{"compute_hashes", py_compute_hashes, METH_VARARGS,
+		"compute_hashes(zone, salt, iterations, counter, count)\n\n"
+		"compute the NSEC3 hashes of the names <hex(c)>.<zone> for all\n"
+		"label counters c in [counter, counter + count).\n"
+		"zone must be in wire format. Returns the concatenated\n"
+		"20 byte digests."},
+	{"simd_backend", py_simd_backend, METH_NOARGS,
+		"return the name of the multi-buffer SHA-1 implementation used\n"
+		"for the iterations of compute_hashes() and HashGenerator,\n"
+		"or None if OpenSSL is used for all iterations"},
+	{"simd_backends", py_simd_backends, METH_NOARGS,
+		"return the names of all multi-buffer SHA-1 implementations\n"
+		"supported by this CPU, fastest first"},
+	{"set_simd_backend", py_set_simd_backend, METH_VARARGS,
+		"set_simd_backend(name)\n\n"
+		"select a multi-buffer SHA-1 implementation by name.\n"
+		"None disables multi-buffer hashing."},
+	{"filter_uncovered", py_filter_uncovered, METH_VARARGS,
+		"filter_uncovered(counters, digests, starts, ends)\n\n"
+		"remove all digests covered by one of the intervals\n"
+		"[starts[i], ends[i]], together with their label counters.\n"
+		"starts and ends are concatenated 20 byte hashes, sorted by\n"
+		"start. Returns a tuple (counters, digests)."},
+	{"first_uncovered", py_first_uncovered, METH_VARARGS,
+		"first_uncovered(digests, starts, ends, start=0)\n\n"
+		"return the index of the first of the concatenated 20 byte\n"
+		"digests, beginning at index start, that is not covered by one\n"
+		"of the intervals [starts[i], ends[i]], or -1 if all are covered.\n"
+		"See filter_uncovered()."},
+	{"memory_fence", py_memory_fence, METH_NOARGS,
+		"issue a full hardware memory barrier. Used to order the\n"
+		"stores and loads of shared memory ring buffers on CPUs with\n"
+		"a weak memory model."},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -30,10 +112,17 @@ static struct PyModuleDef nsec3hash_module = {
 };
 
 static PyObject *nsec3hash_error;
+static PyTypeObject HashGeneratorType;
+static const struct sha1mb_impl *simd_impl;
 
 PyMODINIT_FUNC PyInit_nsec3hash(void)
 {
 	PyObject *m;
+
+	if (PyType_Ready(&HashGeneratorType) < 0)
+		return NULL;
+	simd_impl = sha1mb_best();
+
 	m = PyModule_Create(&nsec3hash_module);
 	if (m == NULL) {
 		return NULL;
@@ -48,6 +137,14 @@ PyMODINIT_FUNC PyInit_nsec3hash(void)
 		return NULL;
 	}
 
+	Py_INCREF(&HashGeneratorType);
+	if (PyModule_AddObject(m, "HashGenerator",
+				(PyObject *)&HashGeneratorType) < 0) {
+		Py_DECREF(&HashGeneratorType);
+		Py_DECREF(m);
+		return NULL;
+	}
+
 	return m;
 }
 
@@ -55,19 +152,25 @@ int compute_hash(const unsigned char *dn, unsigned int dn_length,
 		struct hash_ctx *ctx, unsigned char *result,
 		unsigned int *presult_len)
 {
-	int i = 0;
-	int ret = -1;
+	int ret;
 	EVP_MD_CTX *mdctx;
 
 	if ((mdctx = EVP_MD_CTX_new()) == NULL)
-		goto allocerror;
-	if (1 != EVP_DigestInit_ex(mdctx, EVP_sha1(), NULL))
-		goto error;
-	if (1 != EVP_DigestUpdate(mdctx, dn, dn_length))
-		goto error;
-	if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
-		goto error;
-	if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
+		return -1;
+	ret = compute_hash_md(mdctx, dn, dn_length, ctx, result, presult_len);
+	EVP_MD_CTX_free(mdctx);
+	return ret;
+}
+
+/* same as compute_hash(), but reuses the digest context mdctx */
+static int compute_hash_md(EVP_MD_CTX *mdctx, const unsigned char *dn,
+		unsigned int dn_length, struct hash_ctx *ctx,
+		unsigned char *result, unsigned int *presult_len)
+{
+	int i = 0;
+
+	if (-1 == compute_first_iteration(mdctx, dn, dn_length, ctx, result,
+				presult_len))
 		goto error;
 
 	while (i++ < ctx->iterations) {
@@ -81,13 +184,191 @@ int compute_hash(const unsigned char *dn, unsigned int dn_length,
 			goto error;
 	}
 
+	return 0;
+
+error:
+	return -1;
+}
+
+/* computes H(dn || salt), the first of the iterations + 1 hashes */
+static int compute_first_iteration(EVP_MD_CTX *mdctx,
+		const unsigned char *dn, unsigned int dn_length,
+		struct hash_ctx *ctx, unsigned char *result,
+		unsigned int *presult_len)
+{
+	if (1 != EVP_DigestInit_ex(mdctx, EVP_sha1(), NULL))
+		return -1;
+	if (1 != EVP_DigestUpdate(mdctx, dn, dn_length))
+		return -1;
+	if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
+		return -1;
+	if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
+		return -1;
+	return 0;
+}
+
+/*
+ * Applies the remaining iterations to count digests that were computed
+ * by compute_first_iteration(). Uses the multi-buffer implementation if
+ * available, OpenSSL otherwise.
+ */
+static int compute_iterations(EVP_MD_CTX *mdctx, struct hash_ctx *ctx,
+		const struct sha1mb_msg *msg, unsigned char *digests,
+		Py_ssize_t count)
+{
+	const struct sha1mb_impl *impl = simd_impl;
+	uint32_t state[SHA1MB_DIGEST_WORDS * MAX_LANES];
+	unsigned char *d;
+	unsigned int result_len;
+	Py_ssize_t i, k, lane, n;
+	int j, it;
+
+	if (ctx->iterations == 0)
+		return 0;
+
+	if (impl == NULL) {
+		for (i = 0; i < count; i++) {
+			d = digests + i * SHA1_LENGTH;
+			result_len = SHA1_LENGTH;
+			for (it = 0; it < ctx->iterations; it++) {
+				if (1 != EVP_DigestInit_ex(mdctx, EVP_sha1(),
+							NULL))
+					return -1;
+				if (1 != EVP_DigestUpdate(mdctx, d, result_len))
+					return -1;
+				if (1 != EVP_DigestUpdate(mdctx, ctx->salt,
+							ctx->salt_length))
+					return -1;
+				if (1 != EVP_DigestFinal_ex(mdctx, d,
+							&result_len))
+					return -1;
+			}
+		}
+		return 0;
+	}
+
+	for (i = 0; i < count; i += impl->lanes) {
+		n = count - i < impl->lanes ? count - i : impl->lanes;
+		for (lane = 0; lane < impl->lanes; lane++) {
+			/* unused lanes hash a copy of the last digest */
+			k = i + (lane < n ? lane : n - 1);
+			d = digests + k * SHA1_LENGTH;
+			for (j = 0; j < SHA1MB_DIGEST_WORDS; j++)
+				state[j * impl->lanes + lane] =
+					((uint32_t)d[4 * j] << 24) |
+					((uint32_t)d[4 * j + 1] << 16) |
+					((uint32_t)d[4 * j + 2] << 8) |
+					(uint32_t)d[4 * j + 3];
+		}
+		impl->iterate(state, msg, ctx->iterations);
+		for (lane = 0; lane < n; lane++) {
+			d = digests + (i + lane) * SHA1_LENGTH;
+			for (j = 0; j < SHA1MB_DIGEST_WORDS; j++) {
+				uint32_t w = state[j * impl->lanes + lane];
+				d[4 * j] = (unsigned char)(w >> 24);
+				d[4 * j + 1] = (unsigned char)(w >> 16);
+				d[4 * j + 2] = (unsigned char)(w >> 8);
+				d[4 * j + 3] = (unsigned char)w;
+			}
+		}
+	}
+	return 0;
+}
+
+static void label_buf_init(struct label_buf *lb, const unsigned char *zone,
+		Py_ssize_t zone_length)
+{
+	memcpy(lb->buf + LABEL_END, zone, zone_length);
+	lb->zone_length = zone_length;
+	lb->lbl_length = 0;
+}
+
+/* writes the label hex(counter) in front of the zone */
+static void label_buf_set(struct label_buf *lb, unsigned long long counter)
+{
+	char hex[MAX_HEX_LABEL + 1];
+
+	lb->lbl_length = snprintf(hex, sizeof(hex), "%llx", counter);
+	memcpy(lb->buf + LABEL_END - lb->lbl_length, hex, lb->lbl_length);
+	lb->buf[LABEL_END - lb->lbl_length - 1] =
+		(unsigned char)lb->lbl_length;
+}
+
+/*
+ * Increments the hex label in place. The caller has to make sure that the
+ * counter does not exceed 64 bits.
+ */
+static void label_buf_inc(struct label_buf *lb)
+{
+	unsigned char *first = lb->buf + LABEL_END - lb->lbl_length;
+	unsigned char *p = lb->buf + LABEL_END;
+
+	while (p-- > first) {
+		if (*p == '9') {
+			*p = 'a';
+			return;
+		} else if (*p != 'f') {
+			(*p)++;
+			return;
+		}
+		*p = '0';
+	}
+	/* carry from the first digit: label is one digit longer now */
+	*p = '1';
+	lb->lbl_length++;
+	*(p - 1) = (unsigned char)lb->lbl_length;
+}
+
+static const unsigned char *label_buf_dn(struct label_buf *lb,
+		unsigned int *dn_length)
+{
+	*dn_length = 1 + lb->lbl_length + lb->zone_length;
+	return lb->buf + LABEL_END - lb->lbl_length - 1;
+}
+
+/*
+ * Computes the hashes of count consecutive names <hex(counter)>.<zone>,
+ * starting at counter. The digests are written to result, which must be
+ * able to hold count * SHA1_LENGTH bytes.
+ */
+static int compute_hash_range(const unsigned char *zone,
+		Py_ssize_t zone_length, struct hash_ctx *ctx,
+		unsigned long long counter, Py_ssize_t count,
+		unsigned char *result)
+{
+	int ret = -1;
+	unsigned int result_len;
+	unsigned int dn_length;
+	const unsigned char *dn;
+	struct label_buf lb;
+	struct sha1mb_msg msg;
+	EVP_MD_CTX *mdctx;
+	Py_ssize_t i;
+
+	if ((mdctx = EVP_MD_CTX_new()) == NULL)
+		return -1;
+
+	sha1mb_msg_init(&msg, ctx->salt, ctx->salt_length);
+	label_buf_init(&lb, zone, zone_length);
+	for (i = 0; i < count; i++) {
+		if (i == 0)
+			label_buf_set(&lb, counter);
+		else
+			label_buf_inc(&lb);
+		dn = label_buf_dn(&lb, &dn_length);
+		if (dn_length > MAX_DOMAINNAME)
+			goto error;
+		if (-1 == compute_first_iteration(mdctx, dn, dn_length, ctx,
+					result + i * SHA1_LENGTH, &result_len))
+			goto error;
+	}
+	if (-1 == compute_iterations(mdctx, ctx, &msg, result, count))
+		goto error;
 	ret = 0;
 
 error:
 	EVP_MD_CTX_free(mdctx);
-allocerror:
 	return ret;
-
 }
 
 static PyObject *py_compute_hash(PyObject *self, PyObject *args)
@@ -111,3 +392,429 @@ static PyObject *py_compute_hash(PyObject *self, PyObject *args)
 	}
 	return Py_BuildValue("y#", result, result_len);
 }
+
+static PyObject *py_compute_hashes(PyObject *self, PyObject *args)
+{
+	struct hash_ctx ctx;
+	const unsigned char *zone;
+	Py_ssize_t zone_length;
+	unsigned long long counter;
+	Py_ssize_t count;
+	PyObject *result;
+	int ret;
+
+	/* zone, salt, iterations, counter, count */
+	if (!PyArg_ParseTuple(args, "y#y#iKn", &zone,
+				&zone_length,
+				&ctx.salt,
+				&ctx.salt_length,
+				&ctx.iterations,
+				&counter,
+				&count))
+		return NULL;
+	if (count < 0) {
+		PyErr_SetString(PyExc_ValueError, "count must not be negative");
+		return NULL;
+	}
+	if (zone_length > MAX_DOMAINNAME) {
+		PyErr_SetString(PyExc_ValueError, "zone name too long");
+		return NULL;
+	}
+	if (count > 0 && counter + (unsigned long long)(count - 1) < counter) {
+		PyErr_SetString(PyExc_OverflowError, "label counter overflow");
+		return NULL;
+	}
+
+	result = PyBytes_FromStringAndSize(NULL, count * SHA1_LENGTH);
+	if (result == NULL)
+		return NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	ret = compute_hash_range(zone, zone_length, &ctx, counter, count,
+			(unsigned char *)PyBytes_AS_STRING(result));
+	Py_END_ALLOW_THREADS
+
+	if (-1 == ret) {
+		Py_DECREF(result);
+		PyErr_SetString(nsec3hash_error, "compute_hashes() failed");
+		return NULL;
+	}
+	return result;
+}
+
+static PyObject *py_simd_backend(PyObject *self, PyObject *args)
+{
+	if (simd_impl == NULL)
+		Py_RETURN_NONE;
+	return PyUnicode_FromString(simd_impl->name);
+}
+
+static PyObject *py_simd_backends(PyObject *self, PyObject *args)
+{
+	const struct sha1mb_impl * const *impl;
+	PyObject *lst;
+	PyObject *name;
+
+	if ((lst = PyList_New(0)) == NULL)
+		return NULL;
+	for (impl = sha1mb_available(); *impl != NULL; impl++) {
+		if ((name = PyUnicode_FromString((*impl)->name)) == NULL ||
+				PyList_Append(lst, name) < 0) {
+			Py_XDECREF(name);
+			Py_DECREF(lst);
+			return NULL;
+		}
+		Py_DECREF(name);
+	}
+	return lst;
+}
+
+static PyObject *py_set_simd_backend(PyObject *self, PyObject *args)
+{
+	const char *name;
+	const struct sha1mb_impl *impl;
+
+	if (!PyArg_ParseTuple(args, "z", &name))
+		return NULL;
+	if (name == NULL) {
+		simd_impl = NULL;
+		Py_RETURN_NONE;
+	}
+	if ((impl = sha1mb_find(name)) == NULL) {
+		PyErr_Format(PyExc_ValueError,
+				"unsupported SIMD backend: %s", name);
+		return NULL;
+	}
+	simd_impl = impl;
+	Py_RETURN_NONE;
+}
+
+
+/*
+ * Returns 1 if digest lies within one of the n intervals [starts[i], ends[i]]
+ * (sorted by start), 0 otherwise
+ */
+static int intervals_cover(const unsigned char *starts,
+		const unsigned char *ends, Py_ssize_t n,
+		const unsigned char *digest)
+{
+	Py_ssize_t lo = 0, hi = n, mid;
+
+	/* find the first interval starting after digest */
+	while (lo < hi) {
+		mid = lo + (hi - lo) / 2;
+		if (memcmp(starts + mid * SHA1_LENGTH, digest, SHA1_LENGTH) <= 0)
+			lo = mid + 1;
+		else
+			hi = mid;
+	}
+	if (lo == 0)
+		return 0;
+	return memcmp(digest, ends + (lo - 1) * SHA1_LENGTH, SHA1_LENGTH) <= 0;
+}
+
+static PyObject *py_filter_uncovered(PyObject *self, PyObject *args)
+{
+	Py_buffer counters, digests, starts, ends;
+	PyObject *rcounters = NULL;
+	PyObject *rdigests = NULL;
+	PyObject *result = NULL;
+	Py_ssize_t i, n, nintervals, nuncovered = 0;
+	unsigned char *pc, *pd;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*", &counters, &digests, &starts,
+				&ends))
+		return NULL;
+	n = digests.len / SHA1_LENGTH;
+	nintervals = starts.len / SHA1_LENGTH;
+	if (digests.len % SHA1_LENGTH != 0 ||
+			counters.len != n * (Py_ssize_t)sizeof(unsigned long long) ||
+			starts.len % SHA1_LENGTH != 0 || ends.len != starts.len) {
+		PyErr_SetString(PyExc_ValueError, "invalid buffer length");
+		goto out;
+	}
+	rcounters = PyBytes_FromStringAndSize(NULL, counters.len);
+	rdigests = PyBytes_FromStringAndSize(NULL, digests.len);
+	if (rcounters == NULL || rdigests == NULL)
+		goto out;
+
+	pc = (unsigned char *)PyBytes_AS_STRING(rcounters);
+	pd = (unsigned char *)PyBytes_AS_STRING(rdigests);
+	Py_BEGIN_ALLOW_THREADS
+	for (i = 0; i < n; i++) {
+		const unsigned char *digest =
+			(const unsigned char *)digests.buf + i * SHA1_LENGTH;
+		if (intervals_cover(starts.buf, ends.buf, nintervals, digest))
+			continue;
+		memcpy(pc + nuncovered * sizeof(unsigned long long),
+				(const unsigned char *)counters.buf +
+				i * sizeof(unsigned long long),
+				sizeof(unsigned long long));
+		memcpy(pd + nuncovered * SHA1_LENGTH, digest, SHA1_LENGTH);
+		nuncovered++;
+	}
+	Py_END_ALLOW_THREADS
+
+	if (_PyBytes_Resize(&rcounters,
+				nuncovered * sizeof(unsigned long long)) < 0 ||
+			_PyBytes_Resize(&rdigests, nuncovered * SHA1_LENGTH) < 0)
+		goto out;
+	result = Py_BuildValue("(OO)", rcounters, rdigests);
+out:
+	Py_XDECREF(rcounters);
+	Py_XDECREF(rdigests);
+	PyBuffer_Release(&counters);
+	PyBuffer_Release(&digests);
+	PyBuffer_Release(&starts);
+	PyBuffer_Release(&ends);
+	return result;
+}
+
+static PyObject *py_memory_fence(PyObject *self, PyObject *args)
+{
+	__atomic_thread_fence(__ATOMIC_SEQ_CST);
+	Py_RETURN_NONE;
+}
+
+static PyObject *py_first_uncovered(PyObject *self, PyObject *args)
+{
+	Py_buffer digests, starts, ends;
+	Py_ssize_t i, n, nintervals, start = 0, result = -1;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*|n", &digests, &starts, &ends,
+				&start))
+		return NULL;
+	n = digests.len / SHA1_LENGTH;
+	nintervals = starts.len / SHA1_LENGTH;
+	if (digests.len % SHA1_LENGTH != 0 || starts.len % SHA1_LENGTH != 0 ||
+			ends.len != starts.len) {
+		PyBuffer_Release(&digests);
+		PyBuffer_Release(&starts);
+		PyBuffer_Release(&ends);
+		PyErr_SetString(PyExc_ValueError, "invalid buffer length");
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	for (i = start < 0 ? 0 : start; i < n; i++) {
+		if (!intervals_cover(starts.buf, ends.buf, nintervals,
+					(const unsigned char *)digests.buf +
+					i * SHA1_LENGTH)) {
+			result = i;
+			break;
+		}
+	}
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&digests);
+	PyBuffer_Release(&starts);
+	PyBuffer_Release(&ends);
+	return PyLong_FromSsize_t(result);
+}
+
+
+/*
+ * HashGenerator: hashes the label counter sequence of one prehash process.
+ *
+ * Process i of n hashes the label counters [start, start + gap), then
+ * skips the ranges of the other processes and continues at
+ * start + n * gap (see prehash._process_label_generator()).
+ */
+typedef struct {
+	PyObject_HEAD
+	PyObject *salt;
+	struct hash_ctx ctx;
+	struct sha1mb_msg msg;
+	EVP_MD_CTX *mdctx;
+	struct label_buf lb;
+	unsigned long long start;
+	unsigned long long counter;
+	unsigned long long gap;
+	unsigned long long stride;
+	/* label_buf holds hex(counter - 1) */
+	int lb_valid;
+	/* all 64 bit label counters have been used */
+	int exhausted;
+} HashGenerator;
+
+static int HashGenerator_init(HashGenerator *self, PyObject *args,
+		PyObject *kwds)
+{
+	static char *kwlist[] = {"zone", "salt", "iterations", "init", "gap",
+		"process_id", "num_processes", NULL};
+	const unsigned char *zone;
+	Py_ssize_t zone_length;
+	PyObject *salt;
+	int iterations;
+	unsigned long long init = 0;
+	unsigned long long gap = 1024;
+	unsigned long long process_id = 0;
+	unsigned long long num_processes = 1;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "y#O!i|KKKK", kwlist,
+				&zone, &zone_length, &PyBytes_Type, &salt,
+				&iterations, &init, &gap, &process_id,
+				&num_processes))
+		return -1;
+	if (zone_length > MAX_DOMAINNAME) {
+		PyErr_SetString(PyExc_ValueError, "zone name too long");
+		return -1;
+	}
+	if (gap == 0 || num_processes == 0 || process_id >= num_processes) {
+		PyErr_SetString(PyExc_ValueError,
+				"invalid process range parameters");
+		return -1;
+	}
+	if (num_processes > ULLONG_MAX / gap ||
+			process_id * gap > ULLONG_MAX - init) {
+		PyErr_SetString(PyExc_OverflowError, "label counter overflow");
+		return -1;
+	}
+
+	if (self->mdctx == NULL && (self->mdctx = EVP_MD_CTX_new()) == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	Py_INCREF(salt);
+	Py_XSETREF(self->salt, salt);
+	self->ctx.salt = (const unsigned char *)PyBytes_AS_STRING(salt);
+	self->ctx.salt_length = PyBytes_GET_SIZE(salt);
+	self->ctx.iterations = iterations;
+	sha1mb_msg_init(&self->msg, self->ctx.salt, self->ctx.salt_length);
+	label_buf_init(&self->lb, zone, zone_length);
+	self->gap = gap;
+	self->stride = num_processes * gap;
+	self->start = init + process_id * gap;
+	self->counter = self->start;
+	self->lb_valid = 0;
+	self->exhausted = 0;
+	return 0;
+}
+
+static void HashGenerator_dealloc(HashGenerator *self)
+{
+	if (self->mdctx != NULL)
+		EVP_MD_CTX_free(self->mdctx);
+	Py_XDECREF(self->salt);
+	Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/*
+ * Fills counters and digests with the next count label counters and their
+ * hashes.
+ * Returns 0 on success, -1 if hashing failed and -2 on counter overflow.
+ */
+static int HashGenerator_fill(HashGenerator *self, Py_ssize_t count,
+		unsigned long long *counters, unsigned char *digests)
+{
+	unsigned int result_len;
+	unsigned int dn_length;
+	const unsigned char *dn;
+	Py_ssize_t i;
+
+	for (i = 0; i < count; i++) {
+		if (self->counter - self->start >= self->gap) {
+			if (self->start > ULLONG_MAX - self->stride)
+				return -2;
+			self->start += self->stride;
+			self->counter = self->start;
+			self->lb_valid = 0;
+		}
+		if (self->exhausted)
+			return -2;
+		if (self->lb_valid)
+			label_buf_inc(&self->lb);
+		else
+			label_buf_set(&self->lb, self->counter);
+		self->lb_valid = 1;
+
+		dn = label_buf_dn(&self->lb, &dn_length);
+		if (dn_length > MAX_DOMAINNAME)
+			return -1;
+		if (-1 == compute_first_iteration(self->mdctx, dn, dn_length,
+					&self->ctx,
+					digests + i * SHA1_LENGTH,
+					&result_len))
+			return -1;
+		counters[i] = self->counter;
+		if (self->counter == ULLONG_MAX)
+			self->exhausted = 1;
+		else
+			self->counter++;
+	}
+	return compute_iterations(self->mdctx, &self->ctx, &self->msg,
+			digests, count);
+}
+
+static PyObject *HashGenerator_compute(HashGenerator *self, PyObject *args)
+{
+	Py_ssize_t count;
+	PyObject *counters;
+	PyObject *digests;
+	int ret;
+
+	if (!PyArg_ParseTuple(args, "n", &count))
+		return NULL;
+	if (self->mdctx == NULL) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"HashGenerator not initialized");
+		return NULL;
+	}
+	if (count < 0) {
+		PyErr_SetString(PyExc_ValueError, "count must not be negative");
+		return NULL;
+	}
+
+	counters = PyBytes_FromStringAndSize(NULL,
+			count * sizeof(unsigned long long));
+	if (counters == NULL)
+		return NULL;
+	digests = PyBytes_FromStringAndSize(NULL, count * SHA1_LENGTH);
+	if (digests == NULL) {
+		Py_DECREF(counters);
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	ret = HashGenerator_fill(self, count,
+			(unsigned long long *)PyBytes_AS_STRING(counters),
+			(unsigned char *)PyBytes_AS_STRING(digests));
+	Py_END_ALLOW_THREADS
+
+	if (ret != 0) {
+		Py_DECREF(counters);
+		Py_DECREF(digests);
+		if (ret == -2)
+			PyErr_SetString(PyExc_OverflowError,
+					"label counter overflow");
+		else
+			PyErr_SetString(nsec3hash_error,
+					"HashGenerator.compute() failed");
+		return NULL;
+	}
+	return Py_BuildValue("(NN)", counters, digests);
+}
+
+static PyMethodDef HashGenerator_methods[] = {
+	{"compute", (PyCFunction)HashGenerator_compute, METH_VARARGS,
+		"compute(count)\n\n"
+		"hash the next count names. Returns a tuple (counters, digests)\n"
+		"with the label counters packed as native unsigned 64 bit\n"
+		"integers and the concatenated 20 byte digests."},
+	{NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject HashGeneratorType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	.tp_name = "nsec3hash.HashGenerator",
+	.tp_doc = "HashGenerator(zone, salt, iterations, init=0, gap=1024, "
+		"process_id=0, num_processes=1)\n\n"
+		"hash the names <hex(counter)>.<zone> of a prehash process",
+	.tp_basicsize = sizeof(HashGenerator),
+	.tp_itemsize = 0,
+	.tp_flags = Py_TPFLAGS_DEFAULT,
+	.tp_new = PyType_GenericNew,
+	.tp_init = (initproc)HashGenerator_init,
+	.tp_dealloc = (destructor)HashGenerator_dealloc,
+	.tp_methods = HashGenerator_methods,
+};
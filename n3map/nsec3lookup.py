@@ -2,6 +2,7 @@ import sys
 import os
 import getopt
 
+from . import chainfile
 from . import log
 from . import rrfile
 from . import rrtypes
@@ -12,7 +13,7 @@ stats = {'queries': 0,
          'found' : 0}
 
 def usage(argv):
-    sys.stderr.write("usage: " + os.path.basename(argv[0]) + " file [-o outfile] [-z zone] [-v]\n")
+    sys.stderr.write("usage: " + os.path.basename(argv[0]) + " file [-o outfile] [-z zone] [-p processes] [-v]\n")
     sys.exit(2)
 
 def lookup_nsec3(nsec3_chain, salt, iterations,  zone, line, out):
@@ -38,10 +39,11 @@ def nsec3lookup_main(argv):
     log.logger = log.Logger()
     out = None
     zone = None
+    processes = None
     try:
         nsec3_chain = {}
         try:
-            opts, args = getopt.gnu_getopt(argv[1:], "z:o:v")
+            opts, args = getopt.gnu_getopt(argv[1:], "z:o:p:v")
         except getopt.GetoptError as err:
             usage(argv)
         for opt, arg in opts:
@@ -49,6 +51,13 @@ def nsec3lookup_main(argv):
                 zone = n3map.name.fqdn_from_text(arg)
             if opt == '-o':
                 out = open(arg, "w")
+            if opt == '-p':
+                try:
+                    processes = int(arg)
+                    if processes < 1:
+                        raise ValueError
+                except ValueError:
+                    usage(argv)
             if opt == '-v':
                 log.logger.loglevel += 1
 
@@ -61,14 +70,25 @@ def nsec3lookup_main(argv):
         records_file = rrfile.open_input_rrfile(args[0])
         salt = None
         iterations = None
-        for nsec3 in records_file.nsec3_reader():
-            if salt == None or iterations == None:
-                salt = nsec3.salt
-                iterations = nsec3.iterations
-            elif salt != nsec3.salt or iterations != nsec3.iterations:
-                raise ZoneChangedError("zone salt or iterations not unique!")
-            nsec3_chain[nsec3.hashed_owner] = nsec3;
-        records_file.close()
+        if isinstance(records_file, chainfile.ChainFile):
+            # look up the hashes in the memory-mapped file
+            nsec3_chain = records_file.records()
+            salt = nsec3_chain.salt
+            iterations = nsec3_chain.iterations
+        elif rrfile.can_load_nsec3_records(args[0]):
+            records_file.close()
+            nsec3_chain = rrfile.load_nsec3_records(args[0], processes)
+            salt = nsec3_chain.salt
+            iterations = nsec3_chain.iterations
+        else:
+            for nsec3 in records_file.nsec3_reader():
+                if salt == None or iterations == None:
+                    salt = nsec3.salt
+                    iterations = nsec3.iterations
+                elif salt != nsec3.salt or iterations != nsec3.iterations:
+                    raise ZoneChangedError("zone salt or iterations not unique!")
+                nsec3_chain[nsec3.hashed_owner] = nsec3;
+            records_file.close()
         log.info("read {0:d} records. ready for input!".format(len(nsec3_chain)))
 
         if len(nsec3_chain) == 0:
@@ -1,9 +1,13 @@
-import itertools
+import bisect
+import heapq
 import secrets
+import time
 
+from . import chainfile
 from . import log
 from . import name
 from . import prehash
+from . import rrfile
 from . import util
 from . import walker
 
@@ -13,15 +17,53 @@ from .statusline import format_statusline_nsec3
 
 from .exception import N3MapError, NSEC3WalkError, HashLimitReached
 from .nsec3chain import NSEC3Chain
+from .rrtypes.nsec3 import SHA1_LENGTH
+
+
+class _QueriesInFlight(object):
+    """Hashes of the names of outstanding queries
+
+    Used to find out how many queries target an uncovered interval of the
+    chain. The hashes are kept instead of the intervals themselves because
+    a response may split an interval while other queries into it are
+    still outstanding.
+    """
+    def __init__(self):
+        self._hashes = []
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, dn_hash):
+        bisect.insort(self._hashes, dn_hash)
+
+    def remove(self, dn_hash):
+        del self._hashes[bisect.bisect_left(self._hashes, dn_hash)]
+
+    def count(self, gap):
+        """Returns the number of outstanding queries within gap, see
+        NSEC3Chain.uncovered_gap()"""
+        start, end = gap
+        hashes = self._hashes
+        if start < end:
+            return (bisect.bisect_left(hashes, end) -
+                    bisect.bisect_right(hashes, start))
+        return (len(hashes) - bisect.bisect_right(hashes, start) +
+                bisect.bisect_left(hashes, end))
 
 
 class NSEC3Walker(walker.Walker):
     def __init__(self, zone, queryprovider, hash_queues, prehash_pool,
-            nsec3_records, ignore_overlapping=False, label_counter=None,
+            nsec3_records, ignore_overlapping=False, chain_index='array',
+            label_counter=None,
             output_file=None, stats=None, predictor=None, aggressive=0,
-            hashlimit=0):
+            query_engine='asyncio', use_mmsg=True, hashlimit=0,
+            candidate_window=0):
         super(NSEC3Walker, self).__init__(zone, queryprovider, output_file, stats)
         self.stats['tested_hashes'] = 0
+        if aggressive > 0:
+            self.stats.setdefault('wasted_queries', 0)
+            self.stats.setdefault('deferred_hashes', 0)
         self.hashlimit = hashlimit
 
         self._prediction_current = None
@@ -31,13 +73,24 @@ class NSEC3Walker(walker.Walker):
             self._predictor_proc = None
 
         self._write_chain(nsec3_records)
-        self.nsec3_chain = NSEC3Chain(ignore_overlapping=ignore_overlapping)
+        self.nsec3_chain = NSEC3Chain(ignore_overlapping=ignore_overlapping,
+                index=chain_index)
         self._update_predictor_state()
-        for rr in nsec3_records:
-            self.nsec3_chain.insert(rr)
-            self._update_predictor_state()
+        if (isinstance(nsec3_records, (chainfile.ChainRecords,
+                    rrfile.NSEC3FileRecords)) and
+                self._predictor_proc is None and len(nsec3_records) > 0):
+            # packed records of a file, skip creating the record objects
+            keys, ends = nsec3_records.intervals()
+            self.nsec3_chain.load(nsec3_records.zone, nsec3_records.salt,
+                    nsec3_records.iterations, keys, ends,
+                    nsec3_records.sorted)
+        else:
+            for rr in nsec3_records:
+                self.nsec3_chain.insert(rr)
+                self._update_predictor_state()
 
-        self._prehash_processes = prehash_pool
+        # PrehashProcesses or SharedPrehashJob
+        self._prehash = prehash_pool
 
         if label_counter is not None:
             log.debug2("setting initial label counter to 0x{0:x}".format(
@@ -52,9 +105,17 @@ class NSEC3Walker(walker.Walker):
             self._label_counter_init = 0
 
         self._label_counter_state = 0
-        self._hash_queues = itertools.cycle(hash_queues)
+        self._hash_queues = prehash.HashRingSet(hash_queues)
         self._reset_prehashing()
         self._aggressive = aggressive
+        self._query_engine = query_engine
+        self._use_mmsg = use_mmsg
+        # heap of (-interval size, sequence number, name, hash) tuples to
+        # choose the next query from, see _find_uncovered_dn()
+        self._candidate_window = candidate_window
+        self._candidates = []
+        self._candidate_seq = 0
+        self._candidate_picks = 0
 
     def _process_query_result(self, query_dn, res, ns):
         recv_nsec3 = res.find_NSEC3()
@@ -62,21 +123,23 @@ class NSEC3Walker(walker.Walker):
             if res.status() == "NOERROR":
                 log.info("hit an existing owner name: ", str(query_dn))
                 ns.reset_errors()
-                return
+                return False
             elif res.status() == 'NXDOMAIN':
                 log.error('no NSEC3 RR received\n',
                         "Maybe the zone doesn't support DNSSEC or uses NSEC RRs")
                 self.queryprovider.add_ns_error(ns)
-                return
+                return False
             else:
                 log.error('unexpected response status: ', res.status(),
                         ' from ', str(ns))
                 self.queryprovider.add_ns_error(ns)
-                return
+                return False
         ns.reset_errors()
         if not self._insert_records(recv_nsec3):
             log.warn("did not receive any new NSEC3 records for query: ",
                      str(query_dn))
+            return False
+        return True
 
     def _insert_records(self, recv_rr):
         got_new = False
@@ -102,25 +165,60 @@ class NSEC3Walker(walker.Walker):
                         ' '.join(rr.types))
                 self._write_record(rr)
                 self._update_predictor_state()
+        if got_new:
+            self._update_coverage_snapshot()
         return got_new
 
     def _map_aggressive(self):
+        """Keeps up to self._aggressive queries in flight
+
+        A query is only sent into an uncovered interval of the chain if
+        fewer queries than the number of records expected within it are
+        already outstanding, otherwise the first response would most likely
+        cover the interval and make the others useless. Hashes in such
+        intervals are skipped, or stay in the candidate window until the
+        outstanding queries are answered or time out. Responses without new
+        records are counted in stats['wasted_queries'], skipped hashes in
+        stats['deferred_hashes'].
+        """
+        # query id -> (name, hash)
         queries = {}
+        in_flight = _QueriesInFlight()
         max_queries = self._aggressive
         oldqp = self.queryprovider
         self.queryprovider = create_aggressive_qp(self.queryprovider,
-                                                  max_queries)
+                                                  max_queries,
+                                                  self._query_engine,
+                                                  self._use_mmsg)
         try:
             while not self.nsec3_chain.covers_zone():
                 num_queries = len(queries)
-                query_dn,dn_hash = self._find_uncovered_dn(num_queries > 0)
+                query_dn,dn_hash = self._find_uncovered_dn(num_queries > 0,
+                        in_flight)
+                # all candidates are in intervals with enough queries
+                stalled = (query_dn is None and
+                        self._candidate_window > 0 and
+                        len(self._candidates) >= self._candidate_window)
                 results = self.queryprovider.collectresponses(
-                        block=(num_queries >= max_queries))
+                        block=(num_queries >= max_queries or stalled))
                 for qid, (res, ns) in results:
-                    self._process_query_result(queries.pop(qid),res, ns)
-                if query_dn is None or self.nsec3_chain.covers(dn_hash):
+                    dn, h = queries.pop(qid)
+                    in_flight.remove(h)
+                    if not self._process_query_result(dn, res, ns):
+                        self.stats['wasted_queries'] += 1
+                if query_dn is None:
                     continue
-                queries[self.queryprovider.query_ff(query_dn, rrtype='A')] = query_dn
+                gap = self.nsec3_chain.uncovered_gap(dn_hash)
+                if gap is None:
+                    continue
+                if not self._gap_has_room(gap, in_flight):
+                    self.stats['deferred_hashes'] += 1
+                    if self._candidate_window > 0:
+                        self._push_candidate(query_dn, dn_hash, gap)
+                    continue
+                qid = self.queryprovider.query_ff(query_dn, rrtype='A')
+                queries[qid] = (query_dn, dn_hash)
+                in_flight.add(dn_hash)
         finally:
             self.queryprovider.stop()
             self.queryprovider = oldqp
@@ -165,52 +263,195 @@ class NSEC3Walker(walker.Walker):
             raise e
         finally:
             log.update()
-            log.logger.set_status_generator(None, None)
+            self._show_status(None, None)
 
         return self.nsec3_chain
 
 
-    def _find_uncovered_dn(self, break_early=False):
-        is_covered = self.nsec3_chain.covers
+    def _find_uncovered_dn(self, break_early=False, in_flight=None):
+        """Returns the next name to query and its hash. If break_early is
+        set, (None, None) may be returned if no uncovered hash was found
+        right away.
+
+        Without a candidate window, names are queried in prehash order.
+        Otherwise up to candidate_window uncovered hashes are buffered and
+        the one in the largest uncovered interval of the chain is chosen.
+        If in_flight (a _QueriesInFlight object) is given, the size of an
+        interval is divided by the number of queries in flight into it, so
+        that concurrent queries go to different intervals, and intervals
+        without room for another query (see _gap_has_room()) are skipped.
+        """
+        if self._candidate_window == 0:
+            return self._next_uncovered_dn(break_early)
+        heap = self._candidates
         while True:
-            for ptlabel,dn_hash in self._prehash_iter:
-                if not is_covered(dn_hash):
-                    dn = name.DomainName(name.Label(ptlabel), *self.zone.labels)
-                    owner_b32 = util.base32_ext_hex_encode( dn_hash).lower()
-                    hashed_dn = name.DomainName( name.Label(owner_b32), *self.zone.labels)
-                    log.debug3('found uncovered dn: ', str(dn), '; hashed: ', str(hashed_dn))
-                    return dn,dn_hash
-
-            self.stats['tested_hashes'] += len(self._prehash_list)
+            while len(heap) < self._candidate_window:
+                query_dn, dn_hash = self._next_uncovered_dn(
+                        break_early or len(heap) > 0)
+                if query_dn is None:
+                    break
+                gap = self.nsec3_chain.uncovered_gap(dn_hash)
+                if gap is not None:
+                    self._push_candidate(query_dn, dn_hash, gap)
+
+            self._candidate_picks += 1
+            if self._candidate_picks >= self._candidate_window:
+                # sizes only get updated once a candidate reaches the top,
+                # purge the candidates covered in the meantime
+                self._candidate_picks = 0
+                self._resize_candidates()
+                heap = self._candidates
+
+            best = self._pop_best_candidate(in_flight)
+            if best is not None:
+                return best
+            if break_early:
+                return None, None
+
+    def _push_candidate(self, query_dn, dn_hash, gap):
+        self._candidate_seq += 1
+        heapq.heappush(self._candidates, (-self.nsec3_chain.gap_size(gap),
+            self._candidate_seq, query_dn, dn_hash))
+
+    def _gap_has_room(self, gap, in_flight):
+        """Returns True if fewer queries are in flight into gap than records
+        are expected within it. There is always room for one query."""
+        n = in_flight.count(gap)
+        return n == 0 or n < self.nsec3_chain.expected_records(gap)
+
+    def _pop_best_candidate(self, in_flight):
+        # The heap holds the size of each candidate's interval at the time it
+        # was last looked at. Intervals only shrink, so these are upper
+        # bounds and candidates are popped until none of the remaining ones
+        # can beat the best one found.
+        heap = self._candidates
+        chain = self.nsec3_chain
+        best = None
+        best_weight = None
+        skipped = []
+        while len(heap) > 0:
+            neg_size, seq, query_dn, dn_hash = heap[0]
+            if best is not None and best_weight >= -neg_size:
+                break
+            gap = chain.uncovered_gap(dn_hash)
+            if gap is None:
+                heapq.heappop(heap)
+                continue
+            size = chain.gap_size(gap)
+            if size < -neg_size:
+                heapq.heapreplace(heap, (-size, seq, query_dn, dn_hash))
+                continue
+            candidate = heapq.heappop(heap)
+            weight = size
+            if in_flight is not None:
+                if not self._gap_has_room(gap, in_flight):
+                    skipped.append(candidate)
+                    continue
+                weight /= 1 + in_flight.count(gap)
+            if best is None or weight > best_weight:
+                if best is not None:
+                    skipped.append(best)
+                best = candidate
+                best_weight = weight
+            else:
+                skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(heap, candidate)
+        if best is None:
+            return None
+        return best[2], best[3]
+
+    def _resize_candidates(self):
+        heap = []
+        chain = self.nsec3_chain
+        for neg_size, seq, query_dn, dn_hash in self._candidates:
+            gap = chain.uncovered_gap(dn_hash)
+            if gap is not None:
+                heap.append((-chain.gap_size(gap), seq, query_dn, dn_hash))
+        heapq.heapify(heap)
+        self._candidates = heap
+
+    def _next_uncovered_dn(self, break_early=False):
+        first_uncovered = self.nsec3_chain.first_uncovered
+        while True:
+            digests = self._prehash_digests
+            i = first_uncovered(digests, self._prehash_pos)
+            if i is not None:
+                self._prehash_pos = i + 1
+                dn_hash = digests[i*SHA1_LENGTH:(i+1)*SHA1_LENGTH]
+                ptlabel = name.hex_label(self._prehash_counters[i])
+                dn = name.DomainName(name.Label(ptlabel), *self.zone.labels)
+                owner_b32 = util.base32_ext_hex_encode( dn_hash).lower()
+                hashed_dn = name.DomainName( name.Label(owner_b32), *self.zone.labels)
+                log.debug3('found uncovered dn: ', str(dn), '; hashed: ', str(hashed_dn))
+                return dn,dn_hash
+
+            self.stats['tested_hashes'] += self._prehash_tested
+            self._prehash_tested = 0
             if (self.hashlimit > 0 and
                     self.stats['tested_hashes'] >= self.hashlimit):
                 raise HashLimitReached
-            hashes, label_counter_state = next(self._hash_queues).recv()
-            if self._label_counter_state < label_counter_state:
-                self._label_counter_state = label_counter_state
-            self._prehash_list = hashes
-            self._prehash_iter = iter(hashes)
+            counters, digests, tested, last = self._hash_queues.get()
+            counters = memoryview(counters).cast('Q')
+            if self._label_counter_state < last:
+                self._label_counter_state = last
+            self._prehash_tested = tested
+            self._prehash_counters = counters
+            self._prehash_digests = digests
+            self._prehash_pos = 0
             log.update()
             if break_early:
                 return None,None
 
 
     def _start_prehashing(self):
-        for pipe, proc in self._prehash_processes:
-            pipe.send((self._label_counter_init, self.zone,
-                self.nsec3_chain.salt, self.nsec3_chain.iterations))
+        self._coverage = prehash.CoverageSnapshot()
+        self._update_coverage_snapshot(force=True)
+        self._prehash.start(self._label_counter_init, self.zone,
+                self.nsec3_chain.salt, self.nsec3_chain.iterations,
+                self._coverage.name)
         self._prehash_started = True
 
     def _reset_prehashing(self):
-        self._prehash_list = []
-        self._prehash_iter = iter(self._prehash_list)
+        self._prehash_counters = []
+        self._prehash_digests = b''
+        self._prehash_pos = 0
+        self._prehash_tested = 0
         self._prehash_started = False
+        self._coverage = None
+        self._coverage_size = 0
+        self._coverage_time = 0.0
+        self._coverage_interval = 0.0
 
     def _stop_prehashing(self):
-        for pipe, proc in self._prehash_processes:
-            proc.terminate()
+        self._prehash.stop()
+        if self._coverage is not None:
+            self._coverage.release()
         self._reset_prehashing()
 
+    def _update_coverage_snapshot(self, force=False):
+        """Publishes the covered intervals to the prehash processes
+
+        Building the snapshot takes O(n), so it is only refreshed after the
+        chain has grown by 1/16 or once in a while if it has grown at all.
+        """
+        if self._coverage is None:
+            return
+        size = self.nsec3_chain.size()
+        new = size - self._coverage_size
+        now = time.monotonic()
+        if not force and (new < max(16, self._coverage_size >> 4) and
+                (new == 0 or now - self._coverage_time <
+                    self._coverage_interval)):
+            return
+        if self._coverage.publish(*self.nsec3_chain.covered_intervals()):
+            log.debug2("coverage snapshot resized")
+            self._prehash.coverage_resized(self._coverage.name)
+        self._coverage_size = size
+        self._coverage_time = time.monotonic()
+        # spend at most ~10% of the time on snapshots
+        self._coverage_interval = max(1.0, 10*(self._coverage_time - now))
+
     def _stop_predictor(self):
         if self._predictor_proc is not None:
             self._predictor_proc.terminate()
@@ -232,6 +473,6 @@ class NSEC3Walker(walker.Walker):
                     self.queryprovider.query_rate(),
                     self._prediction_current
                 )
-        log.logger.set_status_generator(status_generator, format_statusline_nsec3)
+        self._show_status(status_generator, format_statusline_nsec3)
 
 
@@ -1,20 +1,36 @@
+import bisect
+import collections
 import itertools
 import enum
+import threading
 
 from . import log
 from . import name
 from . import walker
 
 from .exception import N3MapError
+from .queryprovider import create_aggressive_qp
 
 from .statusline import format_statusline_nsec
 
 from .exception import (
         MaxDomainNameLengthError,
         MaxDomainNameLengthError,
+        MaxLabelLengthError,
+        MaxLabelValueError,
         NSECWalkError
     )
 
+# common labels guessed by speculative NSEC walking
+SPECULATION_WORDS = (b'admin', b'api', b'app', b'autodiscover', b'blog',
+        b'cdn', b'cloud', b'dev', b'dns', b'docs', b'email', b'forum', b'ftp',
+        b'git', b'help', b'imap', b'intranet', b'login', b'mail', b'mobile',
+        b'mx', b'news', b'ns', b'ns1', b'ns2', b'portal', b'pop', b'remote',
+        b'secure', b'server', b'shop', b'smtp', b'staging', b'static',
+        b'support', b'test', b'vpn', b'web', b'webmail', b'wiki', b'www')
+# number of recent speculative queries used to adapt the speculation depth
+SPECULATION_WINDOW = 32
+
 
 class ResultStatus(enum.Enum):
     OK        = enum.auto()
@@ -229,7 +245,7 @@ class NSECWalker(walker.Walker):
         except (KeyboardInterrupt, N3MapError) as e:
             raise e
         finally:
-            log.logger.set_status_generator(None,None)
+            self._show_status(None, None)
 
     def _append_covering_record(self, covering_nsec):
         log.debug2('covering NSEC RR found: ', str(covering_nsec))
@@ -265,6 +281,8 @@ class NSECWalker(walker.Walker):
 
         if startname is None:
             return self.zone
+        elif isinstance(startname, name.DomainName):
+            return startname
         else:
             return name.DomainName(
                     *(name.domainname_from_text(startname).labels +
@@ -273,6 +291,8 @@ class NSECWalker(walker.Walker):
     def _get_end(self, endname):
         if endname is None:
             end = None
+        elif isinstance(endname, name.DomainName):
+            end = endname
         else:
             end = name.DomainName(
                     *(name.domainname_from_text(endname).labels +
@@ -288,6 +308,15 @@ class NSECWalker(walker.Walker):
 
         return (start, end)
 
+    def _top_label(self, dname):
+        """Returns the label directly below the zone name"""
+        if dname.num_labels() <= self.zone.num_labels():
+            return b''
+        return dname.labels[-self.zone.num_labels() - 1].label
+
+    def _name(self, label):
+        return name.DomainName(name.Label(label), *self.zone.labels)
+
     def _set_status_generator(self):
         def status_generator():
             return (str(self.zone),
@@ -295,43 +324,123 @@ class NSECWalker(walker.Walker):
                     len(self.nsec_chain),
                     self.queryprovider.query_rate()
                 )
-        log.logger.set_status_generator(status_generator, format_statusline_nsec)
+        self._show_status(status_generator, format_statusline_nsec)
+
+
+class _RecordIntervals(object):
+    """NSEC records received ahead of the walk, sorted by owner name
+
+    Each record covers the interval between its owner and next owner
+    name. position is a function returning the estimated position of a
+    name, see _label_position(), it is used to find large gaps quickly."""
+    def __init__(self, position):
+        self._position = position
+        self._owners = []
+        self._records = []
+        # (owner position, next owner position, last record of the zone)
+        self._positions = []
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, record):
+        """Returns False if a record with the same owner is known already"""
+        i = bisect.bisect_left(self._owners, record.owner)
+        if i < len(self._owners) and self._owners[i] == record.owner:
+            return False
+        self._owners.insert(i, record.owner)
+        self._records.insert(i, record)
+        self._positions.insert(i, (self._position(record.owner),
+            self._position(record.next_owner),
+            record.next_owner <= record.owner))
+        return True
+
+    def pop(self, owner):
+        """Removes and returns the record of owner, or None"""
+        i = bisect.bisect_left(self._owners, owner)
+        if i < len(self._owners) and self._owners[i] == owner:
+            del self._owners[i]
+            del self._positions[i]
+            return self._records.pop(i)
+        return None
+
+    def covers(self, dname):
+        i = bisect.bisect_right(self._owners, dname) - 1
+        if i < 0:
+            return False
+        record = self._records[i]
+        return (dname < record.next_owner or
+                record.next_owner <= record.owner)
+
+    def largest_gap(self, start, end):
+        """Returns the widest interval (first, last) between the positions
+        start and end not covered by any record"""
+        best = (start, start)
+        for owner, next_owner, last in self._positions:
+            if min(owner, end) - start > best[1] - best[0]:
+                best = (start, min(owner, end))
+            if last:
+                return best
+            start = max(start, next_owner)
+            if start >= end:
+                return best
+        if end - start > best[1] - best[0]:
+            best = (start, end)
+        return best
 
 
 class NSECWalkerN(NSECWalker):
     def __init__(self, zone, queryprovider, nsec_chain=None, startname=None,
-            endname=None, output_file=None, stats=None):
+            endname=None, output_file=None, stats=None, speculate=0,
+            query_engine='asyncio', use_mmsg=True):
         super(NSECWalkerN, self).__init__(zone, queryprovider, nsec_chain,
                 startname, endname, output_file, stats)
+        self.speculate = speculate
+        self._query_engine = query_engine
+        self._use_mmsg = use_mmsg
+        if speculate > 0:
+            self.stats.setdefault('speculative_queries', 0)
+            self.stats.setdefault('wasted_queries', 0)
 
     def walk(self):
         log.info("starting enumeration in NSEC query mode...")
         return super(NSECWalkerN,self).walk()
 
+    def _process_chain_result(self, nresult):
+        """Returns the covering NSEC record or None if the query has to be
+        repeated"""
+        (status, covering_nsec, subzone) = nresult.extract()
+        if status == ResultStatus.ERROR:
+            if nresult.num_NSEC_rrs() == 0:
+                log.error(self._no_NSEC_error(nresult.ns))
+            self.queryprovider.add_ns_error(nresult.ns)
+            return None
+        elif status == ResultStatus.SUBZONE:
+            if covering_nsec is not None:
+                # we write this record down anyway
+                self._append_covering_record(covering_nsec)
+            raise NSECWalkError('walked into subzone at: ',
+                    str(nresult.query_dn),
+                    "\ndon't know how to continue enumeration.\n",
+                    "Try using 'mixed' or 'A' query mode instead.")
+        elif status == ResultStatus.OK:
+            nresult.ns.reset_errors()
+        else:
+            # in case we ever extend ResultStatus
+            raise N3MapError(
+                    "Unexpected ResultStatus. This should never happen")
+        return covering_nsec
+
     def _walk_zone(self):
+        if self.speculate > 0:
+            return self._walk_zone_speculative()
         dname = self.start
         covering_nsec = None
         while not self._finished(dname):
             nresult = self._query(dname, rrtype='NSEC')
-            (status, covering_nsec, subzone) = nresult.extract()
-            if status == ResultStatus.ERROR:
-                if nresult.num_NSEC_rrs() == 0:
-                    log.error(self._no_NSEC_error(nresult.ns))
-                self.queryprovider.add_ns_error(nresult.ns)
+            covering_nsec = self._process_chain_result(nresult)
+            if covering_nsec is None:
                 continue
-            elif status == ResultStatus.SUBZONE:
-                if covering_nsec is not None:
-                    # we write this record down anyway
-                    self._append_covering_record(covering_nsec)
-                raise NSECWalkError('walked into subzone at: ', str(dname),
-                        "\ndon't know how to continue enumeration.\n",
-                        "Try using 'mixed' or 'A' query mode instead.")
-            elif status == ResultStatus.OK:
-                nresult.ns.reset_errors()
-            else:
-                # in case we ever extend ResultStatus
-                raise N3MapError(
-                        "Unexpected ResultStatus. This should never happen")
 
             # status == OK:
             self._append_covering_record(covering_nsec)
@@ -340,6 +449,179 @@ class NSECWalkerN(NSECWalker):
 
         return self.nsec_chain
 
+    def _word_guesses(self):
+        guesses = [name.DomainName(name.Label(bytes([c])), *self.zone.labels)
+                for c in name.range_ld]
+        guesses += [name.DomainName(name.Label(w), *self.zone.labels)
+                for w in SPECULATION_WORDS]
+        return sorted(guesses)
+
+    def _increment_guesses(self, dname):
+        """Returns the names following all names that start with the first
+        one, two or three characters of dname's label below the zone"""
+        if dname.num_labels() <= self.zone.num_labels():
+            return []
+        label = dname.labels[-self.zone.num_labels() - 1].label
+        guesses = []
+        for n in range(min(3, len(label)), 0, -1):
+            try:
+                guesses.append(name.DomainName(
+                    name.Label(label[:n]).forward_next(ldh=True, extend=False),
+                    *self.zone.labels))
+            except (MaxLabelLengthError, MaxLabelValueError):
+                pass
+        return guesses
+
+    def _position(self, dname):
+        return _label_position(self._top_label(dname))
+
+    def _gap_guess(self, dname, ahead):
+        """Returns the estimated middle of the largest unknown part of the
+        chain ahead, or None"""
+        if self.end is not None:
+            end = self._position(self.end)
+        else:
+            end = (len(_NAME_ALPHABET) + 1)**_POSITION_DIGITS
+        first, last = ahead.largest_gap(self._position(dname), end)
+        if last - first < 2:
+            return None
+        return self._name(_label_at_position((first + last)//2))
+
+    def _walk_zone_speculative(self):
+        """Follows the chain while speculatively querying for names further
+        ahead
+
+        Besides the query for the next name in the chain, up to
+        self.speculate NSEC queries are kept in flight. The speculative
+        query names are, in this order: the next owner names of records
+        received ahead of the walk whose own record is still missing, label
+        increments of the current name, common labels and the middle of the
+        largest unknown part of the chain ahead. All records
+        received ahead are kept in a _RecordIntervals structure until the
+        walk reaches them. Speculative queries which did not yield a new
+        record are counted in stats['wasted_queries']; if more than half of
+        the recent ones were wasted, the speculation depth is reduced, if
+        fewer than a quarter were, it is increased again.
+        """
+        oldqp = self.queryprovider
+        self.queryprovider = create_aggressive_qp(oldqp, self.speculate + 1,
+                self._query_engine, self._use_mmsg)
+        try:
+            return self._speculate()
+        finally:
+            self.queryprovider.stop()
+            self.queryprovider = oldqp
+
+    def _speculate(self):
+        ahead = _RecordIntervals(self._position)
+        # next owner names of records in ahead whose record is missing
+        frontier = {}
+        # query id -> (query name, speculative)
+        queries = {}
+        # wire format of all names queried so far and of the names
+        # currently queried
+        queried = set()
+        in_flight = set()
+        words = iter(self._word_guesses())
+        depth = self.speculate
+        outcomes = collections.deque(maxlen=SPECULATION_WINDOW)
+
+        def send(query_dn, speculative):
+            key = query_dn.to_wire()
+            queried.add(key)
+            in_flight.add(key)
+            queries[self.queryprovider.query_ff(query_dn,
+                rrtype='NSEC')] = (query_dn, speculative)
+
+        def useful(guess, dname):
+            return (guess > dname and
+                    (self.end is None or guess < self.end) and
+                    guess.to_wire() not in queried and
+                    not ahead.covers(guess))
+
+        def next_guess(dname):
+            while len(frontier) > 0:
+                guess = frontier.popitem()[1]
+                if useful(guess, dname):
+                    return guess
+            for guess in self._increment_guesses(dname):
+                if useful(guess, dname):
+                    return guess
+            for guess in words:
+                if useful(guess, dname):
+                    return guess
+            guess = self._gap_guess(dname, ahead)
+            if guess is not None and useful(guess, dname):
+                return guess
+            return None
+
+        def add_ahead(record, dname):
+            if record.owner < dname or not ahead.add(record):
+                return False
+            frontier.pop(record.owner.to_wire(), None)
+            next_owner = record.next_owner
+            if next_owner > record.owner and not ahead.covers(next_owner):
+                frontier[next_owner.to_wire()] = next_owner
+            return True
+
+        def adapt(wasted):
+            nonlocal depth
+            if wasted:
+                self.stats['wasted_queries'] += 1
+            outcomes.append(wasted)
+            if len(outcomes) < SPECULATION_WINDOW:
+                return
+            waste = sum(outcomes)/len(outcomes)
+            if waste > 0.5 and depth > 1:
+                depth -= 1
+            elif waste < 0.25 and depth < self.speculate:
+                depth += 1
+            else:
+                return
+            log.debug1("speculation depth: ", str(depth))
+            outcomes.clear()
+
+        dname = self.start
+        while not self._finished(dname):
+            covering_nsec = ahead.pop(dname)
+            if covering_nsec is not None:
+                self._append_covering_record(covering_nsec)
+                log.debug2("next in chain: ", str(covering_nsec.next_owner))
+                dname = covering_nsec.next_owner
+                continue
+
+            if dname.to_wire() not in in_flight:
+                send(dname, False)
+            while len(queries) <= depth:
+                guess = next_guess(dname)
+                if guess is None:
+                    break
+                log.debug2("speculative query: ", str(guess))
+                self.stats['speculative_queries'] += 1
+                send(guess, True)
+
+            for qid, (res, ns) in self.queryprovider.collectresponses():
+                query_dn, speculative = queries.pop(qid)
+                in_flight.discard(query_dn.to_wire())
+                nresult = NSECResult(self.zone, query_dn, 'NSEC', res, ns)
+                nresult.log_NSEC_rrs()
+                if query_dn == dname:
+                    covering_nsec = self._process_chain_result(nresult)
+                    if covering_nsec is None:
+                        continue
+                    self._append_covering_record(covering_nsec)
+                    log.debug2("next in chain: ",
+                            str(covering_nsec.next_owner))
+                    dname = covering_nsec.next_owner
+                    continue
+                (status, covering_nsec, subzone) = nresult.extract()
+                wasted = (status != ResultStatus.OK or
+                        not add_ahead(covering_nsec, dname))
+                if speculative:
+                    adapt(wasted)
+
+        return self.nsec_chain
+
     def _no_NSEC_error(self, ns):
         return (super()._no_NSEC_error(ns) +
                 "or the server {} does not allow NSEC queries.\n".format(ns) +
@@ -514,3 +796,291 @@ class NSECWalkerMixed(NSECWalkerA):
             dname = covering_nsec.next_owner
 
         return self.nsec_chain
+
+
+
+# characters most owner names are made of, in canonical order
+_NAME_ALPHABET = b'-0123456789_abcdefghijklmnopqrstuvwxyz'
+# number of characters used to estimate the position of a label
+_POSITION_DIGITS = 8
+
+def _label_position(label):
+    """Estimates the position of a label among all labels as an integer in
+    [0, (len(_NAME_ALPHABET)+1)**_POSITION_DIGITS), assuming that they are
+    made up of _NAME_ALPHABET"""
+    value = 0
+    for i in range(_POSITION_DIGITS):
+        value *= len(_NAME_ALPHABET) + 1
+        if i < len(label):
+            value += bisect.bisect_right(_NAME_ALPHABET, label[i])
+    return value
+
+def _label_at_position(value):
+    """Inverse of _label_position()"""
+    label = bytearray()
+    for i in range(_POSITION_DIGITS):
+        value, digit = divmod(value, len(_NAME_ALPHABET) + 1)
+        label.insert(0, _NAME_ALPHABET[max(0, digit - 1)])
+    return bytes(label).rstrip(_NAME_ALPHABET[:1]) or _NAME_ALPHABET[:1]
+
+
+class _Segment(object):
+    """Range [start, end) of the namespace walked by a single walker
+
+    Also serves as the walker's output file. Only records whose owner name
+    lies within the range belong to the segment: the first record a walker
+    receives covers its start name and usually belongs to the previous
+    segment, it is not written twice. start is None for the first segment.
+    """
+    def __init__(self, parallel_walker, start, end, is_seed):
+        self._parallel_walker = parallel_walker
+        self.start = start
+        self.end = end
+        # start is not known to exist in the zone
+        self.is_seed = is_seed
+        # the next name the walker is going to query for
+        self.position = start
+        self.walker = None
+
+    def owns(self, record):
+        return ((self.start is None or record.owner >= self.start) and
+                (self.end is None or record.owner < self.end))
+
+    def write_record(self, record):
+        self._parallel_walker._add_record(self, record)
+
+    def __str__(self):
+        return '{} - {}'.format(str(self.start) if self.start is not None
+                else 'start', str(self.end) if self.end is not None else 'end')
+
+
+class NSECWalkerParallel(NSECWalker):
+    """Walks several ranges of the zone's namespace concurrently
+
+    The namespace between the start and end name is split into num_walkers
+    segments at evenly spread names made up of digits and lowercase letters,
+    the most common characters in owner names. Each segment is walked by
+    its own walker_class instance in a separate thread, all sharing the same
+    queryprovider. A segment walker stops as soon as it reaches the start of
+    the next segment, where the partial chains are joined.
+
+    Names are rarely spread evenly, so a thread that finished its segment
+    takes over the second half of the remaining range of the segment which
+    has the most left, as estimated from the names learned so far. If
+    nsec_chain is given, only the gaps in the chain are walked.
+    """
+    def __init__(self, zone, queryprovider, walker_class, num_walkers,
+            walker_args=None, nsec_chain=None, startname=None, endname=None,
+            output_file=None, stats=None):
+        super(NSECWalkerParallel, self).__init__(zone, queryprovider,
+                nsec_chain, startname, endname, output_file, stats)
+        self.walker_class = walker_class
+        self.walker_args = walker_args if walker_args is not None else {}
+        self.num_walkers = num_walkers
+        # unlike self.start, this does not depend on nsec_chain
+        self.range_start = self._get_range_start(startname)
+        # protects the segments, self.nsec_chain and the output file
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._running = []
+        self._aborted = False
+
+    def _get_range_start(self, startname):
+        if startname is None:
+            return self.zone
+        return name.DomainName(*(name.domainname_from_text(startname).labels +
+            self.zone.labels))
+
+    def walk(self):
+        log.info("starting enumeration using {0:d} parallel walkers..."
+                .format(self.num_walkers))
+        return super(NSECWalkerParallel, self).walk()
+
+    def _add_record(self, segment, record):
+        with self._lock:
+            if self._aborted:
+                raise NSECWalkError('enumeration aborted')
+            if segment.owns(record):
+                self._write_record(record)
+                self.nsec_chain.append(record)
+            if record.next_owner > segment.position:
+                segment.position = record.next_owner
+
+    def _seeds(self):
+        """Returns num_walkers-1 names evenly spread over the names made up
+        of _NAME_ALPHABET"""
+        total = (len(_NAME_ALPHABET) + 1)**_POSITION_DIGITS
+        seeds = []
+        for i in range(1, self.num_walkers):
+            seed = self._name(_label_at_position(i*total//self.num_walkers))
+            if len(seeds) == 0 or seeds[-1] < seed:
+                seeds.append(seed)
+        return seeds
+
+    def _gaps(self):
+        """Returns the parts of the range to walk not covered by the known
+        records as (start, end) tuples. end is None for the end of the
+        zone."""
+        gaps = []
+        pos = self.range_start
+        for record in self.nsec_chain:
+            if self.end is not None and pos >= self.end:
+                return gaps
+            if record.owner > pos:
+                gaps.append((pos, record.owner if self.end is None
+                    else min(record.owner, self.end)))
+            if record.next_owner <= record.owner:
+                # last record of the zone
+                return gaps
+            pos = max(pos, record.next_owner)
+        if self.end is None or pos < self.end:
+            gaps.append((pos, self.end))
+        return gaps
+
+    def _segments(self):
+        seeds = self._seeds()
+        segments = []
+        for start, end in self._gaps():
+            is_seed = False
+            for seed in seeds:
+                if seed > start and (end is None or seed < end):
+                    segments.append(_Segment(self, start, seed, is_seed))
+                    start = seed
+                    is_seed = True
+            segments.append(_Segment(self, start, end, is_seed))
+        # like a sequential walk, keep the record covering the start name
+        if len(segments) > 0 and segments[0].start == self.range_start:
+            segments[0].start = None
+        return segments
+
+    def _remaining(self, segment):
+        """Returns the estimated (position, end) of the part of segment that
+        has not been walked yet"""
+        pos = _label_position(self._top_label(segment.position))
+        if segment.end is not None:
+            end = _label_position(self._top_label(segment.end))
+        else:
+            end = (len(_NAME_ALPHABET) + 1)**_POSITION_DIGITS
+        return (pos, end)
+
+    def _split(self, segment):
+        """Splits off the second half of the part of segment that has not
+        been walked yet. Must be called with self._lock held. Returns the
+        new segment or None if it is too small to be split."""
+        pos, end = self._remaining(segment)
+        middle = self._name(_label_at_position((pos + end)//2))
+        if (self._top_label(middle) <= self._top_label(segment.position) or
+                (segment.end is not None and middle >= segment.end)):
+            return None
+        new_segment = _Segment(self, middle, segment.end, True)
+        segment.end = middle
+        if segment.walker is not None:
+            segment.walker.end = middle
+        return new_segment
+
+    def _next_segment(self):
+        with self._lock:
+            if len(self._pending) > 0:
+                segment = self._pending.popleft()
+            else:
+                segment = None
+                def size(s):
+                    pos, end = self._remaining(s)
+                    return end - pos
+                for running in sorted(self._running, key=size, reverse=True):
+                    segment = self._split(running)
+                    if segment is not None:
+                        log.debug1("splitting segment ", str(running),
+                                " at ", str(segment.start))
+                        break
+            if segment is not None:
+                self._running.append(segment)
+            return segment
+
+    def _first_name(self, seed):
+        """Returns the first name in the zone >= seed, or None if there is
+        none. The seeds are made up, but NSEC and mixed query mode have to
+        start at an existing name."""
+        nresult = self._query(seed, rrtype='A')
+        (status, covering_nsec, subzone) = nresult.extract()
+        if status == ResultStatus.OK:
+            nresult.ns.reset_errors()
+            if covering_nsec.next_owner <= covering_nsec.owner:
+                return None
+            return covering_nsec.next_owner
+        if status == ResultStatus.HITOWNER:
+            nresult.ns.reset_errors()
+        # let the segment walker deal with everything else
+        return seed
+
+    def _walk_segment(self, segment):
+        if segment.is_seed:
+            first = self._first_name(segment.start)
+        else:
+            first = (segment.start if segment.start is not None else
+                    self.range_start)
+        with self._lock:
+            if first is None or (segment.end is not None and
+                    first >= segment.end):
+                log.debug1("segment ", str(segment), " is empty")
+                return
+            log.debug1("walking segment ", str(segment))
+            segment.position = first
+            segment.walker = self.walker_class(self.zone, self.queryprovider,
+                    startname=first, endname=segment.end,
+                    output_file=segment, stats=self.stats, **self.walker_args)
+        segment.walker._walk_zone()
+
+    def _worker(self, errors):
+        while True:
+            segment = self._next_segment()
+            if segment is None:
+                return
+            try:
+                self._walk_segment(segment)
+            except BaseException as e:
+                with self._lock:
+                    if not self._aborted:
+                        errors.append(e)
+                        self._aborted = True
+                return
+            finally:
+                with self._lock:
+                    self._running.remove(segment)
+
+    def _stitch(self):
+        """Sorts the records of all segments into one chain and checks that
+        the segments meet"""
+        chain = []
+        for record in sorted(self.nsec_chain, key=lambda x: x.owner):
+            if len(chain) > 0 and chain[-1].owner == record.owner:
+                continue
+            chain.append(record)
+        for record, following in zip(chain, chain[1:]):
+            if record.next_owner != following.owner:
+                log.warn("NSEC chain is not contiguous between ",
+                        str(record.owner), " and ", str(following.owner),
+                        ", the zone may have changed during enumeration")
+        return chain
+
+    def _walk_zone(self):
+        self._pending.extend(self._segments())
+        errors = []
+        threads = []
+        for i in range(self.num_walkers):
+            t = threading.Thread(target=self._worker, args=(errors,))
+            # don't keep the process alive if the main thread is interrupted
+            t.daemon = True
+            threads.append(t)
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        except BaseException:
+            with self._lock:
+                self._aborted = True
+            raise
+        if len(errors) > 0:
+            raise errors[0]
+        self.nsec_chain = self._stitch()
+        return self.nsec_chain
@@ -1,12 +1,22 @@
+import array
+import bisect
 import gc
+import itertools
 import multiprocessing
 import os
+import platform
 import sys
+import threading
+import time
+
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
 
 from . import log
 from . import rrtypes
 from . import name
 from .name import DomainName,Label
+from .rrtypes.nsec3 import SHA1_LENGTH
 
 
 HAS_NSEC3HASH = False
@@ -16,6 +26,38 @@ try:
 except ImportError:
     pass
 
+# label counters are passed to the walker as unsigned 64 bit integers
+MAX_LABEL_COUNTER = 2**64-1
+
+def _no_fence():
+    pass
+
+# x86 keeps stores in order with other stores and loads in order with other
+# loads (total store order), which is all the ring buffers need. Other
+# architectures need a memory barrier from the C extension, or a lock if it
+# is not available.
+_TSO_MACHINES = ('x86_64', 'amd64', 'x86', 'i386', 'i486', 'i586', 'i686')
+
+if HAS_NSEC3HASH:
+    _memory_fence = nsec3hash.memory_fence
+elif platform.machine().lower() in _TSO_MACHINES:
+    _memory_fence = _no_fence
+else:
+    _memory_fence = None
+
+def _ring_lock():
+    """Returns the lock to be shared by the two ends of a HashRing, or None
+    if the ring can rely on memory barriers"""
+    if _memory_fence is None:
+        return multiprocessing.Lock()
+    return None
+
+def _attach_shm(name):
+    """Attaches to a shared memory segment owned by the walker"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
 def _process_label_generator(label_fun, gap, process_id, num_processes, init=0):
     start = l = int(process_id*gap+init)
     end = start + gap
@@ -28,84 +70,662 @@ def _process_label_generator(label_fun, gap, process_id, num_processes, init=0):
         yield (lblstr, l)
         l += 1
 
+# number of slots in the ring buffer of each prehash process
+RING_SLOTS = 16
+# maximum time to sleep while waiting for a ring buffer slot (in seconds)
+RING_MAX_WAIT = 0.005
+# a prehash process ships an element once it has found element_size
+# uncovered hashes, has tested ELEMENT_MAX_TESTED*element_size hashes or
+# ELEMENT_MAX_DELAY seconds have passed
+ELEMENT_MAX_TESTED = 64
+ELEMENT_MAX_DELAY = 0.1
+
+
+class HashRing(object):
+    """Single-producer single-consumer ring buffer in shared memory
+
+    Each slot holds up to element_size label counters (unsigned 64 bit
+    integers in native byte order) followed by the corresponding digests,
+    the number of hashes tested to produce them and the last label counter
+    tested. The producer only ever writes the head index, the consumer only
+    the tail index, so no locking is needed. A slot is published by
+    incrementing the head after its contents have been written, with a
+    memory barrier in between.
+
+    Without a memory barrier on a CPU that may reorder stores, both ends
+    hold lock while accessing the ring (see _ring_lock()). Locks cannot be
+    pickled, so a process receiving the ring through a pipe has to set lock
+    to the one it inherited.
+    """
+    # head and tail live on separate cache lines
+    _HEAD = 0
+    _TAIL = 8
+    _HEADER_SIZE = 128
+
+    def __init__(self, element_size, nslots=RING_SLOTS, lock=None):
+        self.element_size = element_size
+        self.lock = lock
+        self.nslots = nslots
+        self._counters_size = element_size*8
+        self._digests_size = element_size*SHA1_LENGTH
+        # slot layout: count, tested, last counter, counters, digests
+        # (padded to 64 bytes)
+        self._slot_size = ((24 + self._counters_size + self._digests_size
+                + 63) & ~63)
+        self._shm = shared_memory.SharedMemory(create=True,
+                size=self._HEADER_SIZE + nslots*self._slot_size)
+        self._setup()
+        self._index[self._HEAD] = 0
+        self._index[self._TAIL] = 0
+
+    def _setup(self):
+        self._buf = self._shm.buf
+        self._index = self._buf[:self._HEADER_SIZE].cast('Q')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_buf', '_index', '_shm'):
+            del state[k]
+        state['_shm_name'] = self._shm.name
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self._shm = _attach_shm(state.pop('_shm_name'))
+        self.__dict__.update(state)
+        self._setup()
+
+    def _slot(self, i):
+        return self._HEADER_SIZE + (i % self.nslots)*self._slot_size
+
+    def full(self):
+        return self._index[self._HEAD] - self._index[self._TAIL] >= self.nslots
+
+    def put(self, counters, digests, tested, last):
+        """Write one element, waits until a slot is free."""
+        wait = 0.0001
+        while not self._put(counters, digests, tested, last):
+            time.sleep(wait)
+            wait = min(wait*2, RING_MAX_WAIT)
+
+    def _put(self, counters, digests, tested, last):
+        if self.lock is not None:
+            with self.lock:
+                return self._put_fenced(counters, digests, tested, last,
+                        _no_fence)
+        return self._put_fenced(counters, digests, tested, last,
+                _memory_fence)
+
+    def _put_fenced(self, counters, digests, tested, last, fence):
+        index = self._index
+        head = index[self._HEAD]
+        if head - index[self._TAIL] >= self.nslots:
+            return False
+        # the consumer must be done with the slot before it is overwritten
+        fence()
+        off = self._slot(head)
+        count = len(counters)//8
+        buf = self._buf
+        buf[off:off+24] = array.array('Q', (count, tested, last)).tobytes()
+        off += 24
+        buf[off:off+len(counters)] = counters
+        off += self._counters_size
+        buf[off:off+len(digests)] = digests
+        fence()
+        index[self._HEAD] = head + 1
+        return True
+
+    def get_nowait(self):
+        """Returns the oldest element as (counters, digests, tested, last)
+        or None."""
+        if self.lock is not None:
+            with self.lock:
+                return self._get_fenced(_no_fence)
+        return self._get_fenced(_memory_fence)
+
+    def _get_fenced(self, fence):
+        index = self._index
+        tail = index[self._TAIL]
+        if tail == index[self._HEAD]:
+            return None
+        fence()
+        off = self._slot(tail)
+        buf = self._buf
+        count, tested, last = buf[off:off+24].cast('Q')
+        off += 24
+        counters = bytes(buf[off:off+count*8])
+        off += self._counters_size
+        digests = bytes(buf[off:off+count*SHA1_LENGTH])
+        fence()
+        index[self._TAIL] = tail + 1
+        return (counters, digests, tested, last)
+
+    def close(self):
+        self._index.release()
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class HashRingSet(object):
+    """Collects elements from the ring buffers of all prehash processes
+
+    Rings are polled in turn, starting after the one that was read last, so
+    that a slow process does not stall the others.
+    """
+    def __init__(self, rings):
+        self._rings = list(rings)
+        self._next = 0
+
+    def get(self):
+        rings = self._rings
+        n = len(rings)
+        wait = 0.0001
+        while True:
+            for i in range(n):
+                j = (self._next + i) % n
+                element = rings[j].get_nowait()
+                if element is not None:
+                    self._next = (j + 1) % n
+                    return element
+            time.sleep(wait)
+            wait = min(wait*2, RING_MAX_WAIT)
+
+
+class CoverageSnapshot(object):
+    """Covered intervals of an NSEC3 chain, shared with the prehash processes
+
+    The walker publishes the intervals returned by
+    NSEC3Chain.covered_intervals() so that the prehash processes can drop
+    covered hashes themselves. The sequence number in the header is odd
+    while an update is in progress, readers retry if it changed while they
+    were copying. Without a memory barrier on a CPU that may reorder stores,
+    a reader can see a torn snapshot; this only makes a prehash process drop
+    some uncovered hashes, which the walker does not depend on.
+
+    If the intervals do not fit anymore, a segment of twice the size is
+    created and the prehash processes have to be told its name. Old segments
+    are only unlinked by release(), so a reader can always attach to a name
+    it was given.
+    """
+    _SEQ = 0
+    _COUNT = 1
+    _CAPACITY = 2
+    _HEADER_SIZE = 64
+
+    def __init__(self, capacity=1024):
+        self._segments = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        shm = shared_memory.SharedMemory(create=True, size=self._HEADER_SIZE +
+                2*capacity*SHA1_LENGTH)
+        header = shm.buf[:self._HEADER_SIZE].cast('Q')
+        header[self._SEQ] = 0
+        header[self._COUNT] = 0
+        header[self._CAPACITY] = capacity
+        self._segments.append((shm, header))
+
+    @property
+    def name(self):
+        return self._segments[-1][0].name
+
+    def publish(self, starts, ends):
+        """Publishes a new set of intervals
+
+        Returns True if a new segment had to be created.
+        """
+        count = len(starts)//SHA1_LENGTH
+        capacity = self._segments[-1][1][self._CAPACITY]
+        resized = False
+        if count > capacity:
+            while capacity < count:
+                capacity *= 2
+            self._allocate(capacity)
+            resized = True
+        shm, header = self._segments[-1]
+        buf = shm.buf
+        fence = _memory_fence or _no_fence
+        seq = header[self._SEQ]
+        header[self._SEQ] = seq + 1
+        fence()
+        off = self._HEADER_SIZE
+        buf[off:off+len(starts)] = starts
+        off += capacity*SHA1_LENGTH
+        buf[off:off+len(ends)] = ends
+        header[self._COUNT] = count
+        fence()
+        header[self._SEQ] = seq + 2
+        return resized
+
+    def release(self):
+        for shm, header in self._segments:
+            header.release()
+            shm.close()
+            shm.unlink()
+        self._segments = []
+
+
+class CoverageReader(object):
+    """Read side of a CoverageSnapshot, used by the prehash processes"""
+    def __init__(self):
+        self._shm = None
+        self._header = None
+        self._seq = None
+        self.count = 0
+        self.starts = b''
+        self.ends = b''
+        self._lists = None
+
+    def attach(self, name):
+        try:
+            shm = _attach_shm(name)
+        except FileNotFoundError:
+            # the walker has already released the snapshot
+            return
+        self.close()
+        self._shm = shm
+        self._header = shm.buf[:CoverageSnapshot._HEADER_SIZE].cast('Q')
+        self._seq = None
+
+    def close(self):
+        if self._shm is not None:
+            self._header.release()
+            self._shm.close()
+            self._shm = None
+
+    def update(self):
+        """Copies the intervals if the snapshot has changed
+
+        Returns True if new intervals were read.
+        """
+        if self._shm is None:
+            return False
+        fence = _memory_fence or _no_fence
+        header = self._header
+        seq = header[CoverageSnapshot._SEQ]
+        if seq == self._seq or seq & 1:
+            return False
+        fence()
+        count = header[CoverageSnapshot._COUNT]
+        size = count*SHA1_LENGTH
+        buf = self._shm.buf
+        off = CoverageSnapshot._HEADER_SIZE
+        starts = bytes(buf[off:off+size])
+        off += header[CoverageSnapshot._CAPACITY]*SHA1_LENGTH
+        ends = bytes(buf[off:off+size])
+        fence()
+        if header[CoverageSnapshot._SEQ] != seq:
+            return False
+        self._seq = seq
+        self.count = count
+        self.starts = starts
+        self.ends = ends
+        self._lists = None
+        return True
+
+    def interval_lists(self):
+        """Returns the interval boundaries as a tuple of lists (starts, ends)"""
+        if self._lists is None:
+            n = SHA1_LENGTH
+            self._lists = ([self.starts[i:i+n]
+                                for i in range(0, len(self.starts), n)],
+                           [self.ends[i:i+n]
+                                for i in range(0, len(self.ends), n)])
+        return self._lists
+
+
+def _filter_uncovered(counters, digests, starts, ends):
+    """Python-based equivalent of nsec3hash.filter_uncovered()
+
+    starts and ends are lists of the interval boundaries.
+    """
+    n = SHA1_LENGTH
+    counters = memoryview(counters).cast('Q')
+    rcounters = array.array('Q')
+    rdigests = bytearray()
+    for i in range(len(counters)):
+        h = digests[i*n:(i+1)*n]
+        j = bisect.bisect_right(starts, h) - 1
+        if j < 0 or h > ends[j]:
+            rcounters.append(counters[i])
+            rdigests += h
+    return (rcounters.tobytes(), bytes(rdigests))
+
+
+def release_hash_rings(rings):
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+
+
 def create_prehash_pool(num_processes, element_size,
-        use_cext):
+        use_cext, use_simd=True):
+    _log_simd_backend(use_cext, use_simd)
     processes = []
     hash_queues = []
     for i in range(num_processes):
         par,chld = multiprocessing.Pipe(True)
-        p = PreHashProcess(chld, element_size, i, name.hex_label,
-                num_processes, use_cext)
+        # the last batch hashed for an element may exceed element_size
+        ring = HashRing(2*element_size, lock=_ring_lock())
+        p = PreHashProcess(chld, ring, element_size, i, name.hex_label,
+                num_processes, use_cext, use_simd)
         p.start()
         processes.append((par,p))
-        hash_queues.append(par)
+        hash_queues.append(ring)
+
+    return hash_queues, PrehashProcesses(processes)
+
+def _log_simd_backend(use_cext, use_simd):
+    if use_cext and use_simd and HAS_NSEC3HASH:
+        backend = nsec3hash.simd_backend()
+        if backend is not None:
+            log.debug1("using multi-buffer SHA-1 implementation: ", backend)
+
+def _check_cext(use_cext):
+    if use_cext and not HAS_NSEC3HASH:
+        log.error("failed to import nsec3hash module, ",
+                  "falling back to Python-based hashing\n",
+                  "use --no-openssl to avoid printing this error")
+        return False
+    return use_cext
+
+
+class PrehashProcesses(object):
+    """Prehash processes working for a single walk, see create_prehash_pool()
+
+    The walker tells the processes which hashes to compute with start(), and
+    announces new coverage snapshot segments with coverage_resized().
+    """
+    def __init__(self, processes):
+        self._processes = processes
+
+    def start(self, label_counter_init, zone, salt, iterations,
+            coverage_name):
+        for pipe, proc in self._processes:
+            pipe.send((label_counter_init, zone, salt, iterations,
+                coverage_name))
+
+    def coverage_resized(self, coverage_name):
+        for pipe, proc in self._processes:
+            pipe.send(coverage_name)
+
+    def stop(self):
+        for pipe, proc in self._processes:
+            proc.terminate()
+
+
+class SharedPrehashPool(object):
+    """Prehash processes shared by several concurrent walks
+
+    Each walk opens a job, which is keyed by its zone, salt and iterations
+    once started. Every process works on all started jobs in turn and
+    computes an element for a job whenever its ring buffer has a free slot,
+    so the CPUs go to the walks that are actually waiting for hashes.
+    Methods may be called from several threads.
+    """
+    def __init__(self, num_processes, element_size, use_cext, use_simd=True):
+        _log_simd_backend(use_cext, use_simd)
+        self.element_size = element_size
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._processes = []
+        for i in range(num_processes):
+            par,chld = multiprocessing.Pipe(True)
+            p = SharedPreHashProcess(chld, element_size, i, name.hex_label,
+                    num_processes, use_cext, use_simd)
+            p.start()
+            self._processes.append((par, p))
+
+    def open_job(self):
+        """Returns the ring buffers of a new job, one per process, and the
+        SharedPrehashJob to be passed to the walker"""
+        with self._lock:
+            job_id = next(self._job_ids)
+        # the last batch hashed for an element may exceed element_size
+        rings = [HashRing(2*self.element_size, lock=p.ring_lock)
+                for pipe, p in self._processes]
+        return rings, SharedPrehashJob(self, job_id, rings)
+
+    def _send(self, messages):
+        with self._lock:
+            for (pipe, proc), msg in zip(self._processes, messages):
+                pipe.send(msg)
+
+    def close(self):
+        with self._lock:
+            for pipe, proc in self._processes:
+                proc.terminate()
+            self._processes = []
+
+
+class SharedPrehashJob(object):
+    """A single walk's share of a SharedPrehashPool, offers the same
+    interface as PrehashProcesses"""
+    def __init__(self, pool, job_id, rings):
+        self._pool = pool
+        self._id = job_id
+        self._rings = rings
+        self._started = False
+
+    def start(self, label_counter_init, zone, salt, iterations,
+            coverage_name):
+        self._pool._send([('open', self._id, ring, label_counter_init, zone,
+            salt, iterations, coverage_name) for ring in self._rings])
+        self._started = True
+
+    def coverage_resized(self, coverage_name):
+        self._pool._send([('coverage', self._id, coverage_name)
+            for ring in self._rings])
+
+    def stop(self):
+        if self._started:
+            self._pool._send([('close', self._id) for ring in self._rings])
+            self._started = False
 
-    return hash_queues, processes
+
+class _HashJob(object):
+    """Computes the hashes of a single zone within a prehash process
+
+    Labels are generated from the label counters assigned to process_id, see
+    _process_label_generator().
+    """
+    def __init__(self, ring, element_size, process_id, num_processes,
+            label_fun, use_cext, label_counter_init, zone, salt, iterations,
+            coverage_name):
+        self.ring = ring
+        self.element_size = element_size
+        self.zone = zone
+        self.salt = salt
+        self.iterations = iterations
+        self.coverage = CoverageReader()
+        self.coverage.attach(coverage_name)
+        if use_cext:
+            # HashGenerator always uses hex labels (see name.hex_label)
+            generator = nsec3hash.HashGenerator(
+                    self.zone.to_wire(), self.salt, self.iterations,
+                    init = label_counter_init, gap = 1024,
+                    process_id = process_id,
+                    num_processes = num_processes)
+            self._compute = lambda: generator.compute(element_size)
+            self._filter_uncovered = nsec3hash.filter_uncovered
+        else:
+            self.generator = _process_label_generator(label_fun = label_fun,
+                    gap = 1024, process_id = process_id,
+                    num_processes = num_processes, init = label_counter_init)
+            self._compute = self._compute_python
+            self._filter_uncovered = self._filter_uncovered_python
+
+    def _hash(self, dn):
+        return rrtypes.nsec3.compute_hash(dn, self.salt,
+                self.iterations)
+
+    def _compute_python(self):
+        """Python-based equivalent of nsec3hash.HashGenerator.compute()"""
+        counters = array.array('Q')
+        digests = bytearray()
+        for i in range(self.element_size):
+            ptlabel, counter = next(self.generator)
+            dn = DomainName(Label(ptlabel), *self.zone.labels)
+            digests += self._hash(dn)
+            counters.append(counter)
+        return (counters.tobytes(), bytes(digests))
+
+    def _filter_uncovered_python(self, counters, digests, starts, ends):
+        return _filter_uncovered(counters, digests,
+                *self.coverage.interval_lists())
+
+    def next_element(self, poll):
+        """Computes the next element for the walker, calling poll() before
+        each batch to process pending messages
+
+        An element consists of the uncovered hashes, i.e. the label counters
+        packed as unsigned 64 bit integers in native byte order and the
+        concatenated hashes, the number of hashes tested and the last label
+        counter tested.
+        """
+        element_size = self.element_size
+        max_tested = ELEMENT_MAX_TESTED*element_size
+        coverage = self.coverage
+        counters = bytearray()
+        digests = bytearray()
+        tested = 0
+        deadline = time.monotonic() + ELEMENT_MAX_DELAY
+        while True:
+            poll()
+            coverage.update()
+            c, d = self._compute()
+            tested += len(c)//8
+            last = int.from_bytes(c[-8:], sys.byteorder)
+            if coverage.count > 0:
+                c, d = self._filter_uncovered(c, d, coverage.starts,
+                        coverage.ends)
+            counters += c
+            digests += d
+            if (len(counters) >= element_size*8 or tested >= max_tested
+                    or time.monotonic() >= deadline):
+                return (counters, digests, tested, last)
+
+    def close(self):
+        self.coverage.close()
+        self.ring.close()
 
 
 class PreHashProcess(multiprocessing.Process):
-    def __init__ (self, pipe, element_size,
-            process_id, label_fun, num_processes,  use_cext):
+    def __init__ (self, pipe, ring, element_size,
+            process_id, label_fun, num_processes,  use_cext, use_simd=True):
         multiprocessing.Process.__init__(self)
         # Kills this Process when parent exits
         self.daemon = True
 
         self.pipe = pipe
+        self.ring = ring
+        self.ring_lock = ring.lock if ring is not None else _ring_lock()
         self.id = process_id
         self.element_size = element_size
-        self.use_cext = use_cext
+        self.use_cext = _check_cext(use_cext)
+        self.use_simd = use_simd
         self.label_fun = label_fun
         self.num_processes = num_processes
+        self.job = None
 
-        if self.use_cext and not HAS_NSEC3HASH:
-            log.error("failed to import nsec3hash module, ",
-                      "falling back to Python-based hashing\n",
-                      "use --no-openssl to avoid printing this error")
-            self.use_cext = False
-
-        self.zone = None
-        self.generator = None
-        self.salt = None
-        self.iterations = None
+    def _setup(self):
+        os.nice(15)
+        gc.collect()
+        log.logger = None
+        # the walker owns all shared memory segments. If attaching to one
+        # registered it with the resource tracker again, the registration
+        # could arrive after the walker unregistered and unlinked it, and
+        # the tracker would complain at exit. Python 3.13 can attach without
+        # tracking (see _attach_shm()).
+        if sys.version_info < (3, 13):
+            resource_tracker.register = lambda name, rtype: None
+        if self.ring is not None:
+            self.ring.lock = self.ring_lock
+        if self.use_cext and not self.use_simd:
+            nsec3hash.set_simd_backend(None)
 
     def run(self):
         try:
-            os.nice(15)
-            gc.collect()
-            log.logger = None
-            (label_counter_init,  self.zone, self.salt,
-                    self.iterations) = self.pipe.recv()
-            self.generator = _process_label_generator(label_fun =
-                    self.label_fun, gap = 1024, process_id = self.id,
-                    num_processes = self.num_processes,
-                    init = label_counter_init)
-            if self.use_cext:
-                self._precompute_hashes(self._hash_cext)
-            else:
-                self._precompute_hashes(self._hash)
+            self._setup()
+            (label_counter_init, zone, salt, iterations,
+                    coverage_name) = self.pipe.recv()
+            self.job = _HashJob(self.ring, self.element_size, self.id,
+                    self.num_processes, self.label_fun, self.use_cext,
+                    label_counter_init, zone, salt, iterations,
+                    coverage_name)
+            while True:
+                self.ring.put(*self.job.next_element(self._update_coverage))
         except KeyboardInterrupt:
             sys.exit(3)
 
+    def _update_coverage(self):
+        """Attaches to the latest coverage snapshot announced by the
+        walker"""
+        name = None
+        while self.pipe.poll():
+            name = self.pipe.recv()
+        if name is not None:
+            self.job.coverage.attach(name)
 
-    def _hash(self, dn):
-        return rrtypes.nsec3.compute_hash(dn, self.salt,
-                self.iterations)
 
-    def _hash_cext(self, dn):
-        return nsec3hash.compute_hash(dn.to_wire(), self.salt,
-                self.iterations)
+class SharedPreHashProcess(PreHashProcess):
+    """Prehash process of a SharedPrehashPool
 
-    def _precompute_hashes(self, hash_func):
-        counter_state = 0
-        element_size = self.element_size
-        generator = self.generator
-        while True:
-            element = []
-            for i in range(element_size):
-                ptlabel, counter_state = next(generator)
-                dn = DomainName(Label(ptlabel), *self.zone.labels)
-                hashed_owner =  hash_func(dn)
-                element.append((ptlabel,hashed_owner))
+    Receives ('open', job id, ring, label counter, zone, salt, iterations,
+    coverage name), ('coverage', job id, coverage name) and ('close', job
+    id) messages.
+    """
+    def __init__ (self, pipe, element_size, process_id, label_fun,
+            num_processes, use_cext, use_simd=True):
+        super(SharedPreHashProcess, self).__init__(pipe, None, element_size,
+                process_id, label_fun, num_processes, use_cext, use_simd)
+        self.jobs = {}
+        self._closed = set()
 
-            self.pipe.send((element, counter_state))
+    def run(self):
+        try:
+            self._setup()
+            while True:
+                self._poll(block=len(self.jobs) == 0)
+                busy = False
+                for job_id, job in list(self.jobs.items()):
+                    if job_id in self._closed or job.ring.full():
+                        continue
+                    element = job.next_element(self._poll)
+                    if job_id not in self._closed:
+                        job.ring.put(*element)
+                    busy = True
+                for job_id in self._closed:
+                    job = self.jobs.pop(job_id, None)
+                    if job is not None:
+                        job.close()
+                self._closed.clear()
+                if not busy:
+                    # all walks are busy with the hashes they already have
+                    time.sleep(RING_MAX_WAIT)
+        except KeyboardInterrupt:
+            sys.exit(3)
 
+    def _poll(self, block=False):
+        while block or self.pipe.poll():
+            block = False
+            try:
+                msg = self.pipe.recv()
+            except FileNotFoundError:
+                # the ring buffer of a job that was stopped right away has
+                # already been released
+                continue
+            if msg[0] == 'open':
+                msg[2].lock = self.ring_lock
+                self.jobs[msg[1]] = _HashJob(msg[2], self.element_size,
+                        self.id, self.num_processes, self.label_fun,
+                        self.use_cext, *msg[3:])
+            elif msg[0] == 'coverage':
+                job = self.jobs.get(msg[1])
+                if job is not None:
+                    job.coverage.attach(msg[2])
+            elif msg[0] == 'close':
+                self._closed.add(msg[1])
@@ -1,10 +1,16 @@
 import struct
 import itertools
+import ipaddress
+import select
+import socket
+import time
 
 import dns.resolver
+import dns.entropy
 import dns.exception
 import dns.message
 import dns.name
+import dns.opcode
 import dns.query
 import dns.rcode
 import dns.rdataclass
@@ -17,6 +23,7 @@ from .rrtypes import nsec
 from . import rrtypes
 from . import exception
 from . import log
+from .wireresult import WireResult
 
 def _rrtypes_from_window_list(window_list):
     # see RFC 3845, section 2.1.2 "The List of Type Bit Map(s) Field"
@@ -137,33 +144,242 @@ class DNSPythonResult(object):
                     _rrtypes_to_text(types)))
         return nsec3
 
-def dnspython_query(dname, ns_ip, ns_port, rrtype, timeout):
-    # XXX:
-    qname = dns.name.from_wire(dname.to_wire(), 0)[0]
+_HEADER = struct.Struct('!HHHHHH')
+_HEADER_LENGTH = _HEADER.size
+# OPT pseudo-RR: root owner name, 4096 bytes UDP payload, DO bit set
+_EDNS_OPT = b'\x00' + struct.pack('!HHIH', dns.rdatatype.OPT, 4096,
+        dns.flags.DO, 0)
+# rcodes which may come without a question section, see
+# dns.message.Message.is_response()
+_RCODES_NO_QUESTION = (dns.rcode.FORMERR, dns.rcode.SERVFAIL,
+        dns.rcode.NOTIMP, dns.rcode.REFUSED)
 
-    q = dns.message.make_query(qname,
-                               rrtype,
-                               want_dnssec=True,
-                               payload = 4096)
-    r = dns.query.udp(q, ns_ip, port=ns_port, timeout=timeout,
-            ignore_unexpected=True)
-    if r.flags & dns.flags.TC:
-        r = dns.query.tcp(q, ns_ip, port=ns_port, timeout=timeout)
+class QueryTemplate(object):
+    """Pre-encoded query for names below a fixed parent name
 
-    return DNSPythonResult(r)
+    The header, the remainder of the question and the EDNS OPT record are
+    the same as dns.message.make_query(qname, rrtype, want_dnssec=True,
+    payload=4096) would produce. Only the first label of the query name and
+    the message ID are filled in per query.
+    """
+    def __init__(self, parent_wire, rrtype):
+        self._question_end = (parent_wire +
+                struct.pack('!HH', dns.rdatatype.from_text(rrtype),
+                    dns.rdataclass.IN))
 
+    def to_wire(self, label, msgid):
+        return (_HEADER.pack(msgid, dns.flags.RD, 1, 0, 0, 1) +
+                label.to_wire() + self._question_end + _EDNS_OPT)
 
-def query(dname, ns, rrtype, timeout):
+_query_templates = {}
+
+def query_wire(dname, rrtype, msgid=None):
+    """Returns the wire format of a query for dname"""
+    key = (tuple([l.label for l in dname.labels[1:]]), rrtype)
+    template = _query_templates.get(key)
+    if template is None:
+        parent_wire = b''.join([l.to_wire() for l in dname.labels[1:]])
+        template = QueryTemplate(parent_wire, rrtype)
+        _query_templates[key] = template
+    if msgid is None:
+        msgid = dns.entropy.random_16()
+    return template.to_wire(dname.labels[0], msgid)
+
+def wire_is_response(request, response):
+    """Checks whether response answers the query request, both in wire
+    format. Like dns.message.Message.is_response(), but without parsing
+    either message."""
+    if len(response) < _HEADER_LENGTH:
+        return False
+    (msgid, flags, qdcount, ancount, nscount,
+            arcount) = _HEADER.unpack_from(response)
+    if (response[:2] != request[:2] or not flags & dns.flags.QR or
+            dns.opcode.from_flags(flags) != dns.opcode.QUERY):
+        return False
+    if qdcount == 0:
+        return (flags & 0xf) in _RCODES_NO_QUESTION
+    question_end = len(request) - len(_EDNS_OPT)
+    return (qdcount == 1 and
+            response[_HEADER_LENGTH:question_end].lower() ==
+            request[_HEADER_LENGTH:question_end])
+
+class _PendingUDPQuery(object):
+    """A query sent over UDP from its own socket, waiting for the response"""
+    def __init__(self, request, ns_ip, ns_port):
+        self.request = request
+        self.ns_ip = ns_ip
+        self.ns_port = ns_port
+        self.sent = time.monotonic()
+        self._ip = ipaddress.ip_address(ns_ip)
+        family = socket.AF_INET6 if self._ip.version == 6 else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self._sock.setblocking(False)
+            self._sock.sendto(request, (ns_ip, ns_port))
+        except:
+            self._sock.close()
+            raise
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def receive(self):
+        """Reads the datagrams waiting on the socket. Returns a WireResult
+        for the first response to the query, or None."""
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return None
+            # ignore unexpected responses, like dns.query.udp() does with
+            # ignore_unexpected=True
+            if (addr[1] != self.ns_port or
+                    ipaddress.ip_address(addr[0]) != self._ip or
+                    not wire_is_response(self.request, data)):
+                continue
+            try:
+                return WireResult(data)
+            except dns.exception.DNSException:
+                continue
+
+    def tcp_fallback(self, timeout, tcp_pool=None):
+        if tcp_pool is not None:
+            return tcp_pool.query(self.request, timeout)
+        return DNSPythonResult(dns.query.tcp(
+            dns.message.from_wire(self.request), self.ns_ip,
+            port=self.ns_port, timeout=timeout))
+
+    def close(self):
+        self._sock.close()
+
+def _wait_for_response(pending, expiration):
+    """Waits until one of the pending queries receives a response.
+    Returns a tuple (pending query, response). Raises dns.exception.Timeout
+    at expiration."""
+    while True:
+        timeleft = expiration - time.monotonic()
+        if timeleft <= 0:
+            raise dns.exception.Timeout
+        readable, _, _ = select.select(pending, [], [], timeleft)
+        for p in readable:
+            r = p.receive()
+            if r is not None:
+                return (p, r)
+
+def _poll_response(pending):
+    """Returns a tuple (pending query, response) if one of the pending
+    queries has already received a response, otherwise None"""
+    readable, _, _ = select.select(pending, [], [], 0)
+    for p in readable:
+        r = p.receive()
+        if r is not None:
+            return (p, r)
+    return None
+
+def dnspython_query(dname, ns_ip, ns_port, rrtype, timeout, tcp_pool=None):
+    """Sends the query over UDP, truncated responses are retried over TCP,
+    using tcp_pool (a tcppool.TCPPool) if given"""
+    p = _PendingUDPQuery(query_wire(dname, rrtype), ns_ip, ns_port)
     try:
-        res = dnspython_query(dname, ns.ip_str(), ns.port, rrtype, timeout)
-    except dns.exception.Timeout:
-        return exception.TimeOutError()
-    except dns.query.BadResponse:
-        return exception.QueryError()
+        r = _wait_for_response([p], p.sent + timeout)[1]
+    finally:
+        p.close()
+    if r.truncated():
+        r = p.tcp_fallback(timeout, tcp_pool)
+
+    return r
+
+def check_status(res):
+    """Returns res, or an UnexpectedResponseStatus error if the status is
+    neither NOERROR nor NXDOMAIN"""
     if res.status() != 'NOERROR' and res.status() != 'NXDOMAIN':
         return exception.UnexpectedResponseStatus(res.status())
     return res
 
+
+def query(dname, ns, rrtype, timeout, tcp_only=False):
+    try:
+        if tcp_only:
+            res = ns.tcp_pool.query(query_wire(dname, rrtype), timeout)
+        else:
+            res = dnspython_query(dname, ns.ip_str(), ns.port, rrtype,
+                    timeout, ns.tcp_pool)
+    except (dns.exception.Timeout, socket.timeout):
+        return exception.TimeOutError()
+    except (dns.query.BadResponse, dns.exception.FormError, OSError):
+        return exception.QueryError()
+    return check_status(res)
+
+def hedged_query(dname, ns, rrtype, timeout, hedge_delay, hedge):
+    """Like query(), but if ns did not respond within hedge_delay seconds,
+    the same query is also sent to the nameserver returned by hedge(), and
+    whichever response arrives first is used.
+
+    hedge() is called with a function that polls for the response of ns and
+    returns True if it has arrived in the meantime, e.g. while hedge() was
+    waiting for a rate limit. hedge() may return None to skip the hedged
+    query.
+
+    Returns a tuple (result, nameserver, round-trip time, missed). On
+    timeout, nameserver is ns and missed lists the hedged nameserver that
+    timed out as well. If the hedged query was answered first, missed lists
+    ns. Entries of missed are tuples (nameserver, seconds waited).
+    """
+    request = query_wire(dname, rrtype)
+    pending = []
+    servers = {}
+    missed = []
+    p = None
+    r = None
+    def answered():
+        nonlocal p, r
+        response = _poll_response(pending)
+        if response is None:
+            return False
+        p, r = response
+        return True
+
+    try:
+        p = _PendingUDPQuery(request, ns.ip_str(), ns.port)
+        pending.append(p)
+        servers[p] = ns
+        primary = p
+        expiration = p.sent + timeout
+        try:
+            p, r = _wait_for_response(pending,
+                    p.sent + min(hedge_delay, timeout))
+        except dns.exception.Timeout:
+            if hedge_delay >= timeout:
+                raise
+            hedge_ns = hedge(answered)
+            if r is None and hedge_ns is not None:
+                try:
+                    p = _PendingUDPQuery(request, hedge_ns.ip_str(),
+                            hedge_ns.port)
+                    pending.append(p)
+                    servers[p] = hedge_ns
+                    expiration = p.sent + timeout
+                except OSError as e:
+                    log.debug2("failed to send hedged query to ",
+                            str(hedge_ns), ": ", str(e))
+            if r is None:
+                p, r = _wait_for_response(pending, expiration)
+        rtt = time.monotonic() - p.sent
+        if p is not primary:
+            missed.append((ns, time.monotonic() - primary.sent))
+        if r.truncated():
+            r = p.tcp_fallback(timeout, servers[p].tcp_pool)
+    except (dns.exception.Timeout, socket.timeout):
+        if r is None:
+            missed = [(servers[q], timeout) for q in pending[1:]]
+        return (exception.TimeOutError(), ns, None, missed)
+    except (dns.query.BadResponse, dns.exception.FormError, OSError):
+        return (exception.QueryError(), servers.get(p, ns), None, [])
+    finally:
+        for q in pending:
+            q.close()
+    return (check_status(r), servers[p], rtt, missed)
+
 def query_ns_records(zone):
     try:
         log.info("looking up nameservers for zone ", str(zone))
@@ -1,4 +1,5 @@
 import collections
+import random
 import socket
 import time
 import itertools
@@ -11,6 +12,8 @@ from . import vis
 from .util import printsafe
 from . import query
 from . import log
+from . import tcppool
+from .asyncquery import AsyncQueryEngine
 from .exception import (
         N3MapError,
         InvalidPortError,
@@ -27,34 +30,137 @@ from .exception import (
 DEFAULT_PORT = 53
 QR_MEASUREMENTS = 256
 
+# nameserver selection policies
+NS_POLICIES = ('round-robin', 'latency', 'least-outstanding')
+
+# weights of new samples in the smoothed RTT, RTT variation and loss
+# estimates of a nameserver (see RFC 6298 for the RTT estimators)
+RTT_ALPHA = 0.125
+RTTVAR_BETA = 0.25
+LOSS_ALPHA = 0.1
+# lower bound of the expected RTT used for weighting nameservers
+MIN_RTT = 0.0001
+
+# adaptive query rate control, see AIMDRate
+AIMD_INITIAL_RATE = 10.0
+AIMD_MIN_RATE = 1.0
+# queries/s per second
+AIMD_INCREASE = 10.0
+AIMD_DECREASE = 0.5
+# response statuses which indicate an overloaded or rate-limiting server
+CONGESTION_STATUS = ('REFUSED', 'SERVFAIL')
+
+# number of recent RTT samples kept per nameserver
+RTT_SAMPLES = 64
+# queries are only hedged once this many RTT samples are available
+HEDGE_MIN_SAMPLES = 8
+
 
 class QueryProvider(object):
+    """Sends queries to a list of nameservers, handling timeouts, errors and
+    rate limits
+
+    query() may be called from several threads at once, e.g. by parallel
+    NSEC walkers. The nameserver selection, the statistics and the rate
+    limits are shared by all threads.
+
+    rate_limit is an optional RateLimit shared with other query providers,
+    e.g. those of the other zones in batch mode. shared_engine is passed
+    on to the query providers created by create_aggressive_qp().
+    """
     def __init__(self,
                  ns_list,
                  timeout,
                  max_retries,
                  max_errors = 1,
                  stats=None,
-                 query_interval=None):
+                 query_interval=None,
+                 ns_policy='round-robin',
+                 adaptive_rate=False,
+                 hedge_percentile=None,
+                 tcp_only=False,
+                 rate_limit=None,
+                 shared_engine=None):
+        if ns_policy not in NS_POLICIES:
+            raise ValueError("unknown nameserver policy: " + str(ns_policy))
         self.ns_list = ns_list
+        self.ns_policy = ns_policy
         self.next_ns_idx = 0
         self.timeout = timeout
         self.max_retries = max_retries
         self.max_errors = max_errors
         self.query_interval = query_interval
+        self.adaptive_rate = adaptive_rate
+        self.hedge_percentile = hedge_percentile
+        self.tcp_only = tcp_only
+        self.rate_limit = rate_limit
+        self.shared_engine = shared_engine
         self._last_query_time = None
+        # protects the nameserver list and statistics when query() is
+        # called from several threads
+        self._lock = threading.RLock()
+        if adaptive_rate:
+            # --limit-rate is the ceiling of every server's rate
+            ceiling = None if query_interval is None else 1.0/query_interval
+            for ns in ns_list:
+                if ns.rate_control is None:
+                    ns.rate_control = AIMDRate(ceiling=ceiling)
 
         self.stats = stats if stats is not None else {}
         self.stats['queries'] = 0
+        if hedge_percentile is not None:
+            self.stats['hedged_queries'] = 0
         self._qr_measurements = collections.deque(maxlen=QR_MEASUREMENTS)
 
     def _ns_cycle(self, step=1):
         self.next_ns_idx = (self.next_ns_idx + step) % len(self.ns_list)
 
-    def _next_ns(self):
-        ns = self.ns_list[self.next_ns_idx]
+    def _next_ns(self, exclude=None):
+        """Returns the next nameserver according to the nameserver policy,
+        other than exclude. Returns None if there is no other server."""
+        with self._lock:
+            if exclude is not None and all(ns is exclude
+                    for ns in self.ns_list):
+                return None
+            if self.ns_policy == 'latency':
+                return self._next_ns_latency(exclude)
+            if self.ns_policy == 'least-outstanding':
+                return self._next_ns_least_outstanding(exclude)
+            ns = self.ns_list[self.next_ns_idx]
+            self._ns_cycle()
+            if ns is exclude:
+                ns = self.ns_list[self.next_ns_idx]
+                self._ns_cycle()
+            return ns
+
+    def _next_ns_latency(self, exclude=None):
+        """Picks a nameserver at random, weighted by 1/rtt^2 where rtt is the
+        expected round-trip time including timeouts caused by packet loss.
+        Nameservers without measurements are treated like the fastest
+        one."""
+        ns_list = [ns for ns in self.ns_list if ns is not exclude]
+        rtts = [ns.expected_rtt(self.timeout) for ns in ns_list]
+        measured = [rtt for rtt in rtts if rtt is not None]
+        if len(measured) == 0:
+            return random.choice(ns_list)
+        fastest = min(measured)
+        weights = [1.0/max(rtt if rtt is not None else fastest, MIN_RTT)**2
+                for rtt in rtts]
+        return random.choices(ns_list, weights)[0]
+
+    def _next_ns_least_outstanding(self, exclude=None):
+        """Picks the nameserver with the fewest outstanding queries, ties are
+        broken round-robin"""
+        n = len(self.ns_list)
+        best = None
+        for i in range(n):
+            ns = self.ns_list[(self.next_ns_idx + i) % n]
+            if ns is exclude:
+                continue
+            if best is None or ns.outstanding < best.outstanding:
+                best = ns
         self._ns_cycle()
-        return ns
+        return best
 
     def _remove_ns(self, ns):
         try:
@@ -85,17 +191,43 @@ class QueryProvider(object):
             log.warn("reducing query rate to avoid increasing the load ",
                     "on remaining servers")
 
+    def _wait_ns_rate(self, ns):
+        if ns.rate_control is not None:
+            ns.rate_control.wait()
+
+    def _ns_response(self, ns, rtt):
+        with self._lock:
+            timely = ns.is_timely(rtt)
+            ns.add_rtt(rtt)
+            if ns.rate_control is not None:
+                ns.rate_control.response(timely)
+
+    def _ns_congestion(self, ns, sent):
+        with self._lock:
+            if (ns.rate_control is not None and
+                    ns.rate_control.congestion(sent)):
+                log.debug1("reducing query rate for ", str(ns), " to ",
+                        "{0:.1f}/s".format(ns.rate_control.rate))
+
     def add_ns_error(self, ns):
-        try:
-            ns.add_error(self.max_errors)
-        except MaxNsErrors:
-            self._remove_ns(ns)
+        with self._lock:
+            try:
+                ns.add_error(self.max_errors)
+            except MaxNsErrors:
+                self._remove_ns(ns)
+
+    def _ns_late(self, ns, waited):
+        """Counts a query that ns did not answer within waited seconds,
+        before a hedged query to another server was answered, as lost"""
+        with self._lock:
+            ns.add_loss(waited)
 
     def add_ns_timeout(self, ns):
-        try:
-            ns.add_timeouterror(self.max_retries)
-        except MaxRetriesError:
-            self._remove_ns(ns)
+        with self._lock:
+            try:
+                ns.add_timeouterror(self.max_retries)
+            except MaxRetriesError:
+                self._remove_ns(ns)
 
     def _query_timing(self, query_dn, rrtype, ns):
         self._wait_query_interval()
@@ -107,11 +239,55 @@ class QueryProvider(object):
         # need to block signals because dnspython doesn't handle EINTR
         # correctly
         log.logger.block_signals()
+        with self._lock:
+            ns.outstanding += 1
+            self.stats['queries'] += 1
         try:
+            log.debug2('query: ', query_dn, '; ns = ', ns, '; rrtype = ', rrtype)
+            return query.query(query_dn, ns, rrtype, self.timeout,
+                    self.tcp_only)
+        finally:
+            with self._lock:
+                ns.outstanding -= 1
+            log.logger.unblock_signals()
+
+    def _sendquery_hedged(self, query_dn, ns, rrtype):
+        hedge_delay = ns.rtt_percentile(self.hedge_percentile)
+        if hedge_delay is None:
+            hedge_delay = self.timeout
+        hedges = []
+        def hedge(answered):
+            hedge_ns = self._next_ns(exclude=ns)
+            if hedge_ns is None:
+                return None
+            # the hedged query is subject to the same rate limits
+            self._wait_query_interval()
+            self._wait_ns_rate(hedge_ns)
+            if answered():
+                return None
+            self._qr_measurements.append(time.monotonic())
+            with self._lock:
+                self.stats['queries'] += 1
+                self.stats['hedged_queries'] += 1
+                hedge_ns.outstanding += 1
+            hedges.append(hedge_ns)
+            log.debug2('hedged query: ', query_dn, '; ns = ', hedge_ns,
+                    '; rrtype = ', rrtype)
+            return hedge_ns
+
+        log.logger.block_signals()
+        with self._lock:
+            ns.outstanding += 1
             self.stats['queries'] += 1
+        try:
             log.debug2('query: ', query_dn, '; ns = ', ns, '; rrtype = ', rrtype)
-            return query.query(query_dn, ns, rrtype, self.timeout)
+            return query.hedged_query(query_dn, ns, rrtype, self.timeout,
+                    hedge_delay, hedge)
         finally:
+            with self._lock:
+                ns.outstanding -= 1
+                for hedge_ns in hedges:
+                    hedge_ns.outstanding -= 1
             log.logger.unblock_signals()
 
 
@@ -119,19 +295,35 @@ class QueryProvider(object):
         ns = self._next_ns()
         self._query_timing(query_dn, rrtype, ns)
         while True:
-            res = self._sendquery(query_dn, ns, rrtype)
+            self._wait_ns_rate(ns)
+            t = time.monotonic()
+            missed = []
+            if self.hedge_percentile is not None and not self.tcp_only:
+                res, ns, rtt, missed = self._sendquery_hedged(query_dn, ns,
+                        rrtype)
+            else:
+                res = self._sendquery(query_dn, ns, rrtype)
+                rtt = time.monotonic() - t
             if not isinstance(res, N3MapError):
+                for late_ns, waited in missed:
+                    self._ns_late(late_ns, waited)
                 ns.retries = 0
+                self._ns_response(ns, rtt)
                 # don't know yet if we can reset the error counter, caller
                 # decides
                 return (res, ns)
             if isinstance(res, TimeOutError):
-                self.add_ns_timeout(ns)
+                for timed_out_ns in [ns] + [m[0] for m in missed]:
+                    self._ns_congestion(timed_out_ns, t)
+                    self.add_ns_timeout(timed_out_ns)
                 ns = self._next_ns()
                 continue
             if isinstance(res, QueryError) or isinstance(res,
                     UnexpectedResponseStatus):
                 log.error("{} from server {}".format(res, ns))
+                if (isinstance(res, UnexpectedResponseStatus) and
+                        res.status in CONGESTION_STATUS):
+                    self._ns_congestion(ns, t)
                 self.add_ns_error(ns)
                 ns = self._next_ns()
                 continue
@@ -150,36 +342,57 @@ class QueryProvider(object):
             return len(self._qr_measurements)/interval
 
     def _wait_query_interval(self):
-        if (self.query_interval is not None and
-                self._last_query_time is not None):
-
-            # the loop is needed because time.sleep()
-            # may be interrupted by a signal
-            while True:
-                diff = time.monotonic() - self._last_query_time
-                if diff < 0 or diff >= self.query_interval:
-                    break
-                time.sleep(self.query_interval - diff)
-
-        self._last_query_time = time.monotonic()
+        # reserve the next free send time, so that concurrent callers are
+        # spaced by query_interval as well
+        with self._lock:
+            send_time = time.monotonic()
+            if (self.query_interval is not None and
+                    self._last_query_time is not None):
+                send_time = max(send_time,
+                        self._last_query_time + self.query_interval)
+            self._last_query_time = send_time
+
+        # the loop is needed because time.sleep()
+        # may be interrupted by a signal
+        while True:
+            diff = send_time - time.monotonic()
+            if diff <= 0:
+                break
+            time.sleep(diff)
+        if self.rate_limit is not None:
+            self.rate_limit.wait()
 
 
 class Query(object):
-    def __init__(self, id, query_dn, ns, rrtype, timeout):
+    def __init__(self, id, query_dn, ns, rrtype, timeout, result_queue):
         self.id = id
         self.query_dn = query_dn
         self.ns = ns
         self.rrtype = rrtype
         self.timeout = timeout
-
-def create_aggressive_qp(queryprovider, num_threads):
+        # the query engine puts (id, result) into this queue
+        self.result_queue = result_queue
+        # time the query was sent and round-trip time, the latter is set
+        # by the query engine
+        self.sent = None
+        self.rtt = None
+
+def create_aggressive_qp(queryprovider, num_threads, engine='asyncio',
+        use_mmsg=True):
     return AggressiveQueryProvider(queryprovider.ns_list,
                                    queryprovider.timeout,
                                    queryprovider.max_retries,
                                    queryprovider.max_errors,
                                    queryprovider.stats,
                                    queryprovider.query_interval,
-                                   num_threads)
+                                   num_threads,
+                                   engine,
+                                   use_mmsg,
+                                   queryprovider.ns_policy,
+                                   queryprovider.adaptive_rate,
+                                   tcp_only=queryprovider.tcp_only,
+                                   rate_limit=queryprovider.rate_limit,
+                                   shared_engine=queryprovider.shared_engine)
 
 class AggressiveQueryProvider(QueryProvider):
     def __init__(self,
@@ -189,55 +402,70 @@ class AggressiveQueryProvider(QueryProvider):
                  max_errors,
                  stats=None,
                  query_interval=None,
-                 num_threads=1):
+                 num_threads=1,
+                 engine='asyncio',
+                 use_mmsg=True,
+                 ns_policy='round-robin',
+                 adaptive_rate=False,
+                 tcp_only=False,
+                 rate_limit=None,
+                 shared_engine=None):
+        """Queries are sent using engine ('asyncio' or 'threads'), or
+        shared_engine if given, which is not stopped by stop()"""
         super(AggressiveQueryProvider,self).__init__(
                  ns_list,
                  timeout,
                  max_retries,
                  max_errors,
                  stats,
-                 query_interval)
+                 query_interval,
+                 ns_policy,
+                 adaptive_rate,
+                 tcp_only=tcp_only,
+                 rate_limit=rate_limit,
+                 shared_engine=shared_engine)
         self._current_queryid = 0
         self._active_queries = {}
         self._results = {}
-        self._query_queue = queue.Queue()
         self._result_queue = queue.Queue()
-        self._querythreads = []
-        self._start_query_threads(num_threads)
-
-    def _start_query_threads(self,num=1):
-        for i in range(num):
-            qt = QueryThread(self._query_queue, self._result_queue)
-            self._querythreads.append(qt)
-            qt.start()
+        if shared_engine is not None:
+            self._engine = shared_engine
+        else:
+            self._engine = create_query_engine(engine, num_threads, use_mmsg,
+                    tcp_only)
 
     def stop(self):
-        for i in range(len(self._querythreads)):
-            self._query_queue.put(None)
-        for qt in self._querythreads:
-            qt.join()
+        if self.shared_engine is None:
+            self._engine.stop()
 
     def _gen_query_id(self):
         self._current_queryid += 1
         return self._current_queryid
 
     def _sendquery(self, query):
+        self._wait_ns_rate(query.ns)
+        query.sent = time.monotonic()
         self.stats['queries'] += 1
         log.debug2('query: ', query.query_dn, '; ns = ', query.ns, '; rrtype = ', query.rrtype)
         self._active_queries[query.id] = query
-        self._query_queue.put(query)
+        query.ns.outstanding += 1
+        self._engine.submit(query)
         return query.id
 
     def _checkresult(self, qid, res):
         q = self._active_queries[qid]
+        q.ns.outstanding -= 1
         if not isinstance(res, N3MapError):
             q.ns.retries = 0
+            if q.rtt is not None:
+                self._ns_response(q.ns, q.rtt)
             self._results[qid] = (res, q.ns)
             del self._active_queries[qid]
             return
         try:
             raise res
         except TimeOutError:
+            self._ns_congestion(q.ns, q.sent)
             try:
                 self.add_ns_timeout(q.ns)
             except N3MapError as e:
@@ -248,6 +476,9 @@ class AggressiveQueryProvider(QueryProvider):
             self._sendquery(q)
         except (QueryError, UnexpectedResponseStatus) as e:
             log.error("{} from server {}".format(e, q.ns))
+            if (isinstance(e, UnexpectedResponseStatus) and
+                    e.status in CONGESTION_STATUS):
+                self._ns_congestion(q.ns, q.sent)
             try:
                 self.add_ns_error(q.ns)
             except N3MapError as e:
@@ -278,7 +509,8 @@ class AggressiveQueryProvider(QueryProvider):
     def query_ff(self, query_dn, rrtype='A'):
         ns = self._next_ns()
         self._query_timing(query_dn, rrtype, ns)
-        return self._sendquery(Query(self._gen_query_id(), query_dn, ns, rrtype, self.timeout))
+        return self._sendquery(Query(self._gen_query_id(), query_dn, ns,
+            rrtype, self.timeout, self._result_queue))
 
 
     def query(self, query_dn, rrtype='A'):
@@ -290,22 +522,144 @@ class AggressiveQueryProvider(QueryProvider):
                 return res
 
 
+def create_query_engine(engine, num_threads=1, use_mmsg=True, tcp_only=False):
+    """Returns an AsyncQueryEngine or QueryThreadPool with num_threads
+    threads, depending on engine ('asyncio' or 'threads')"""
+    if engine == 'asyncio':
+        return AsyncQueryEngine(use_mmsg=use_mmsg, tcp_only=tcp_only)
+    elif engine == 'threads':
+        return QueryThreadPool(num_threads, tcp_only)
+    raise ValueError("unknown query engine: " + str(engine))
+
+
+class QueryThreadPool(object):
+    """Sends queries using one blocking thread per parallel query"""
+    def __init__(self, num_threads=1, tcp_only=False):
+        self._query_queue = queue.Queue()
+        self._querythreads = []
+        for i in range(num_threads):
+            qt = QueryThread(self._query_queue, tcp_only)
+            self._querythreads.append(qt)
+            qt.start()
+
+    def submit(self, q):
+        self._query_queue.put(q)
+
+    def stop(self):
+        for i in range(len(self._querythreads)):
+            self._query_queue.put(None)
+        for qt in self._querythreads:
+            qt.join()
+
+
 class QueryThread(threading.Thread):
-    def __init__(self, query_queue, result_queue):
+    def __init__(self, query_queue, tcp_only=False):
         super(QueryThread, self).__init__()
         self.daemon = True
         self._query_queue = query_queue
-        self._result_queue = result_queue
+        self._tcp_only = tcp_only
 
     def run(self):
         query_queue = self._query_queue
-        result_queue = self._result_queue
         while True:
             q = query_queue.get()
             if q is None:
                 return
-            result_queue.put((q.id,query.query(q.query_dn, q.ns, q.rrtype, q.timeout)))
-
+            t = time.monotonic()
+            res = query.query(q.query_dn, q.ns, q.rrtype, q.timeout,
+                    self._tcp_only)
+            q.rtt = time.monotonic() - t
+            q.result_queue.put((q.id, res))
+
+
+
+class RateLimit(object):
+    """Fixed query rate limit, spaces queries by 1/rate seconds
+
+    Used as the rate control of a nameserver (NameServer.rate_control) or
+    as a limit shared by several query providers."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._next_send = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleeps until the next query may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            send_time = now
+            if self._next_send is not None:
+                send_time = max(now, self._next_send)
+            self._next_send = send_time + 1.0/self.rate
+        # the loop is needed because time.sleep()
+        # may be interrupted by a signal
+        while now < send_time:
+            time.sleep(send_time - now)
+            now = time.monotonic()
+
+    def response(self, timely):
+        pass
+
+    def congestion(self, sent):
+        return False
+
+
+def create_rate_control(query_interval=None, adaptive=False):
+    """Returns the rate control of a nameserver: an AIMDRate not exceeding
+    one query per query_interval if adaptive is set, otherwise a RateLimit
+    or None if there is no query_interval"""
+    rate = None if query_interval is None else 1.0/query_interval
+    if adaptive:
+        return AIMDRate(ceiling=rate)
+    if rate is not None:
+        return RateLimit(rate)
+    return None
+
+
+class AIMDRate(RateLimit):
+    """Adaptive query rate of a single nameserver
+
+    Starts at initial queries/s and adds one query/s per timely response,
+    doubling the rate about every second, until the first congestion event
+    (a timeout or a REFUSED/SERVFAIL response). From then on, the rate is
+    increased additively by AIMD_INCREASE queries/s per second and halved on
+    every congestion event. Like TCP, congestion events caused by queries
+    sent before the last decrease are ignored. The rate never exceeds
+    ceiling if given.
+    """
+    def __init__(self, initial=AIMD_INITIAL_RATE, ceiling=None):
+        super(AIMDRate, self).__init__(initial if ceiling is None
+                else min(initial, ceiling))
+        self.ceiling = ceiling
+        self._slow_start = True
+        self._last_decrease = None
+
+    def response(self, timely):
+        if not timely:
+            return
+        # the rate control of a nameserver may be shared by the query
+        # providers of several zones in batch mode
+        with self._lock:
+            if self._slow_start:
+                self.rate += 1.0
+            else:
+                self.rate += AIMD_INCREASE/self.rate
+            if self.ceiling is not None:
+                self.rate = min(self.rate, self.ceiling)
+
+    def congestion(self, sent):
+        """Decreases the rate after a congestion event caused by a query
+        sent at time sent. Returns True if the rate was decreased."""
+        with self._lock:
+            if (self._last_decrease is not None and sent is not None and
+                    sent < self._last_decrease):
+                return False
+            self._slow_start = False
+            self.rate = max(AIMD_MIN_RATE, self.rate * AIMD_DECREASE)
+            if self.ceiling is not None:
+                self.rate = min(self.rate, self.ceiling)
+            self._last_decrease = time.monotonic()
+            return True
 
 
 class NameServer(object):
@@ -317,8 +671,61 @@ class NameServer(object):
         self.name = vis.strvis(name.encode()).decode()
         self.retries = 0
         self.errors = 0
+        # smoothed round-trip time and its variation in seconds, None until
+        # the first response was received
+        self.srtt = None
+        self.rttvar = 0.0
+        self._rtt_samples = collections.deque(maxlen=RTT_SAMPLES)
+        # smoothed fraction of queries that timed out
+        self.loss = 0.0
+        # number of queries sent to this server still waiting for a result
+        self.outstanding = 0
+        # AIMDRate if adaptive rate control is enabled
+        self.rate_control = None
+        # persistent TCP connections, used for truncated responses and
+        # --tcp-only
+        self.tcp_pool = tcppool.TCPPool(ip, port)
+
+    def add_rtt(self, rtt):
+        self._rtt_samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+        else:
+            self.rttvar += RTTVAR_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.loss -= LOSS_ALPHA * self.loss
+
+    def rtt_percentile(self, p):
+        """Returns the p-th percentile of the recent RTT samples, or None if
+        there are too few samples"""
+        n = len(self._rtt_samples)
+        if n < HEDGE_MIN_SAMPLES:
+            return None
+        return sorted(self._rtt_samples)[min(n-1, int(p/100.0 * n))]
+
+    def is_timely(self, rtt):
+        """Checks whether rtt is within the usual variation of this server's
+        round-trip time"""
+        return self.srtt is None or rtt <= self.srtt + 4*self.rttvar
+
+    def expected_rtt(self, timeout):
+        """Returns the expected time until a query is answered, counting lost
+        queries as timeout, or None if no RTT was measured yet"""
+        if self.srtt is None:
+            return None
+        return self.srtt + self.loss * timeout
+
+    def add_loss(self, waited=None):
+        """Counts a query as lost. waited is the time waited for the
+        response, which is kept as a lower bound of its RTT so that the RTT
+        percentiles are not skewed towards the responses that arrived."""
+        self.loss += LOSS_ALPHA * (1.0 - self.loss)
+        if waited is not None:
+            self._rtt_samples.append(waited)
 
     def add_timeouterror(self, max_retries):
+        self.add_loss()
         if max_retries != -1:
             self.retries += 1
             retries_left = max_retries - self.retries
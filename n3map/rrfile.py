@@ -1,7 +1,11 @@
-import re
+import array
+import collections
 import gzip
+import multiprocessing
 import os
+import re
 
+from . import chainfile
 from . import log
 from .rrtypes import nsec
 from .rrtypes import nsec3
@@ -17,15 +21,53 @@ from .exception import (
 
 _comment_pattern = r'^\s*([;#].*)?$'
 
+def _nsec3_line_parser(filename):
+    """Returns a function parse_line(line, i) for the lines of an NSEC3 record
+    file. It returns the NSEC3 record of line i, the label counter value for
+    label counter lines and None for comments."""
+    p_counter = re.compile(r"^;;;; label_counter\s*=\s*0x([0-9a-fA-F]+)")
+    p_ignore = re.compile(_comment_pattern)
+    nsec3_parse = rrtypes.nsec3.parser()
+    def parse_line(line, i):
+        # records start with their owner name, skip the regular expressions
+        # for them
+        if not line[:1].isalnum():
+            m_counter = p_counter.match(line)
+            if m_counter is not None:
+                try:
+                    return int(m_counter.group(1), 16)
+                except ValueError:
+                    raise FileParseError(filename, i,
+                            "cannot parse label counter value")
+            elif p_ignore.match(line):
+                return None
+        try:
+            nsec3 = nsec3_parse(line)
+            if nsec3 is None:
+                raise FileParseError(filename, i, "invalid file format")
+            return nsec3
+        except ParseError:
+            raise FileParseError(filename, i, "could not parse NSEC3 record")
+        except (NSEC3Error,
+                MaxDomainNameLengthError,
+                MaxLabelLengthError) as e:
+            raise FileParseError(filename, i,
+                    "invalid NSEC3 record:\n" + str(e))
+    return parse_line
+
 def _open(filename, mode):
     if filename.endswith(".gz"):
         return gzip.open(filename, mode + 't', encoding="utf-8")
     return open(filename, mode, encoding="utf-8")
 
 def open_output_rrfile(filename):
+    if filename.endswith(chainfile.EXTENSION):
+        return chainfile.create_chain_file(filename)
     return RRFile(_open(filename, "w+"), filename)
 
 def open_input_rrfile(filename):
+    if chainfile.is_chain_file(filename):
+        return chainfile.open_chain_file(filename)
     return RRFile(_open(filename, "r"), filename)
 
 class RRFileStream(object):
@@ -67,6 +109,14 @@ class RRFileStream(object):
     def write_record(self, rr):
         self.f.write(str(rr) + '\n')
 
+    def write_chain(self, records):
+        if isinstance(records, NSEC3FileRecords):
+            # copy the lines instead of parsing and formatting the records
+            self.f.writelines(records.lines())
+            return
+        for rr in records:
+            self.write_record(rr)
+
     def _desc_filename(self):
         return self.f.name
 
@@ -97,34 +147,15 @@ class RRFileStream(object):
     def nsec3_reader(self):
         log.info("reading NSEC3 RRs from ", str(self.f.name))
         self.seek(0)
-        p_counter = re.compile("^;;;; label_counter\s*=\s*0x([0-9a-fA-F]+)")
-        p_ignore = re.compile(_comment_pattern)
-        nsec3_parse = rrtypes.nsec3.parser()
+        parse_line = _nsec3_line_parser(self._desc_filename())
         for i, line in enumerate(self.f, start=1):
-            m_counter = p_counter.match(line)
-            if m_counter is not None:
-                try:
-                    self.label_counter = int(m_counter.group(1), 16)
-                except ValueError:
-                    raise FileParseError(self._desc_filename(), i,
-                            "cannot parse label counter value")
+            res = parse_line(line, i)
+            if res is None:
                 continue
-            elif p_ignore.match(line):
+            elif isinstance(res, int):
+                self.label_counter = res
                 continue
-            try:
-                nsec3 = nsec3_parse(line)
-                if nsec3 is None:
-                    raise FileParseError(self._desc_filename(), i,
-                            "invalid file format")
-                yield nsec3
-            except ParseError:
-                raise FileParseError(self._desc_filename(), i,
-                        "could not parse NSEC3 record")
-            except (NSEC3Error,
-                    MaxDomainNameLengthError,
-                    MaxLabelLengthError) as e:
-                raise FileParseError(self._desc_filename(), i,
-                        "invalid NSEC3 record:\n" + str(e))
+            yield res
 
     def write_label_counter(self, label_counter):
         self.f.write(";;;; label_counter = 0x{0:x}\n".format(label_counter))
@@ -178,3 +209,246 @@ def nsec3_from_file(filename):
 
 
 
+
+def nsec3_hashes_from_file(filename, processes=None):
+    """Yields a tuple (hashed owner name, zone, salt, iterations) for every
+    NSEC3 record in a file. Uncompressed text files are read using
+    load_nsec3_records()."""
+    if can_load_nsec3_records(filename):
+        records = load_nsec3_records(filename, processes)
+        try:
+            for h in records.hashed_owners():
+                yield (h, records.zone, records.salt, records.iterations)
+        finally:
+            records.close()
+        return
+    rrf = open_input_rrfile(filename)
+    try:
+        for rr in rrf.nsec3_reader():
+            yield (rr.hashed_owner, rr.zone, rr.salt, rr.iterations)
+    finally:
+        rrf.close()
+
+
+# files are split into chunks of about this size for load_nsec3_records()
+MIN_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 64 << 20
+
+_NSEC3Chunk = collections.namedtuple('_NSEC3Chunk', ['keys', 'ends',
+    'offsets', 'zone', 'salt', 'iterations', 'label_counter', 'error'])
+
+def can_load_nsec3_records(filename):
+    """Returns True if load_nsec3_records() can read filename, i.e. it is an
+    uncompressed text file"""
+    return not filename.endswith(".gz") and not chainfile.is_chain_file(
+            filename)
+
+def _line_ranges(filename, chunk_size):
+    """Splits filename into ranges (start, end) of about chunk_size bytes
+    which begin and end at line boundaries"""
+    size = os.path.getsize(filename)
+    ranges = []
+    start = 0
+    with open(filename, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _parse_nsec3_range(args):
+    """Parses the NSEC3 records in a range of a file, see _line_ranges().
+    Errors are returned instead of raised, with the line number relative to
+    the start of the range."""
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    keys = bytearray()
+    ends = bytearray()
+    offsets = array.array('Q')
+    zone = None
+    salt = None
+    iterations = None
+    label_counter = None
+    parse_line = _nsec3_line_parser(filename)
+    offset = start
+    try:
+        for i, line in enumerate(data.split(b'\n'), start=1):
+            line_offset = offset
+            offset += len(line) + 1
+            try:
+                res = parse_line(line.decode('utf-8'), i)
+            except UnicodeError:
+                raise FileParseError(filename, i, "invalid encoding")
+            if res is None:
+                continue
+            elif isinstance(res, int):
+                label_counter = res
+                continue
+            if zone is None:
+                zone = res.zone
+                salt = res.salt
+                iterations = res.iterations
+            # the records of a zone share its DomainName, see
+            # nsec3.parser()
+            elif (res.salt != salt or res.iterations != iterations or
+                    (res.zone is not zone and res.zone != zone)):
+                raise FileParseError(filename, i,
+                        "zone, salt or iterations not unique")
+            keys += res.hashed_owner
+            ends += res.next_hashed_owner
+            offsets.append(line_offset)
+    except FileParseError as e:
+        return _NSEC3Chunk(None, None, None, None, None, None, None,
+                (e.line, e.msg))
+    return _NSEC3Chunk(bytes(keys), bytes(ends), offsets, zone, salt,
+            iterations, label_counter, None)
+
+def _line_number(filename, offset, i):
+    """Returns the number of line i of the range starting at offset"""
+    n = 0
+    with open(filename, 'rb') as f:
+        while offset > 0:
+            data = f.read(min(offset, MAX_CHUNK_SIZE))
+            if len(data) == 0:
+                break
+            n += data.count(b'\n')
+            offset -= len(data)
+    return n + i
+
+def load_nsec3_records(filename, processes=None):
+    """Reads the NSEC3 records of an uncompressed text file using a pool of
+    processes
+
+    The file is split into chunks at line boundaries which are parsed in
+    parallel. Only the hashed owner names, next hashed owner names and the
+    positions of the records in the file are sent back, see
+    NSEC3FileRecords. processes defaults to the number of CPUs.
+    """
+    log.info("reading NSEC3 RRs from ", str(filename))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    size = os.path.getsize(filename)
+    chunk_size = min(MAX_CHUNK_SIZE,
+            max(MIN_CHUNK_SIZE, size//(4*processes) + 1))
+    tasks = [(filename, start, end) for start, end in
+            _line_ranges(filename, chunk_size)]
+    if processes > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            chunks = list(pool.imap(_parse_nsec3_range, tasks))
+    else:
+        chunks = [_parse_nsec3_range(t) for t in tasks]
+
+    keys = []
+    ends = []
+    offsets = array.array('Q')
+    zone = None
+    salt = None
+    iterations = None
+    label_counter = None
+    for (_, start, _), chunk in zip(tasks, chunks):
+        if chunk.error is not None:
+            i, msg = chunk.error
+            raise FileParseError(filename, _line_number(filename, start, i),
+                    msg)
+        if chunk.label_counter is not None:
+            label_counter = chunk.label_counter
+        if chunk.zone is None:
+            continue
+        if zone is None:
+            zone = chunk.zone
+            salt = chunk.salt
+            iterations = chunk.iterations
+        elif (chunk.salt != salt or chunk.iterations != iterations or
+                chunk.zone != zone):
+            raise FileParseError(filename,
+                    _line_number(filename, chunk.offsets[0], 1),
+                    "zone, salt or iterations not unique")
+        keys.append(chunk.keys)
+        ends.append(chunk.ends)
+        offsets.extend(chunk.offsets)
+    return NSEC3FileRecords(filename, zone, salt, iterations, label_counter,
+            b''.join(keys), b''.join(ends), offsets)
+
+
+class NSEC3FileRecords(object):
+    """NSEC3 records of a text file read by load_nsec3_records()
+
+    Offers the interface of chainfile.ChainRecords. The hashed owner names
+    and next hashed owner names are kept packed, the records themselves are
+    only parsed when they are accessed. The file is kept open, so the
+    records can still be read after it was renamed by into_backup().
+    """
+    def __init__(self, filename, zone, salt, iterations, label_counter,
+            keys, ends, offsets):
+        self.filename = filename
+        self.zone = zone
+        self.salt = salt
+        self.iterations = iterations
+        self.label_counter = label_counter
+        self.sorted = False
+        self._keys = keys
+        self._ends = ends
+        self._offsets = offsets
+        self._index = None
+        self._parse_line = _nsec3_line_parser(filename)
+        self._f = open(filename, 'rb')
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def _line(self, i):
+        self._f.seek(self._offsets[i])
+        return self._f.readline().decode('utf-8')
+
+    def record(self, i):
+        """Returns the i-th record as nsec3.NSEC3 object"""
+        return self._parse_line(self._line(i), i)
+
+    def lines(self):
+        """Yields the lines of the records as they are in the file"""
+        for i in range(len(self)):
+            line = self._line(i)
+            yield line if line.endswith('\n') else line + '\n'
+
+    def hashed_owners(self):
+        """Returns the list of hashed owner names"""
+        n = nsec3.SHA1_LENGTH
+        return [self._keys[o:o+n] for o in range(0, len(self._keys), n)]
+
+    def intervals(self):
+        """Returns the lists of hashed owner names and next hashed owner
+        names of all records, in file order"""
+        n = nsec3.SHA1_LENGTH
+        return (self.hashed_owners(),
+                [self._ends[o:o+n] for o in range(0, len(self._ends), n)])
+
+    def find(self, nsec3_hash):
+        """Returns the index of the record with hashed owner name nsec3_hash
+        or None"""
+        if self._index is None:
+            keys = self.hashed_owners()
+            self._index = dict(zip(keys, range(len(keys))))
+        return self._index.get(nsec3_hash)
+
+    def __getitem__(self, nsec3_hash):
+        i = self.find(nsec3_hash)
+        if i is None:
+            raise KeyError(nsec3_hash)
+        return self.record(i)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
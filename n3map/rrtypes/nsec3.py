@@ -41,6 +41,24 @@ class NSEC3(rr.RR):
         self.next_hashed_owner = next_hashed_owner
         self.types = types
 
+    @classmethod
+    def from_parts(cls, hashed_owner, zone, ttl, rrclass, algorithm, flags,
+            iterations, salt, next_hashed_owner, types):
+        """Creates an NSEC3 record from already validated values, without
+        going through the owner name"""
+        nsec3 = cls.__new__(cls)
+        nsec3.hashed_owner = hashed_owner
+        nsec3.zone = zone
+        nsec3.ttl = ttl
+        nsec3.cls = rrclass
+        nsec3._algorithm = algorithm
+        nsec3.flags = flags
+        nsec3._iterations = iterations
+        nsec3.salt = salt
+        nsec3._next_hashed_owner = next_hashed_owner
+        nsec3.types = types
+        return nsec3
+
     @property
     def owner(self):
         return self.hashed_owner_dn()
@@ -135,7 +153,81 @@ def compute_hash(owner_name, salt, iterations, algorithm=SHA1):
             break
     return h.digest()
 
+def _is_number(s):
+    # same as the ([0-9]|[1-9][0-9]*) groups of the regular expressions
+    return s.isascii() and s.isdigit() and (len(s) == 1 or s[0] != '0')
+
+def _hash_from_label(s):
+    """Decodes a base32hex encoded SHA-1 hash, returns None if s is not
+    one"""
+    # int() would also accept signs, whitespace and underscores
+    if len(s) != 32 or not (s.isascii() and s.isalnum()):
+        return None
+    try:
+        # the digits of base 32 are the base32hex alphabet
+        return int(s, 32).to_bytes(SHA1_LENGTH, 'big')
+    except ValueError:
+        return None
+
 def parser():
+    """Returns a parser for NSEC3 records
+
+    Lines in the format written by n3map (see NSEC3.__str__()) are split
+    into their fields directly, all other lines are parsed using regular
+    expressions. The zone is only parsed the first time it is encountered,
+    all records of the zone share its DomainName object."""
+    p_types = re.compile(r'[A-Z0-9]+( [A-Z0-9]+)*')
+    # owner name without the hashed label -> zone of the last slow-path
+    # record
+    last_zone = [None, None]
+
+    def nsec3_from_n3map_text(s):
+        fields = s.rstrip('\n').split('\t')
+        if len(fields) != 5 or fields[2] != 'IN':
+            return None
+        owner, ttl, cls, rdata, types = fields
+        label, sep, zone = owner.partition('.')
+        if zone != last_zone[0] or not _is_number(ttl):
+            return None
+        rdata = rdata.split(' ')
+        if len(rdata) != 6 or rdata[0] != 'NSEC3':
+            return None
+        rrtype, algorithm, flags, iterations, salt, next_hashed_owner = rdata
+        if not (_is_number(algorithm) and _is_number(flags) and
+                _is_number(iterations)):
+            return None
+        algorithm = int(algorithm)
+        iterations = int(iterations)
+        if not (algorithm & SHA1) or iterations > 2500:
+            return None
+        hashed_owner = _hash_from_label(label)
+        next_hashed_owner = _hash_from_label(next_hashed_owner)
+        if (hashed_owner is None or next_hashed_owner is None or
+                p_types.fullmatch(types) is None):
+            return None
+        if salt == '-':
+            salt = b''
+        else:
+            try:
+                salt = bytes.fromhex(salt)
+            except ValueError:
+                return None
+        return NSEC3.from_parts(hashed_owner, last_zone[1], int(ttl), cls,
+                algorithm, int(flags), iterations, salt, next_hashed_owner,
+                types.split(' '))
+
+    nsec3_from_regex = _regex_parser()
+    def nsec3_from_text(s):
+        nsec3 = nsec3_from_n3map_text(s)
+        if nsec3 is None:
+            nsec3 = nsec3_from_regex(s)
+            if nsec3 is not None:
+                last_zone[0] = s.split('\t', 1)[0].partition('.')[2]
+                last_zone[1] = nsec3.zone
+        return nsec3
+    return nsec3_from_text
+
+def _regex_parser():
     p_nsec3 = re.compile(r'^NSEC3\s+([0-9]|[1-9][0-9]*)\s+([0-9]|[1-9][0-9]*)\s+([0-9]|[1-9][0-9]*)\s+([a-fA-F0-9]+|\-)\s+([a-vA-V0-9]+)((\s+[A-Z0-9]+)*)\s*$')
     rr_parse = rr.parser()
     def nsec3_from_text(s):
@@ -0,0 +1,120 @@
+/*
+ * Multi-buffer SHA-1 for NSEC3 iterations
+ *
+ * All iterations after the first one hash a message of the same length
+ * (previous digest + salt), so several names can be processed in parallel
+ * in the lanes of a SIMD register. The implementations are generated from
+ * sha1mb_impl.h using GCC vector extensions, the instruction set is
+ * selected at runtime.
+ */
+#include <string.h>
+
+#include "sha1mb.h"
+
+void sha1mb_msg_init(struct sha1mb_msg *msg, const unsigned char *salt,
+		size_t salt_length)
+{
+	unsigned char buf[SHA1MB_MAX_BLOCKS * 64];
+	/* the digest is not part of the template, see struct sha1mb_msg */
+	size_t length = SHA1MB_DIGEST_WORDS * 4 + salt_length;
+	uint64_t bits = (uint64_t)length * 8;
+	int i;
+
+	msg->nblocks = (int)((length + 8) / 64 + 1);
+	memset(buf, 0, sizeof(buf));
+	memcpy(buf + SHA1MB_DIGEST_WORDS * 4, salt, salt_length);
+	buf[length] = 0x80;
+	for (i = 0; i < 8; i++)
+		buf[msg->nblocks * 64 - 1 - i] = (unsigned char)(bits >> (8 * i));
+	for (i = 0; i < msg->nblocks * 16; i++)
+		msg->words[i] = ((uint32_t)buf[4 * i] << 24) |
+			((uint32_t)buf[4 * i + 1] << 16) |
+			((uint32_t)buf[4 * i + 2] << 8) |
+			(uint32_t)buf[4 * i + 3];
+}
+
+#if defined(__GNUC__)
+
+#define SHA1MB_LANES 4
+#define SHA1MB_SUFFIX vec4
+#define SHA1MB_TARGET
+#include "sha1mb_impl.h"
+#undef SHA1MB_TARGET
+#undef SHA1MB_SUFFIX
+#undef SHA1MB_LANES
+
+static const struct sha1mb_impl impl_vec4 = {"vec4", 4, sha1mb_iterate_vec4};
+
+#if defined(__x86_64__) || defined(__i386__)
+#define SHA1MB_X86
+
+#define SHA1MB_LANES 8
+#define SHA1MB_SUFFIX avx2
+#define SHA1MB_TARGET __attribute__((target("avx2")))
+#include "sha1mb_impl.h"
+#undef SHA1MB_TARGET
+#undef SHA1MB_SUFFIX
+#undef SHA1MB_LANES
+
+#define SHA1MB_LANES 16
+#define SHA1MB_SUFFIX avx512
+#define SHA1MB_TARGET __attribute__((target("avx512f")))
+#include "sha1mb_impl.h"
+#undef SHA1MB_TARGET
+#undef SHA1MB_SUFFIX
+#undef SHA1MB_LANES
+
+static const struct sha1mb_impl impl_avx2 = {"avx2", 8, sha1mb_iterate_avx2};
+static const struct sha1mb_impl impl_avx512 = {"avx512", 16,
+	sha1mb_iterate_avx512};
+#endif /* x86 */
+
+#endif /* __GNUC__ */
+
+/* fastest first */
+static const struct sha1mb_impl *available[4];
+static int initialized = 0;
+
+static void sha1mb_init(void)
+{
+	int n = 0;
+
+	if (initialized)
+		return;
+#if defined(SHA1MB_X86)
+	__builtin_cpu_init();
+	if (__builtin_cpu_supports("avx512f"))
+		available[n++] = &impl_avx512;
+	if (__builtin_cpu_supports("avx2"))
+		available[n++] = &impl_avx2;
+#endif
+#if defined(__GNUC__)
+	available[n++] = &impl_vec4;
+#endif
+	available[n] = NULL;
+	initialized = 1;
+}
+
+const struct sha1mb_impl * const *sha1mb_available(void)
+{
+	sha1mb_init();
+	return available;
+}
+
+const struct sha1mb_impl *sha1mb_best(void)
+{
+	sha1mb_init();
+	return available[0];
+}
+
+const struct sha1mb_impl *sha1mb_find(const char *name)
+{
+	int i;
+
+	sha1mb_init();
+	for (i = 0; available[i] != NULL; i++) {
+		if (strcmp(available[i]->name, name) == 0)
+			return available[i];
+	}
+	return NULL;
+}
@@ -0,0 +1,46 @@
+#ifndef SHA1MB_H
+#define SHA1MB_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+#define SHA1MB_DIGEST_WORDS 5
+/* salt (max. 255 bytes) + digest + padding fit into 5 blocks */
+#define SHA1MB_MAX_BLOCKS 5
+
+/*
+ * Padded message template of one NSEC3 iteration, H(x || salt) where x is
+ * the 20 byte digest of the previous iteration.
+ *
+ * Only the first 5 words of the first block depend on x, all remaining
+ * words are the same for every name hashed with the same salt.
+ */
+struct sha1mb_msg {
+	uint32_t words[SHA1MB_MAX_BLOCKS * 16];
+	int nblocks;
+};
+
+/*
+ * Multi-buffer implementation: computes iterations NSEC3 iterations for
+ * each of the lanes. state holds the digests in big endian words, word-major
+ * (state[word * lanes + lane]).
+ */
+typedef void (*sha1mb_iterate_fn)(uint32_t *state, const struct sha1mb_msg *msg,
+		int iterations);
+
+struct sha1mb_impl {
+	const char *name;
+	int lanes;
+	sha1mb_iterate_fn iterate;
+};
+
+void sha1mb_msg_init(struct sha1mb_msg *msg, const unsigned char *salt,
+		size_t salt_length);
+/* returns the fastest implementation supported by the CPU or NULL */
+const struct sha1mb_impl *sha1mb_best(void);
+/* returns the implementation with the given name or NULL */
+const struct sha1mb_impl *sha1mb_find(const char *name);
+/* NULL-terminated list of all implementations supported by the CPU */
+const struct sha1mb_impl * const *sha1mb_available(void);
+
+#endif
@@ -0,0 +1,98 @@
+/*
+ * Generic multi-lane SHA-1 core for NSEC3 iterations.
+ *
+ * This file is included once per implementation by sha1mb.c with the
+ * following macros defined:
+ *
+ *   SHA1MB_LANES   number of lanes (32 bit elements per vector)
+ *   SHA1MB_SUFFIX  suffix for the generated identifiers
+ *   SHA1MB_TARGET  function attribute selecting the instruction set
+ */
+
+#define SHA1MB_CAT_(a, b) a ## b
+#define SHA1MB_CAT(a, b) SHA1MB_CAT_(a, b)
+#define VEC SHA1MB_CAT(sha1mb_vec_, SHA1MB_SUFFIX)
+#define COMPRESS SHA1MB_CAT(sha1mb_compress_, SHA1MB_SUFFIX)
+#define ITERATE SHA1MB_CAT(sha1mb_iterate_, SHA1MB_SUFFIX)
+
+typedef uint32_t VEC __attribute__((vector_size(4 * SHA1MB_LANES)));
+
+#define ROL(x, n) (((x) << (n)) | ((x) >> (32 - (n))))
+#define BCAST(x) ((VEC){0} + (uint32_t)(x))
+
+#define ROUND(f, k, t) do { \
+	VEC tmp; \
+	if ((t) >= 16) \
+		w[(t) & 15] = ROL(w[((t) - 3) & 15] ^ w[((t) - 8) & 15] ^ \
+				w[((t) - 14) & 15] ^ w[(t) & 15], 1); \
+	tmp = ROL(a, 5) + (f) + e + BCAST(k) + w[(t) & 15]; \
+	e = d; \
+	d = c; \
+	c = ROL(b, 30); \
+	b = a; \
+	a = tmp; \
+} while (0)
+
+static SHA1MB_TARGET void COMPRESS(VEC *h, VEC *w)
+{
+	VEC a = h[0], b = h[1], c = h[2], d = h[3], e = h[4];
+	int t;
+
+	for (t = 0; t < 20; t++)
+		ROUND(d ^ (b & (c ^ d)), 0x5a827999, t);
+	for (; t < 40; t++)
+		ROUND(b ^ c ^ d, 0x6ed9eba1, t);
+	for (; t < 60; t++)
+		ROUND((b & c) | (d & (b | c)), 0x8f1bbcdc, t);
+	for (; t < 80; t++)
+		ROUND(b ^ c ^ d, 0xca62c1d6, t);
+
+	h[0] += a;
+	h[1] += b;
+	h[2] += c;
+	h[3] += d;
+	h[4] += e;
+}
+
+static SHA1MB_TARGET void ITERATE(uint32_t *state,
+		const struct sha1mb_msg *msg, int iterations)
+{
+	VEC x[SHA1MB_DIGEST_WORDS];
+	VEC h[SHA1MB_DIGEST_WORDS];
+	VEC w[16];
+	int i, j, blk;
+
+	for (j = 0; j < SHA1MB_DIGEST_WORDS; j++)
+		memcpy(&x[j], state + j * SHA1MB_LANES, sizeof(VEC));
+
+	for (i = 0; i < iterations; i++) {
+		h[0] = BCAST(0x67452301);
+		h[1] = BCAST(0xefcdab89);
+		h[2] = BCAST(0x98badcfe);
+		h[3] = BCAST(0x10325476);
+		h[4] = BCAST(0xc3d2e1f0);
+		for (blk = 0; blk < msg->nblocks; blk++) {
+			for (j = 0; j < 16; j++) {
+				if (blk == 0 && j < SHA1MB_DIGEST_WORDS)
+					w[j] = x[j];
+				else
+					w[j] = BCAST(msg->words[blk * 16 + j]);
+			}
+			COMPRESS(h, w);
+		}
+		for (j = 0; j < SHA1MB_DIGEST_WORDS; j++)
+			x[j] = h[j];
+	}
+
+	for (j = 0; j < SHA1MB_DIGEST_WORDS; j++)
+		memcpy(state + j * SHA1MB_LANES, &x[j], sizeof(VEC));
+}
+
+#undef ROUND
+#undef BCAST
+#undef ROL
+#undef ITERATE
+#undef COMPRESS
+#undef VEC
+#undef SHA1MB_CAT
+#undef SHA1MB_CAT_
@@ -182,3 +182,65 @@ def format_statusline_nsec(width,
     line = left + [pad * '.'] + right
     return [assemble_line(truncate_line(line, width, cs))]
 
+
+def format_statusline_batch(width,
+                total,
+                done,
+                failed,
+                running
+            ):
+    """running is a list of (zone, queries) tuples of the walks in
+    progress"""
+    cs = log.logger.colors
+    lines = []
+    left = [
+            ColorCode(cs.DECO),
+            ";;",
+            ColorCode(cs.RESET),
+            " batch: ",
+            ]
+    leftlabels =  [['zones'],['done'],['failed']]
+    leftvalues = [
+            [ColorCode(cs.NUMBERS), "{0:d}".format(total),
+                ColorCode(cs.RESET)],
+            [ColorCode(cs.RECORDS), "{0:d}".format(done),
+                ColorCode(cs.RESET)],
+            [ColorCode(cs.NUMBERS), "{0:d}".format(failed),
+                ColorCode(cs.RESET)],
+            ]
+    rightlabels = [['running']]
+    rightvalues = [
+            [ColorCode(cs.NUMBERS), "{0:d}".format(len(running)),
+                ColorCode(cs.RESET)],
+            ]
+    leftline,right = compose_leftright(cs, leftlabels, leftvalues,
+                                   rightlabels, rightvalues)
+    line = left + leftline
+    pad = width - printlen(line) - printlen(right)
+    if pad < 0:
+        pad = 0
+    lines.append(line + [pad * '.'] + right)
+
+    for zone, queries in running:
+        left = [
+                ColorCode(cs.DECO),
+                ";;",
+                ColorCode(cs.RESET),
+                " mapping ",
+                ColorCode(cs.ZONE), str(zone), ColorCode(cs.RESET),
+                " ",
+                ]
+        right = [
+                " queries = ",
+                ColorCode(cs.NUMBERS), "{0:d}".format(queries),
+                ColorCode(cs.RESET),
+                ColorCode(cs.DECO),
+                " ;;",
+                ColorCode(cs.RESET),
+                ]
+        pad = width - printlen(left) - printlen(right)
+        if pad < 0:
+            pad = 0
+        lines.append(left + [pad * '.'] + right)
+
+    return [assemble_line(truncate_line(l, width, cs)) for l in lines]
@@ -0,0 +1,222 @@
+import concurrent.futures
+import socket
+import struct
+import threading
+import time
+
+import dns.entropy
+import dns.exception
+
+from . import query
+from .wireresult import WireResult
+
+# maximum number of connections per nameserver
+DEFAULT_MAX_CONNECTIONS = 2
+# number of outstanding queries on each connection before opening another
+DEFAULT_MAX_PIPELINE = 64
+
+
+def _fail(futures):
+    for future in futures:
+        if future.set_running_or_notify_cancel():
+            future.set_exception(ConnectionError('connection closed'))
+
+
+class TCPConnection(object):
+    """Persistent TCP connection to a nameserver
+
+    Queries are pipelined (RFC 7766, section 6.2.1): they are sent without
+    waiting for the responses to earlier queries. A reader thread matches
+    the responses, which may arrive in any order, to their queries by
+    message ID.
+    """
+    def __init__(self, ip, port, timeout):
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._sock.settimeout(timeout)
+            self._sock.connect((str(ip), port))
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            self._sock.close()
+            raise
+        self._lock = threading.Lock()
+        # serializes writers so that messages are not interleaved. Not
+        # self._lock, which the reader needs to deliver responses while a
+        # write blocks.
+        self._send_lock = threading.Lock()
+        # message id -> (request, future)
+        self._pending = {}
+        self.closed = False
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def outstanding(self):
+        return len(self._pending)
+
+    def submit(self, request):
+        """Sends the query request (in wire format). Returns a
+        concurrent.futures.Future for the WireResult. The message ID is
+        changed if another query with the same ID is outstanding.
+
+        Raises ConnectionError if the connection is closed."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError('connection closed')
+            msgid = int.from_bytes(request[:2], 'big')
+            while msgid in self._pending:
+                msgid = dns.entropy.random_16()
+            request = msgid.to_bytes(2, 'big') + request[2:]
+            self._pending[msgid] = (request, future)
+        try:
+            with self._send_lock:
+                self._sock.sendall(struct.pack('!H', len(request)) + request)
+        except OSError:
+            with self._lock:
+                self._pending.pop(msgid, None)
+                failed = self._close()
+            _fail(failed)
+            raise ConnectionError('connection closed')
+        future.add_done_callback(lambda f: self._forget(msgid, f))
+        return future
+
+    def _forget(self, msgid, future):
+        # removes cancelled queries
+        with self._lock:
+            entry = self._pending.get(msgid)
+            if entry is not None and entry[1] is future:
+                del self._pending[msgid]
+
+    def _read(self):
+        buf = bytearray()
+        while True:
+            try:
+                data = self._sock.recv(65535)
+            except socket.timeout:
+                # no response yet, queries time out on their own
+                continue
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            buf += data
+            while len(buf) >= 2:
+                length = (buf[0] << 8) | buf[1]
+                if len(buf) < 2 + length:
+                    break
+                self._dispatch(bytes(buf[2:2+length]))
+                del buf[:2+length]
+        self.close()
+
+    def _dispatch(self, response):
+        if len(response) < 2:
+            return
+        msgid = int.from_bytes(response[:2], 'big')
+        with self._lock:
+            entry = self._pending.get(msgid)
+            if entry is None or not query.wire_is_response(entry[0], response):
+                return
+            del self._pending[msgid]
+        future = entry[1]
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(WireResult(response))
+        except dns.exception.DNSException as e:
+            future.set_exception(e)
+
+    def _close(self):
+        """Closes the socket, must be called with self._lock held. Returns
+        the futures of the outstanding queries, which have to be failed
+        using _fail() after releasing the lock."""
+        if self.closed:
+            return []
+        self.closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        futures = [future for request, future in self._pending.values()]
+        self._pending = {}
+        return futures
+
+    def close(self):
+        with self._lock:
+            failed = self._close()
+        _fail(failed)
+
+
+class TCPPool(object):
+    """Persistent, pipelining TCP connections to a single nameserver
+
+    A new connection is only opened when all connections have at least
+    max_pipeline outstanding queries, up to max_connections.
+    """
+    def __init__(self, ip, port, max_connections=DEFAULT_MAX_CONNECTIONS,
+            max_pipeline=DEFAULT_MAX_PIPELINE):
+        self.ip = ip
+        self.port = port
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connection(self, timeout):
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            if len(self._connections) > 0:
+                conn = min(self._connections, key=lambda c: c.outstanding())
+                if (conn.outstanding() < self.max_pipeline or
+                        len(self._connections) >= self.max_connections):
+                    return conn
+        conn = TCPConnection(self.ip, self.port, timeout)
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            if len(self._connections) < self.max_connections:
+                self._connections.append(conn)
+                return conn
+            # another thread opened a connection in the meantime
+            existing = min(self._connections, key=lambda c: c.outstanding())
+        conn.close()
+        return existing
+
+    def submit(self, request, timeout):
+        """Sends request over one of the connections, opening one if
+        necessary. Returns a concurrent.futures.Future for the WireResult.
+
+        Raises OSError if no connection could be established."""
+        try:
+            return self._connection(timeout).submit(request)
+        except ConnectionError:
+            # the server closed the connection, try a new one
+            return self._connection(timeout).submit(request)
+
+    def query(self, request, timeout):
+        """Sends request and waits for the response
+
+        Raises dns.exception.Timeout if there is no response within
+        timeout. If the server closes the connection before responding
+        (e.g. because it was idle for too long), the query is sent again
+        once over a new connection."""
+        expiration = time.monotonic() + timeout
+        retry = True
+        while True:
+            future = self.submit(request, timeout)
+            try:
+                return future.result(max(0, expiration - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise dns.exception.Timeout
+            except ConnectionError:
+                if not retry:
+                    raise
+                retry = False
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -0,0 +1,295 @@
+import bisect
+import collections
+import math
+
+from .. import log
+from ..rrtypes.nsec3 import SHA1_LENGTH
+from .nsec3tree import OverLapError, pack_intervals, find_first_uncovered
+
+HAS_NSEC3HASH = False
+try:
+    from .. import nsec3hash
+    HAS_NSEC3HASH = True
+except ImportError:
+    pass
+
+NSEC3ArrayEntry = collections.namedtuple('NSEC3ArrayEntry',
+        ['key', 'value', 'int_end'])
+
+def _covers(e, k):
+    if e.key == e.int_end:
+        # 1 record covers entire zone
+        return True
+    if e.key > e.int_end:
+        return (k >= e.key or k <= e.int_end)
+    return e.key <= k <= e.int_end
+
+def _covered_distance(e, hash_max):
+    l1 = int.from_bytes(e.key, "big")
+    l2 = int.from_bytes(e.int_end, "big")
+    if e.key == e.int_end:
+        return hash_max
+    if e.key > e.int_end:
+        return hash_max - l1 + l2
+    return l2-l1
+
+
+class NSEC3Array(object):
+    """Array-backed alternative to NSEC3Tree
+
+    The intervals are stored in sorted, parallel lists of keys, interval
+    ends and values and are found using binary search. New intervals are
+    inserted into a small sorted buffer which is merged into the main lists
+    once it holds more than ~sqrt(n) entries. For bulk lookups, the main
+    lists are also kept as packed buffers (see first_uncovered()).
+
+    Supports the operations of NSEC3Tree used by NSEC3Chain. Nodes are
+    represented by NSEC3ArrayEntry tuples.
+    """
+    def __init__(self, hash_max):
+        self.last = None
+        self.hash_max = hash_max
+        self.covered_distance = int(0)
+        self.ignore_overlapping = False
+
+        self._keys = []
+        self._ends = []
+        self._values = []
+        # buffer for new intervals
+        self._pkeys = []
+        self._pends = []
+        self._pvalues = []
+        # packed intervals of the main lists, see pack_intervals()
+        self._packed = None
+
+    def _entry(self, keys, ends, values, i):
+        return NSEC3ArrayEntry(keys[i], values[i], ends[i])
+
+    def _lists(self):
+        return ((self._keys, self._ends, self._values),
+                (self._pkeys, self._pends, self._pvalues))
+
+    def _floor(self, k):
+        """Finds the entry with the largest key <= k"""
+        best = None
+        for keys, ends, values in self._lists():
+            i = bisect.bisect_right(keys, k) - 1
+            if i >= 0 and (best is None or keys[i] > best.key):
+                best = self._entry(keys, ends, values, i)
+        return best
+
+    def _neighbours(self, k):
+        """Returns the entries with the next smaller and larger keys"""
+        pre = None
+        suc = None
+        for keys, ends, values in self._lists():
+            i = bisect.bisect_left(keys, k)
+            if i > 0 and (pre is None or keys[i-1] > pre.key):
+                pre = self._entry(keys, ends, values, i-1)
+            if i < len(keys) and keys[i] == k:
+                i += 1
+            if i < len(keys) and (suc is None or keys[i] < suc.key):
+                suc = self._entry(keys, ends, values, i)
+        return pre, suc
+
+    def _locate(self, k):
+        for keys, ends, values in self._lists():
+            i = bisect.bisect_left(keys, k)
+            if i < len(keys) and keys[i] == k:
+                return keys, ends, values, i
+        return None
+
+    def find(self, k):
+        """Finds the entry with key k. Returns None if k is not found.
+
+        Time complexity: O(lg n)"""
+        loc = self._locate(k)
+        return self._entry(*loc) if loc is not None else None
+
+    def find_interval(self, k):
+        """Finds the entry e for which e.key <= k <= e.int_end
+
+        Time complexity: O(lg n)"""
+        last = self.last
+        if last is not None and _covers(last, k):
+            return last
+        # inlined _floor(), this is called for every prehashed name
+        keys = self._keys
+        i = bisect.bisect_right(keys, k) - 1
+        pkeys = self._pkeys
+        if len(pkeys) > 0:
+            j = bisect.bisect_right(pkeys, k) - 1
+            if j >= 0 and (i < 0 or pkeys[j] > keys[i]):
+                if k <= self._pends[j] or pkeys[j] >= self._pends[j]:
+                    return self._entry(pkeys, self._pends, self._pvalues, j)
+                return None
+        if i >= 0 and (k <= self._ends[i] or keys[i] >= self._ends[i]):
+            return self._entry(keys, self._ends, self._values, i)
+        return None
+
+    def _first_last(self):
+        """Returns the entries with the smallest and largest keys"""
+        first = None
+        last = None
+        for keys, ends, values in self._lists():
+            if len(keys) == 0:
+                continue
+            if first is None or keys[0] < first.key:
+                first = self._entry(keys, ends, values, 0)
+            if last is None or keys[-1] > last.key:
+                last = self._entry(keys, ends, values, len(keys)-1)
+        return first, last
+
+    def uncovered_gap(self, k):
+        """Returns the uncovered interval around k as a tuple (start, end):
+        the int_end of the preceding entry and the key of the following
+        entry, wrapping around at the end of the hash space. Returns None if
+        k is covered or there are no entries.
+
+        Time complexity: O(lg n)"""
+        if self.find_interval(k) is not None:
+            return None
+        pre, suc = self._neighbours(k)
+        if pre is None or suc is None:
+            first, last = self._first_last()
+            if first is None:
+                return None
+            pre = last if pre is None else pre
+            suc = first if suc is None else suc
+        return (pre.int_end, suc.key)
+
+    def _check_overlap(self, e):
+        if self.ignore_overlapping:
+            return
+        pre, suc = self._neighbours(e.key)
+        if pre is not None:
+            if pre.int_end > e.key:
+                raise OverLapError
+        if suc is not None:
+            if e.int_end > suc.key:
+                raise OverLapError
+
+    def _merge(self):
+        keys, ends, values = self._keys, self._ends, self._values
+        mkeys, mends, mvalues = [], [], []
+        j = 0
+        for k, e, v in zip(self._pkeys, self._pends, self._pvalues):
+            i = bisect.bisect_left(keys, k, j)
+            mkeys += keys[j:i]
+            mends += ends[j:i]
+            mvalues += values[j:i]
+            mkeys.append(k)
+            mends.append(e)
+            mvalues.append(v)
+            j = i
+        mkeys += keys[j:]
+        mends += ends[j:]
+        mvalues += values[j:]
+        self._keys, self._ends, self._values = mkeys, mends, mvalues
+        self._packed = None
+        self._pkeys = []
+        self._pends = []
+        self._pvalues = []
+
+    def insert(self, k, v, int_end):
+        was_updated = False
+        new = NSEC3ArrayEntry(k, v, int_end)
+        loc = self._locate(k)
+        if loc is None:
+            i = bisect.bisect_left(self._pkeys, k)
+            self._pkeys.insert(i, k)
+            self._pends.insert(i, int_end)
+            self._pvalues.insert(i, v)
+            self.covered_distance += _covered_distance(new, self.hash_max)
+        else:
+            keys, ends, values, i = loc
+            if ends[i] != int_end:
+                # same hashed owner name, but interval changed
+                log.warn("next hashed owner changed for existing NSEC3 record\n",
+                                "zone may have changed")
+                self.covered_distance += _covered_distance(new, self.hash_max)
+                self.covered_distance -= _covered_distance(
+                        self._entry(keys, ends, values, i), self.hash_max)
+            ends[i] = int_end
+            values[i] = v
+            if keys is self._keys:
+                self._packed = None
+            if self.last is not None and self.last.key == k:
+                self.last = new
+            was_updated = True
+
+        if self.last is None and k >= int_end:
+            self.last = new
+
+        self._check_overlap(new)
+        if len(self._pkeys) > max(64, 4*math.isqrt(len(self._keys))):
+            self._merge()
+        return (new, was_updated)
+
+    def load(self, keys, ends):
+        """Inserts the intervals given by the lists keys and ends into an
+        empty array. keys must be sorted and unique, the values are None.
+
+        Time complexity: O(n)"""
+        assert self.size() == 0
+        self._keys = list(keys)
+        self._ends = list(ends)
+        self._values = [None]*len(self._keys)
+        self._packed = None
+        hash_max = self.hash_max
+        distance = 0
+        for k, e in zip(self._keys, self._ends):
+            distance += int.from_bytes(e, "big") - int.from_bytes(k, "big")
+            if k >= e:
+                distance += hash_max
+                if self.last is None:
+                    self.last = NSEC3ArrayEntry(k, None, e)
+        self.covered_distance = distance
+        if not self.ignore_overlapping:
+            for i in range(len(self._keys) - 1):
+                if self._ends[i] > self._keys[i+1]:
+                    raise OverLapError
+
+    def _packed_intervals(self):
+        if self._packed is None:
+            self._packed = pack_intervals(self._keys, self._ends)
+        return self._packed
+
+    def first_uncovered(self, digests, start=0):
+        """Returns the index of the first hash in digests, beginning at index
+        start, that is not covered, or None.
+
+        Uses nsec3hash.first_uncovered() on the packed main lists, hashes
+        found there are checked against the buffer for new intervals.
+        """
+        if not HAS_NSEC3HASH:
+            return find_first_uncovered(self.find_interval, digests, start)
+        starts, ends = self._packed_intervals()
+        n = len(digests)//SHA1_LENGTH
+        while start < n:
+            i = nsec3hash.first_uncovered(digests, starts, ends, start)
+            if i < 0:
+                return None
+            if self.find_interval(
+                    digests[i*SHA1_LENGTH:(i+1)*SHA1_LENGTH]) is None:
+                return i
+            start = i + 1
+        return None
+
+    def covered_intervals(self):
+        if len(self._pkeys) > 0:
+            self._merge()
+        return self._packed_intervals()
+
+    def inorder(self, f):
+        """Calls f(e) for every entry e in order.
+
+        Time complexity: O(n)
+        """
+        if len(self._pkeys) > 0:
+            self._merge()
+        for e in zip(self._keys, self._values, self._ends):
+            f(NSEC3ArrayEntry(*e))
+
+    def size(self):
+        return len(self._keys) + len(self._pkeys)
@@ -1,6 +1,29 @@
 from . import rbtree
 from .. import log
 from ..exception import N3MapError
+from ..rrtypes.nsec3 import SHA1_LENGTH
+
+def pack_intervals(keys, ends):
+    """Packs the sorted intervals [keys[i], ends[i]] into a tuple of
+    concatenated 20 byte hashes (starts, ends), as used by
+    nsec3hash.filter_uncovered(). The interval of the last record, which
+    wraps around, is split in two.
+    """
+    if len(keys) > 0 and keys[-1] >= ends[-1]:
+        hash_min = bytes(SHA1_LENGTH)
+        hash_max = b'\xff'*SHA1_LENGTH
+        if keys[-1] == ends[-1]:
+            # a single record covers the entire zone
+            return (hash_min, hash_max)
+        return (b''.join([hash_min] + keys),
+                b''.join([ends[-1]] + ends[:-1] + [hash_max]))
+    return (b''.join(keys), b''.join(ends))
+
+def find_first_uncovered(find_interval, digests, start):
+    for i in range(start, len(digests)//SHA1_LENGTH):
+        if find_interval(digests[i*SHA1_LENGTH:(i+1)*SHA1_LENGTH]) is None:
+            return i
+    return None
 
 class NSEC3TreeNode(rbtree.RBTreeNode):
     def __init__(self, k, v, int_end=None, nil=None):
@@ -68,6 +91,43 @@ class NSEC3Tree(rbtree.RBTree):
 
         return x if x is not self.nil else None
 
+    def first_uncovered(self, digests, start=0):
+        return find_first_uncovered(self.find_interval, digests, start)
+
+    def uncovered_gap(self, k):
+        """Returns the uncovered interval around k as a tuple (start, end):
+        the int_end of the preceding node and the key of the following
+        node, wrapping around at the end of the hash space. Returns None if
+        k is covered or the tree is empty.
+
+        Time complexity: O(lg n) (balanced)"""
+        if self.root is self.nil or self.find_interval(k) is not None:
+            return None
+        x = self.root
+        pre = None
+        suc = None
+        while x is not self.nil:
+            if k < x.key:
+                suc = x
+                x = x.left
+            else:
+                pre = x
+                x = x.right
+        if pre is None:
+            pre = self.maximum()
+        if suc is None:
+            suc = self.minimum()
+        return (pre.int_end, suc.key)
+
+    def covered_intervals(self):
+        keys = []
+        ends = []
+        def add(node):
+            keys.append(node.key)
+            ends.append(node.int_end)
+        self.inorder(add)
+        return pack_intervals(keys, ends)
+
     def update(self, x, new):
         if x.int_end != new.int_end:
             # same hashed owner name, but interval changed
@@ -107,6 +167,12 @@ class NSEC3Tree(rbtree.RBTree):
         self._check_overlap(new)
         return (new, was_updated)
 
+    def load(self, keys, ends):
+        """Inserts the intervals given by the lists keys and ends, the
+        values are None"""
+        for k, e in zip(keys, ends):
+            self.insert(k, None, e)
+
     def delete(self, node):
         deleted = super(NSEC3Tree, self).delete(node)
         if self.last is deleted:
@@ -63,10 +63,16 @@ class Walker(object):
         self.queryprovider = queryprovider
         self.stats = stats if stats is not None else {}
         self._output_file = output_file
+        # cleared if several walks share the status line, like in batch mode
+        self.show_status = True
+
+    def _show_status(self, generator, formatfunc):
+        if self.show_status:
+            log.logger.set_status_generator(generator, formatfunc)
 
     def _write_chain(self, chain):
-        for record in chain:
-            self._write_record(record)
+        if self._output_file is not None:
+            self._output_file.write_chain(chain)
 
     def _write_record(self, record):
         if self._output_file is not None:
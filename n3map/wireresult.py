@@ -0,0 +1,291 @@
+import struct
+
+import dns.exception
+import dns.flags
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+
+from . import name
+from . import rrtypes
+from .exception import N3MapError
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR_HEADER = struct.Struct('!HHIH')
+_RRSIG_FIXED_LENGTH = 18
+# maximum number of compression pointers followed in a single name
+_MAX_POINTERS = 128
+
+# bit numbers set in each possible bitmap octet
+_OCTET_BITS = [tuple([i for i in range(8) if b & (0x80 >> i)])
+        for b in range(256)]
+
+# sections
+_ANSWER = 0
+_AUTHORITY = 1
+_ADDITIONAL = 2
+
+
+class WireFormatError(dns.exception.FormError):
+    """The response is malformed"""
+
+
+def _read_name(msg, offset):
+    """Reads the (possibly compressed) domain name at offset
+
+    Returns a tuple (labels, offset after the name). labels includes the
+    empty root label, like name.domainname_from_wire() does.
+    """
+    labels = []
+    end = None
+    pointers = 0
+    try:
+        while True:
+            n = msg[offset]
+            if n >= 0xc0:
+                if end is None:
+                    end = offset + 2
+                pointers += 1
+                if pointers > _MAX_POINTERS:
+                    raise WireFormatError('too many compression pointers')
+                offset = ((n & 0x3f) << 8) | msg[offset+1]
+                continue
+            if n > name.MAX_LABEL:
+                raise WireFormatError('unknown label type')
+            offset += 1
+            if offset + n > len(msg):
+                raise WireFormatError('truncated name')
+            labels.append(bytes(msg[offset:offset+n]))
+            offset += n
+            if n == 0:
+                break
+    except IndexError:
+        raise WireFormatError('truncated name')
+    return (labels, end if end is not None else offset)
+
+def _skip_name(msg, offset):
+    """Returns the offset after the domain name at offset"""
+    try:
+        while True:
+            n = msg[offset]
+            if n >= 0xc0:
+                return offset + 2
+            if n > name.MAX_LABEL:
+                raise WireFormatError('unknown label type')
+            offset += 1 + n
+            if n == 0:
+                return offset
+    except IndexError:
+        raise WireFormatError('truncated name')
+
+def _domainname(labels):
+    try:
+        return name.DomainName(*[name.Label(l) for l in labels])
+    except N3MapError:
+        raise WireFormatError('invalid domain name')
+
+
+class TypeBitmap(object):
+    """Type bit maps of an NSEC or NSEC3 record (RFC 3845, section 2.1.2)
+
+    Behaves like the list of rrtype mnemonics used by the NSEC and NSEC3
+    classes, but is only decoded once it is actually used, e.g. when the
+    record is written to the output file.
+    """
+    __slots__ = ('_wire', '_types')
+
+    def __init__(self, wire):
+        self._wire = wire
+        self._types = None
+
+    def _decode(self):
+        if self._types is None:
+            types = []
+            wire = self._wire
+            offset = 0
+            while offset + 2 <= len(wire):
+                base = wire[offset] * 256
+                length = wire[offset+1]
+                offset += 2
+                for i, b in enumerate(wire[offset:offset+length]):
+                    for bit in _OCTET_BITS[b]:
+                        types.append(dns.rdatatype.to_text(base + i*8 + bit))
+                offset += length
+            self._types = types
+        return self._types
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __getitem__(self, i):
+        return self._decode()[i]
+
+    def to_wire(self):
+        return self._wire
+
+
+class WireResult(object):
+    """Query result read directly from the response in wire format
+
+    Offers the same interface as query.DNSPythonResult, but does not parse
+    the whole message: the constructor only locates the resource records,
+    the fields used by the walkers are extracted from the rdata on demand.
+    Raises WireFormatError if the message is malformed.
+    """
+    def __init__(self, wire):
+        self._msg = msg = memoryview(wire)
+        try:
+            (self.id, self.flags, qdcount, ancount, nscount,
+                    arcount) = _HEADER.unpack_from(msg)
+        except struct.error:
+            raise WireFormatError('message too short')
+        self._rcode = self.flags & 0xf
+
+        offset = _HEADER.size
+        for i in range(qdcount):
+            offset = _skip_name(msg, offset) + 4
+        # per section: lists of (owner offset, rrtype, rrclass, ttl,
+        # rdata offset, rdata length) tuples
+        self._sections = ([], [], [])
+        for section, count in zip(self._sections,
+                (ancount, nscount, arcount)):
+            for i in range(count):
+                owner = offset
+                offset = _skip_name(msg, offset)
+                try:
+                    rrtype, rrclass, ttl, rdlen = _RR_HEADER.unpack_from(msg,
+                            offset)
+                except struct.error:
+                    raise WireFormatError('truncated resource record')
+                offset += _RR_HEADER.size
+                if offset + rdlen > len(msg):
+                    raise WireFormatError('truncated resource record')
+                if rrtype == dns.rdatatype.OPT:
+                    # extended rcode
+                    self._rcode |= (ttl >> 24) << 4
+                section.append((owner, rrtype, rrclass, ttl, offset, rdlen))
+                offset += rdlen
+
+    def truncated(self):
+        return bool(self.flags & dns.flags.TC)
+
+    def _records(self, section, rrtype):
+        for rr in self._sections[section]:
+            if rr[1] == rrtype and rr[2] == dns.rdataclass.IN:
+                yield rr
+
+    def _first_per_owner(self, section, rrtype):
+        # dnspython groups records into RRsets and DNSPythonResult only looks
+        # at the first record of each set
+        seen = set()
+        for rr in self._records(section, rrtype):
+            labels = _read_name(self._msg, rr[0])[0]
+            key = tuple([l.lower() for l in labels])
+            if key not in seen:
+                seen.add(key)
+                yield labels, rr
+
+    def _owner(self, rr):
+        return _domainname(_read_name(self._msg, rr[0])[0])
+
+    def status(self):
+        return dns.rcode.to_text(self._rcode)
+
+    def find_SOA(self, in_answer=True):
+        for rr in self._records(_ANSWER if in_answer else _AUTHORITY,
+                dns.rdatatype.SOA):
+            return self._owner(rr)
+        return None
+
+    def find_NS(self, in_answer=True):
+        for rr in self._records(_ANSWER if in_answer else _AUTHORITY,
+                dns.rdatatype.NS):
+            return self._owner(rr)
+        return None
+
+    def find_DNSKEY(self):
+        for rr in self._records(_ANSWER, dns.rdatatype.DNSKEY):
+            return self._owner(rr)
+        return None
+
+    def answer_length(self):
+        """Returns the number of RRsets in the answer section"""
+        rrsets = set()
+        msg = self._msg
+        for owner, rrtype, rrclass, ttl, rdata, rdlen in self._sections[
+                _ANSWER]:
+            covers = 0
+            if rrtype == dns.rdatatype.RRSIG and rdlen >= 2:
+                covers = (msg[rdata] << 8) | msg[rdata+1]
+            labels = _read_name(msg, owner)[0]
+            rrsets.add((tuple([l.lower() for l in labels]), rrtype, rrclass,
+                covers))
+        return len(rrsets)
+
+    def find_RRSIG_signer(self, owner, type_covered, in_answer=True):
+        type_covered = dns.rdatatype.from_text(type_covered)
+        msg = self._msg
+        for rr in self._records(_ANSWER if in_answer else _AUTHORITY,
+                dns.rdatatype.RRSIG):
+            rdata, rdlen = rr[4], rr[5]
+            if (rdlen < _RRSIG_FIXED_LENGTH + 1 or
+                    ((msg[rdata] << 8) | msg[rdata+1]) != type_covered):
+                continue
+            if owner == self._owner(rr):
+                return _domainname(_read_name(msg,
+                    rdata + _RRSIG_FIXED_LENGTH)[0])
+        return None
+
+    def find_NSEC(self, in_answer=False):
+        nsec = []
+        msg = self._msg
+        for labels, rr in self._first_per_owner(
+                _ANSWER if in_answer else _AUTHORITY, dns.rdatatype.NSEC):
+            owner, rrtype, rrclass, ttl, rdata, rdlen = rr
+            next_labels, bitmap = _read_name(msg, rdata)
+            if bitmap > rdata + rdlen:
+                raise WireFormatError('invalid NSEC record')
+            nsec.append(rrtypes.nsec.NSEC(
+                    _domainname(labels),
+                    ttl,
+                    'IN',
+                    _domainname(next_labels),
+                    TypeBitmap(bytes(msg[bitmap:rdata+rdlen]))))
+        return nsec
+
+    def all_NSEC_rrs(self):
+        return self.find_NSEC(in_answer=False) + self.find_NSEC(in_answer=True)
+
+    def find_NSEC3(self):
+        nsec3 = []
+        msg = self._msg
+        for labels, rr in self._first_per_owner(_AUTHORITY,
+                dns.rdatatype.NSEC3):
+            owner, rrtype, rrclass, ttl, rdata, rdlen = rr
+            end = rdata + rdlen
+            try:
+                algorithm = msg[rdata]
+                flags = msg[rdata+1]
+                iterations = (msg[rdata+2] << 8) | msg[rdata+3]
+                salt_end = rdata + 5 + msg[rdata+4]
+                salt = bytes(msg[rdata+5:salt_end])
+                next_end = salt_end + 1 + msg[salt_end]
+                next_hashed_owner = bytes(msg[salt_end+1:next_end])
+            except IndexError:
+                raise WireFormatError('invalid NSEC3 record')
+            if next_end > end:
+                raise WireFormatError('invalid NSEC3 record')
+            nsec3.append(rrtypes.nsec3.NSEC3(
+                _domainname(labels),
+                ttl,
+                'IN',
+                algorithm,
+                flags,
+                iterations,
+                salt,
+                next_hashed_owner,
+                TypeBitmap(bytes(msg[next_end:end]))))
+        return nsec3
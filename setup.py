@@ -5,7 +5,8 @@ setup(
     ext_modules = [
         Extension(
             name = "n3map.nsec3hash",
-            sources = ["n3map/nsec3hash.c"],
+            sources = ["n3map/nsec3hash.c", "n3map/sha1mb.c"],
+            depends = ["n3map/sha1mb.h", "n3map/sha1mb_impl.h"],
             libraries = ["crypto"],
             extra_compile_args = ["-O3"],
             ),